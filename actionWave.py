@@ -17,28 +17,29 @@ limitations under the License.
 '''
 Handles requests incoming at wave/action and acts upon them
 '''
-import cgi
 import logging
 import re
 import urllib
 
 import config
-import emailInterface
 from errors.rayExceptions import MalformedRequest
 from errors.interceptor import *
+import notifications
 from permission import rawTypes as pt_raw
-from security import sessionCreation
+from push import waveChannels
+from security import requestContext
 from security.decorators import *
 import utils
 
+from dbtools import readReceipts
 from dbtools import settingsTools
 from dbtools import sessionTools
+from waveto import waveletCache
 from waveto import waveRpc
 
 from waveapi import robot
 from waveapi import simplejson
 
-from google.appengine.ext import deferred
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
@@ -58,8 +59,8 @@ class ActionWave(webapp.RequestHandler):
         '''
         logging.info("POST: /wave/action/")
         #Fetch the auth values from the url + form values
-        incoming_json = cgi.escape(self.request.body)
-        self.incoming = simplejson.loads(incoming_json)
+        self.context = requestContext.get(self)
+        self.incoming = self.context.getBody(strict=True)
 
         self.wave_id = urllib.unquote(self.incoming.get("waveid", ""))
         self.wavelet_id = urllib.unquote(self.incoming.get("waveletid", ""))
@@ -75,6 +76,8 @@ class ActionWave(webapp.RequestHandler):
             return self._readRequest()
         elif self.action == "REFRESH":
             return self._refreshRequest()
+        elif self.action == "CONNECT":
+            return self._connectRequest()
         else:
             return self._malformedRequest()
 
@@ -87,9 +90,7 @@ class ActionWave(webapp.RequestHandler):
         Launches a reply request with ensuring permissions are checked etc
         '''
         logging.info("This is a REPLY request")
-        settingsTools.markSeenChanges(key={ 'wave_id'   : self.wave_id,
-                                            'wavelet_id': self.wavelet_id,
-                                            'email'     : self.email})
+        self.context.setSettings(settingsTools.markSeenChanges(session=self.context.getSession()))
         self._UserReplies()
     
     @hasPermission(False, pt_raw.RW['READ_WRITE'])
@@ -99,9 +100,7 @@ class ActionWave(webapp.RequestHandler):
         Note: this endpoint is accessible via public but is never shown on the wave
         '''
         logging.info("This is a READ request")
-        settingsTools.markSeenChanges(key={ 'wave_id'   : self.wave_id,
-                                            'wavelet_id': self.wavelet_id,
-                                            'email'     : self.email})
+        self.context.setSettings(settingsTools.markSeenChanges(session=self.context.getSession()))
         self.__UserReads(self.incoming.get('blipid', ""))
         self.response.set_status(201)
     
@@ -113,6 +112,16 @@ class ActionWave(webapp.RequestHandler):
         logging.info("This is a REFRESH request")
         self._UserRefresh()
     
+    @hasPermission(False, pt_raw.RW['READ'])
+    def _connectRequest(self):
+        '''
+        Launches a connect request ensuring permissions are checked etc
+        '''
+        logging.info("This is a CONNECT request")
+        token = waveChannels.openChannel(self.wave_id, self.wavelet_id, self.email)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps({'token': token}))
+    
     @hasPermission(False, pt_raw.RW['READ'])
     def _malformedRequest(self):
         '''
@@ -131,14 +140,16 @@ class ActionWave(webapp.RequestHandler):
         marking the wave read etc.
         '''
         #Modify requirements if the wave is public
-        if sessionTools.isPublic(sessionTools.get( self.wave_id, self.wavelet_id, self.email)):
+        if sessionTools.isPublic(self.context.getSession()):
             self._PublicReplies()
         else:
-            #Fetch the wavelet and do some house-keeping
-            wavelet = waveRpc.retry_fetch_wavelet(  config.HTTP_IMPORTANT_RETRY,
-                                                    mrray,
-                                                    self.wave_id,
-                                                    self.wavelet_id)
+            #Fetch the wavelet and do some house-keeping. The snapshot may not
+            #have the blip being replied to or the current roles yet
+            wavelet = waveletCache.fetch_wavelet_json(  config.HTTP_IMPORTANT_RETRY,
+                                                        mrray,
+                                                        self.wave_id,
+                                                        self.wavelet_id,
+                                                        fresh=True).get('wavelet')
         
             try:
                 wavelet.robot_address = config.ROBOT_EMAIL
@@ -156,20 +167,21 @@ class ActionWave(webapp.RequestHandler):
             wavelet.add_proxying_participant(proxy_for)
             self.__InsertBlipIntoWavelet(wavelet, proxy_for)
             self.__AlertEmailParticipants(wavelet, self.email+"(via Mr-Ray)")
-            waveRpc.retry_submit(config.HTTP_IMPORTANT_RETRY, mrray, wavelet)
 
-            #Re-fetch the new (updated) wavelet
-            new_wavelet_data = waveRpc.retry_fetch_wavelet_json(config.HTTP_IMPORTANT_RETRY,
-                                                                mrray,
-                                                                self.wave_id,
-                                                                self.wavelet_id)
+            #Submit and re-fetch the new (updated) wavelet
+            new_wavelet_data = waveletCache.submit_and_fetch_wavelet_json(  config.HTTP_IMPORTANT_RETRY,
+                                                                            mrray,
+                                                                            wavelet)
             self.__MarkNewBlipRead(new_wavelet_data)
+            waveChannels.queueNotifyWave(self.wave_id, self.wavelet_id)
         
             #Write the response
             wavelet_json = utils.construct_wavelet_json_for_http_response(  new_wavelet_data,
                                                                             self.wave_id,
                                                                             self.wavelet_id,
-                                                                            self.email)
+                                                                            self.email,
+                                                                            session=self.context.getSession(),
+                                                                            settings=self.context.getSettings())
             self.response.headers['Content-Type'] = 'application/json'
             self.response.out.write(wavelet_json)
             self.response.set_status(201)
@@ -187,11 +199,13 @@ class ActionWave(webapp.RequestHandler):
             logger.warn("The response came from a public wave and expected the 'name' field to only contain [a-zA-Z0-9_] but it was " + name)
             raise MalformedRequest("The response came from a public wave and expected the 'name' field to only contain [a-zA-Z0-9_] but it was " + name)
         
-        #Fetch the wavelet and do some house-keeping
-        wavelet = waveRpc.retry_fetch_wavelet(  config.HTTP_IMPORTANT_RETRY,
-                                                mrray,
-                                                self.wave_id,
-                                                self.wavelet_id)
+        #Fetch the wavelet and do some house-keeping. The snapshot may not
+        #have the blip being replied to or the current roles yet
+        wavelet = waveletCache.fetch_wavelet_json(  config.HTTP_IMPORTANT_RETRY,
+                                                    mrray,
+                                                    self.wave_id,
+                                                    self.wavelet_id,
+                                                    fresh=True).get('wavelet')
         
         try:
             wavelet.robot_address = config.ROBOT_EMAIL
@@ -209,19 +223,20 @@ class ActionWave(webapp.RequestHandler):
         wavelet.add_proxying_participant(proxy_for)
         self.__InsertBlipIntoWavelet(wavelet, proxy_for)
         self.__AlertEmailParticipants(wavelet, self.name + "(via Mr-Ray Public)")
-        waveRpc.retry_submit(config.HTTP_IMPORTANT_RETRY, mrray, wavelet)
 
-        #Re-fetch the new (updated) wavelet
-        new_wavelet_data = waveRpc.retry_fetch_wavelet_json(config.HTTP_IMPORTANT_RETRY,
-                                                            mrray,
-                                                            self.wave_id,
-                                                            self.wavelet_id)
+        #Submit and re-fetch the new (updated) wavelet
+        new_wavelet_data = waveletCache.submit_and_fetch_wavelet_json(  config.HTTP_IMPORTANT_RETRY,
+                                                                        mrray,
+                                                                        wavelet)
+        waveChannels.queueNotifyWave(self.wave_id, self.wavelet_id)
         
         #Write the response
         wavelet_json = utils.construct_wavelet_json_for_http_response(  new_wavelet_data,
                                                                         self.wave_id,
                                                                         self.wavelet_id,
-                                                                        self.email)
+                                                                        self.email,
+                                                                        session=self.context.getSession(),
+                                                                        settings=self.context.getSettings())
         self.response.headers['Content-Type'] = 'application/json'
         self.response.out.write(wavelet_json)
         self.response.set_status(201)
@@ -230,15 +245,39 @@ class ActionWave(webapp.RequestHandler):
         '''
         Fetches and returns the wavelet json for a user
         '''
-        new_wavelet_data = waveRpc.retry_fetch_wavelet_json(config.HTTP_LOSSY_RETRY,
+        new_wavelet_data = waveletCache.fetch_wavelet_json( config.HTTP_LOSSY_RETRY,
                                                             mrray,
                                                             self.wave_id,
                                                             self.wavelet_id)
 
+        #Built once for both the etag and the response
+        user_fields = utils.construct_user_fields(  self.wave_id,
+                                                    self.wavelet_id,
+                                                    self.email,
+                                                    session=self.context.getSession(),
+                                                    settings=self.context.getSettings())
+
+        #Don't send anything back if the client is already up to date
+        etag = utils.construct_wavelet_etag(new_wavelet_data,
+                                            self.wave_id,
+                                            self.wavelet_id,
+                                            self.email,
+                                            user_fields=user_fields)
+        self.response.headers['ETag'] = '"' + etag + '"'
+        if self.request.headers.get('If-None-Match', None) == '"' + etag + '"':
+            self.response.set_status(304)
+            return
+        if self.incoming.get('etag', None) == etag:
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.out.write(simplejson.dumps({'unchanged': True, 'etag': etag}))
+            return
+
         wavelet_json = utils.construct_wavelet_json_for_http_response(  new_wavelet_data,
                                                                         self.wave_id,
                                                                         self.wavelet_id,
-                                                                        self.email)
+                                                                        self.email,
+                                                                        known=self.incoming.get('known', None),
+                                                                        user_fields=user_fields)
         self.response.headers['Content-Type'] = 'application/json'
         self.response.out.write(wavelet_json)
 
@@ -267,26 +306,14 @@ class ActionWave(webapp.RequestHandler):
                         subscribed to
         @param who_changed: the friendly name of who changed the wave
         '''
-        #Alert other e-mail participants that a new blip has been posted
-        sessions = sessionTools.fetch(wavelet.wave_id, wavelet.wavelet_id)
-
-        for userSession in sessions:
-            if not userSession.email == self.email and not sessionTools.isPublic(userSession):
-                userSettings = settingsTools.get(userSession)
-                if not userSettings.unseen_changes and not userSettings.rw_permission == pt_raw.RW['DELETED']:
-                    deferred.defer(
-                        emailInterface.sendNotificationEmail,
-                        sessionCreation.regenerateUser( wavelet.wave_id,
-                                                        wavelet.wavelet_id,
-                                                        userSession.email   ),
-                        wavelet.wave_id,
-                        wavelet.wavelet_id,
-                        userSession.email,
-                        self.email,
-                        wavelet.title,
-                        who_modified_display=who_changed)
-                    
-                    settingsTools.markUnseenChanges(session=userSession)
+        #Alert other e-mail participants that a new blip has been posted. The
+        #participants are worked through in a task
+        notifications.queueNotifyParticipants(  wavelet.wave_id,
+                                                wavelet.wavelet_id,
+                                                wavelet.title,
+                                                self.email,
+                                                who_modified_display=who_changed,
+                                                exclude_email=self.email)
 
     def __MarkNewBlipRead(self, new_wavelet_data):
         '''
@@ -297,12 +324,14 @@ class ActionWave(webapp.RequestHandler):
         '''
         #Mark new blip read
         blip_id = self.incoming.get('blipid', "")
-        new_parent_blip = new_wavelet_data.get('wavelet').blips.get(blip_id, None)
+        #Read the json rather than building the wavelet just to find one blip
+        blips = new_wavelet_data.get('json').get('blips', {})
+        new_parent_blip = blips.get(blip_id, None)
         if new_parent_blip:
-            child_blips = new_parent_blip.child_blips
-            for b in child_blips:
-                if config.ROBOT_IDENT + "+" + utils.getProxyForFromEmail(self.email) + "@" + config.ROBOT_DOMAIN in b.contributors:
-                    self.__UserReads(b.blip_id)
+            for child_blip_id in new_parent_blip.get('childBlipIds', []):
+                b = blips.get(child_blip_id, None)
+                if b and config.ROBOT_IDENT + "+" + utils.getProxyForFromEmail(self.email) + "@" + config.ROBOT_DOMAIN in b.get('contributors', []):
+                    self.__UserReads(child_blip_id)
 
 
     def __UserReads(self, blip_id):
@@ -313,10 +342,8 @@ class ActionWave(webapp.RequestHandler):
         if not blip_id:
             return
 
-        #Update the database
-        settingsTools.userReadsBlip(blip_id, key={  'wave_id'   : self.wave_id,
-                                                    'wavelet_id': self.wavelet_id,
-                                                    'email'     : self.email})
+        #Buffered and written to the datastore by a later flush
+        readReceipts.record(self.context.getSession(), blip_id)
 
 
 if __name__=="__main__":
@@ -324,6 +351,9 @@ if __name__=="__main__":
 
     mrray = robot.Robot(config.ROBOT_IDENT)
     mrray.setup_oauth(config.CONSUMER_KEY, config.CONSUMER_SECRET, server_rpc_base=config.WAVE_SERVER_RPC)
+    transport = waveRpc.get_http_transport()
+    if transport:
+        mrray.http_post = transport.post
 
     run_wsgi_app(   webapp.WSGIApplication(
                                             [('/wave/action/', ActionWave)]
@@ -52,6 +52,65 @@ PROXY_FOR_AT_REPLACE = "-_at_-"
 #Contacting external wave service
 HTTP_LOSSY_RETRY = 2
 HTTP_IMPORTANT_RETRY = 4
+#How robots post rpcs to the wave server. "appengine" uses urlfetch, "pooled"
+#keeps connections open between rpcs for when the app isn't run on App Engine
+HTTP_TRANSPORT = "appengine"
+
+#Shared wavelet snapshot cache. Snapshots are served to every user of a wave
+#for this many seconds before being re-fetched from the wave server
+WAVELET_SNAPSHOT_FRESH_SECS = 10
+#Seconds a snapshot cannot be re-added after it is invalidated. Stops fetches
+#that were in flight when the wave changed from caching the old wavelet
+WAVELET_SNAPSHOT_INVALIDATE_LOCK_SECS = 5
+
+#Single flight fetching. When many requests want the same wavelet at once one
+#takes a lease and fetches it while the others wait for its result. A waiting
+#request holds up its instance, so the wait is kept short
+WAVELET_FETCH_LEASE_SECS = 10
+WAVELET_FETCH_WAIT_SECS = 0.5
+WAVELET_FETCH_POLL_SECS = 0.05
+WAVELET_FETCH_RESULT_SECS = 2
+
+#The most wavelets fetched at once by bulk jobs. Threads can't be started on
+#the python 2.5 runtime so fetches fall back to being serial there
+WAVELET_FETCH_MANY_CONCURRENCY = 4
+
+#Push updates to open pages as the wave changes. Pages fall back to slow
+#polling when this is off or their channel closes
+PUSH_ENABLED = True
+PUSH_CHANNEL_LIFETIME_SECS = 7200
+
+#Update notifications are collected for each recipient and sent as one
+#digest e-mail per window rather than one e-mail per wave. Off by default so
+#recipients keep getting one e-mail per wave until it is turned on
+EMAIL_DIGEST_ENABLED = False
+EMAIL_DIGEST_WINDOW_SECS = 600
+EMAIL_DIGEST_MAX_ENTRIES = 50
+
+#Outgoing mail. Each sender may send MAIL_RATE_PER_MINUTE with bursts of up
+#to MAIL_BUCKET_SIZE. Update notices leave MAIL_INVITATION_RESERVE of the
+#burst for invitations. Mail that has to wait is held in the lanes task queue
+MAIL_RATE_PER_MINUTE = 60
+MAIL_BUCKET_SIZE = 20
+MAIL_INVITATION_RESERVE = 5
+MAIL_QUEUES = { "invitation"    :   "mail-invitations",
+                "update"        :   "mail-updates"}
+#When the mail quota runs out sending pauses, doubling each time up to the max
+MAIL_BACKOFF_MIN_SECS = 60
+MAIL_BACKOFF_MAX_SECS = 3600
+#How long a sent message is remembered so a retried task can't send it again
+MAIL_DEDUP_EXPIRE_SECS = 86400
+#How mail is sent. "appengine" uses the App Engine mail API, "smtp" sends
+#through the SMTP server below over a pool of persistent connections
+MAIL_TRANSPORT = "appengine"
+SMTP_HOST = "localhost"
+SMTP_PORT = 25
+SMTP_USERNAME = None
+SMTP_PASSWORD = None
+SMTP_USE_TLS = False
+SMTP_POOL_SIZE = 4
+#Connections are replaced after sending this many messages
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
 
 #Public users
 PUBLIC_EMAIL = "mrrayopen-public@wave.to"
@@ -0,0 +1,305 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Two tier cache for the dbtools entities. The first tier is an LRU held in
+the memory of this instance, the second is memcache.
+
+memcache can't tell a cached None from a miss so entities that don't exist
+are cached as a sentinel with a short expiry instead. Repeated lookups for a
+missing entity then cost a single memcache call rather than a datastore query
+each time.
+
+Entries are cached in a group, which is the wave they belong to. Writing an
+entity increments a generation counter for its group in memcache, which tells
+every other instance to drop its local copies of that group. Instances only
+look at the counter once every LOCAL_CACHE_GENERATION_CHECK_SECS so their
+local copies can be that much out of date. Objects from the local tier are
+shared between requests on this instance, so anything that is going to
+change an entity must fetch it with local=False
+'''
+import base64
+import time as _time
+
+import memcacheConfig
+
+from google.appengine.api import memcache
+
+#Returned by get when the key isn't cached at all
+MISS = object()
+
+#Stored in place of None
+_NEGATIVE = "__cacheTools:negative__"
+
+#Hits and misses for each tier since the instance started
+_stats = {  'local_hits'    :   0,
+            'memcache_hits' :   0,
+            'misses'        :   0}
+
+def get(key, group=None, local=True):
+    '''
+    @param key: the memcache key
+    @param group=None: the group the entry is cached in. Entries without a
+    group are only cached in memcache
+    @param local=True: set to False to skip the local tier, for example when
+    the entity is going to be changed
+    @return the cached value, None if the entity is cached as not existing or
+    MISS if nothing is cached
+    '''
+    if local and not group == None:
+        value = _local.get(key, _currentGeneration(group))
+        if not value is MISS:
+            _stats['local_hits'] += 1
+            return value
+    value = _decode(memcache.get(key))
+    if value is MISS:
+        _stats['misses'] += 1
+    else:
+        _stats['memcache_hits'] += 1
+        if local:
+            _storeLocal(key, value, group)
+    return value
+
+def get_multi(keys, group=None, local=True):
+    '''
+    @param keys: the list of memcache keys
+    @param group=None: the group the entries are cached in
+    @param local=True: set to False to skip the local tier
+    @return a dict of key to the cached value, with None for entities cached
+    as not existing. Keys that aren't cached are left out
+    '''
+    values = {}
+    remaining = keys
+    if local and not group == None:
+        generation = _currentGeneration(group)
+        remaining = []
+        for key in keys:
+            value = _local.get(key, generation)
+            if value is MISS:
+                remaining.append(key)
+            else:
+                values[key] = value
+        _stats['local_hits'] += len(values)
+    if remaining:
+        for key, value in memcache.get_multi(remaining).items():
+            values[key] = _decode(value)
+            if local:
+                _storeLocal(key, values[key], group)
+            _stats['memcache_hits'] += 1
+        _stats['misses'] += len(keys) - len(values)
+    return values
+
+def add(key, value, group=None, local=True, time=memcacheConfig.DEFAULT_EXPIRE_SECS):
+    '''
+    Caches a value fetched from the datastore unless the key is already
+    cached or locked by an invalidation. None is cached as a negative entry
+    which expires after memcacheConfig.NEGATIVE_EXPIRE_SECS
+    @param key: the memcache key
+    @param value: the entity or None if it doesn't exist
+    @param group=None: the group to cache the entry in
+    @param local=True: set to False to only cache the entry in memcache
+    @param time=DEFAULT_EXPIRE_SECS: the expiry of a positive entry
+    '''
+    if value == None:
+        memcache.add(key, _NEGATIVE, time=memcacheConfig.NEGATIVE_EXPIRE_SECS)
+    else:
+        memcache.add(key, value, time=time)
+    if local:
+        _storeLocal(key, value, group)
+
+def add_multi(mapping, group=None, local=True, time=memcacheConfig.DEFAULT_EXPIRE_SECS):
+    '''
+    Caches many values at once. See add
+    @param mapping: a dict of key to the entity or None if it doesn't exist
+    @param group=None: the group to cache the entries in
+    @param local=True: set to False to only cache the entries in memcache
+    @param time=DEFAULT_EXPIRE_SECS: the expiry of the positive entries
+    '''
+    positive = {}
+    negative = {}
+    for key, value in mapping.items():
+        if value == None:
+            negative[key] = _NEGATIVE
+        else:
+            positive[key] = value
+        if local:
+            _storeLocal(key, value, group)
+    if positive:
+        memcache.add_multi(positive, time=time)
+    if negative:
+        memcache.add_multi(negative, time=memcacheConfig.NEGATIVE_EXPIRE_SECS)
+
+def delete(key, group=None):
+    '''
+    Removes a key after its entity has been written. The key is locked
+    against add for a moment so a request that read the datastore before the
+    write can't cache its stale result, including a stale negative entry
+    @param key: the memcache key
+    @param group=None: the group the entry is cached in. Other instances drop
+    their local copies of the whole group
+    '''
+    delete_multi([key], group)
+
+def delete_multi(keys, group=None):
+    '''
+    Removes many keys at once. See delete
+    @param keys: the list of memcache keys
+    @param group=None: the group the entries are cached in
+    '''
+    memcache.delete_multi(keys, seconds=memcacheConfig.INVALIDATE_LOCK_SECS)
+    for key in keys:
+        _local.remove(key)
+    if not group == None:
+        generation = memcache.incr(_generateGenerationKey(group), initial_value=0)
+        if generation == None:
+            #memcache is unavailable. Stop trusting the local copies of this group
+            generation = MISS
+        _generations[group] = (generation, _time.time())
+
+def getStats():
+    '''
+    @return a dict of the hits and misses for each tier since the instance
+    started, along with the hit rate of each tier as a fraction of all gets
+    '''
+    stats = dict(_stats)
+    total = stats['local_hits'] + stats['memcache_hits'] + stats['misses']
+    for tier in ['local', 'memcache']:
+        if total:
+            stats[tier + '_hit_rate'] = float(stats[tier + '_hits']) / total
+        else:
+            stats[tier + '_hit_rate'] = 0.0
+    stats['local_size'] = len(_local)
+    return stats
+
+class _LocalCache(object):
+    '''
+    A size bounded least recently used cache whose entries expire. When it
+    is full the least recently used tenth of the entries are evicted at once
+    '''
+    def __init__(self, max_size, expire_secs):
+        '''
+        @param max_size: the most entries to hold
+        @param expire_secs: how long an entry is kept
+        '''
+        self._max_size = max_size
+        self._expire_secs = expire_secs
+        self._entries = {}
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation):
+        '''
+        @param key: the key of the entry
+        @param generation: the current generation of the entries group
+        @return the value or MISS if it isn't held, has expired or is from
+        another generation
+        '''
+        entry = self._entries.get(key, None)
+        if entry == None:
+            return MISS
+        value, entry_generation, expires, last_used = entry
+        if generation is MISS or not entry_generation == generation or expires < _time.time():
+            del self._entries[key]
+            return MISS
+        self._tick += 1
+        entry[3] = self._tick
+        return value
+
+    def put(self, key, value, generation):
+        '''
+        @param key: the key of the entry
+        @param value: the value to hold
+        @param generation: the generation of the entries group
+        '''
+        if len(self._entries) >= self._max_size and not self._entries.has_key(key):
+            self._evict()
+        self._tick += 1
+        self._entries[key] = [value, generation, _time.time() + self._expire_secs, self._tick]
+
+    def remove(self, key):
+        '''
+        @param key: the key of the entry to drop
+        '''
+        if self._entries.has_key(key):
+            del self._entries[key]
+
+    def _evict(self):
+        '''
+        Drops the least recently used tenth of the entries
+        '''
+        by_use = [(entry[3], key) for key, entry in self._entries.items()]
+        by_use.sort()
+        for last_used, key in by_use[:max(1, len(by_use) / 10)]:
+            del self._entries[key]
+
+_local = _LocalCache(   memcacheConfig.LOCAL_CACHE_SIZE,
+                        memcacheConfig.LOCAL_CACHE_EXPIRE_SECS)
+
+#group to a tuple of its last seen generation and when it was fetched
+_generations = {}
+
+def _currentGeneration(group):
+    '''
+    @param group: the cache group
+    @return the generation of the group, fetching it from memcache if it
+    hasn't been looked at recently. MISS if memcache is unavailable
+    '''
+    generation, checked = _generations.get(group, (MISS, 0))
+    if _time.time() - checked >= memcacheConfig.LOCAL_CACHE_GENERATION_CHECK_SECS:
+        generation = memcache.get(_generateGenerationKey(group))
+        if generation == None:
+            #Never written. Start it so everyone agrees on its value
+            memcache.add(_generateGenerationKey(group), 0)
+            generation = memcache.get(_generateGenerationKey(group))
+            if generation == None:
+                generation = MISS
+        _generations[group] = (generation, _time.time())
+    return generation
+
+def _storeLocal(key, value, group):
+    '''
+    Holds a value in the local tier, tagged with the generation of its group
+    as it was before the value was fetched
+    @param key: the memcache key
+    @param value: the value or None for a missing entity
+    @param group: the group of the entry or None to skip the local tier
+    '''
+    if group == None:
+        return
+    generation = _generations.get(group, (MISS, 0))[0]
+    if not generation is MISS:
+        _local.put(key, value, generation)
+
+def _generateGenerationKey(group):
+    '''
+    @param group: the cache group
+    @return the memcache key of the groups generation counter
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['GENERATION'] + group)
+
+def _decode(value):
+    '''
+    @param value: the value returned by memcache
+    @return the value with the negative sentinel turned into None and a miss
+    turned into MISS
+    '''
+    if value is None:
+        return MISS
+    if isinstance(value, str) and value == _NEGATIVE:
+        return None
+    return value
@@ -18,4 +18,20 @@ limitations under the License.
 A set of configuration variables used for database entries
 '''
 KEY_PREFIX = {  "SETTINGS"      :   "",#This is blank as there is already data in the wild
-                "FOLLOWED_WAVE" :   "flwdwv:/"}
\ No newline at end of file
+                "FOLLOWED_WAVE" :   "flwdwv:/",
+                "SESSION"       :   "sess:/",
+                "ROSTER"        :   "rstr:/"}
+
+#The most sessions fetched by a single query when walking the sessions of a
+#wave. Each chunk is cached as a separate memcache value
+SESSION_CHUNK_SIZE = 100
+
+#The most users whose settings are written in one cross group transaction.
+#Each users settings are an entity group of their own and a cross group
+#transaction can span at most 25
+XG_TRANSACTION_GROUPS = 25
+
+#Throughput of the bulk migration jobs in dbmigration. Each task migrates one
+#batch and the next is queued after the delay
+MIGRATION_BATCH_SIZE = 100
+MIGRATION_BATCH_DELAY_SECS = 1
@@ -17,12 +17,159 @@ limitations under the License.
 '''
 Methods used for migrating database models between versions
 '''
+import base64
+import logging
+import time
+
+import dbConfig
+import memcacheConfig
+from models import MigrationStatus
+from models import Session
 from models import Settings
+import rosterTools
 import settingsTools
 import sessionTools
 
 from waveapi import simplejson
 
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+#The name of the job that moves every session to version 2
+V1_TO_V2 = "v1tov2"
+
+#The name of the job that gives every session a key name
+SESSION_KEYS = "sessionkeys"
+
+#Jobs this instance has seen finish. A job never becomes unfinished again
+_complete = {}
+
+def isComplete(name):
+    '''
+    Checks whether a bulk migration job has finished. Read paths use this to
+    skip checking each entity once every entity has been migrated. Once a job
+    is seen to have finished it is remembered for the life of the instance
+    @param name: the name of the job
+    @return True if the job has finished
+    '''
+    if _complete.get(name, False):
+        return True
+    key = base64.b64encode(memcacheConfig.PREFIX['MIGRATION'] + name)
+    complete = memcache.get(key)
+    if complete == None:
+        status = MigrationStatus.get_by_key_name(name)
+        complete = bool(status and status.complete)
+        memcache.add(key, complete, time=memcacheConfig.MIGRATION_STATUS_EXPIRE_SECS)
+    if complete:
+        _complete[name] = True
+    return complete
+
+def getStatus(name):
+    '''
+    @param name: the name of the job
+    @return the MigrationStatus of the job or None if it has never been started
+    '''
+    return MigrationStatus.get_by_key_name(name)
+
+def startJob(name, model, function):
+    '''
+    Starts a bulk migration job, or resumes it from where it got to if it has
+    been started before. The job walks every entity of a kind with a query
+    cursor in a chain of deferred tasks. Each task migrates
+    dbConfig.MIGRATION_BATCH_SIZE entities, records its progress in the jobs
+    MigrationStatus and queues the next after
+    dbConfig.MIGRATION_BATCH_DELAY_SECS
+    @param name: the name of the job
+    @param model: the model class of the entities to migrate
+    @param function: a module level function that is passed each entity and
+    returns True if it migrated it. It must be safe to run more than once
+    '''
+    status = MigrationStatus.get_or_insert(name, kind=model.kind())
+    if status.complete:
+        logging.info("Migration " + name + " has already finished")
+        return
+    deferred.defer(_mapBatch, name, function, status.cursor)
+
+def startV1toV2():
+    '''
+    Starts the job that moves every session to version 2. Once it has
+    finished the sessions are no longer checked as they are read
+    '''
+    startJob(V1_TO_V2, Session, _migrateSessionV1toV2)
+
+def startSessionKeys():
+    '''
+    Starts the job that gives sessions created before sessions had key names
+    a key name, so they can be fetched by key rather than by query. Their
+    settings are re-parented to the new session. Once it has finished
+    sessions are no longer looked for with a query
+    '''
+    startJob(SESSION_KEYS, Session, _migrateSessionKeyName)
+
+def _mapBatch(name, function, cursor):
+    '''
+    Migrates one batch of a job. The progress and the next task are written
+    in one transaction so a retried task can tell its batch is already done
+    @param name: the name of the job
+    @param function: the function to pass each entity to
+    @param cursor: the query cursor the batch starts from
+    '''
+    status = MigrationStatus.get_by_key_name(name)
+    if status == None or status.complete or not status.cursor == cursor:
+        #Finished or this batch has already been done
+        return
+    query = db.Query(db.class_for_kind(status.kind))
+    if cursor:
+        query.with_cursor(cursor)
+    entities = query.fetch(dbConfig.MIGRATION_BATCH_SIZE)
+    start = time.time()
+    migrated = 0
+    for entity in entities:
+        if function(entity):
+            migrated += 1
+    next_cursor = query.cursor()
+    complete = len(entities) < dbConfig.MIGRATION_BATCH_SIZE
+
+    def worker(status):
+        '''
+        @transaction_safe
+        '''
+        status = db.get(status.key())
+        if not status.cursor == cursor:
+            return status
+        status.scanned += len(entities)
+        status.migrated += migrated
+        status.cursor = next_cursor
+        status.complete = complete
+        status.put()
+        if not complete:
+            deferred.defer( _mapBatch,
+                            name,
+                            function,
+                            next_cursor,
+                            _countdown=dbConfig.MIGRATION_BATCH_DELAY_SECS,
+                            _transactional=True)
+        return status
+
+    status = db.run_in_transaction(worker, status)
+    logging.info(   "Migration " + name + " migrated " + str(migrated) + " of " +
+                    str(len(entities)) + " in " + str(int((time.time() - start) * 1000)) +
+                    "ms. " + str(status.migrated) + " of " + str(status.scanned) + " so far")
+    if status.complete:
+        memcache.delete(base64.b64encode(memcacheConfig.PREFIX['MIGRATION'] + name))
+        logging.info("Migration " + name + " complete")
+
+def _migrateSessionV1toV2(session):
+    '''
+    @param session: the session to migrate
+    @return True if the session was on version 1 and has been migrated
+    '''
+    if not session.version == 1:
+        return False
+    migratev1tov2([session])
+    return True
+
 def migratev1tov2(sessions):
     '''
     Looks at the provided session and if it is running version 1 migrates it
@@ -41,4 +188,67 @@ def migratev1tov2(sessions):
             session.version = 2
             session.read_blips = None
             session.unseenChanges = None
-            sessionTools.put(session)
\ No newline at end of file
+            sessionTools.put(session)
+
+def _migrateSessionKeyName(session):
+    '''
+    @param session: the session to migrate
+    @return True if the session had no key name and has been given one
+    '''
+    if not session.key().name() == None:
+        return False
+    _migrateSessionKey(session)
+    return True
+
+def _migrateSessionKey(session):
+    '''
+    Copies a session and its settings to their key named versions and removes
+    the originals. The copy and the removal are made in one cross group
+    transaction over the old and new sessions, so the session can always be
+    found and a change made to the settings in the meantime isn't lost
+    @param session: the session without a key name
+    '''
+    migratev1tov2([session])
+
+    def worker(session_key):
+        '''
+        @transaction_safe
+        '''
+        session = db.get(session_key)
+        if session == None:
+            return None#Migrated by another task
+        new_session = Session(  wave_id     =   session.wave_id,
+                                wavelet_id  =   session.wavelet_id,
+                                email       =   session.email,
+                                auth_token  =   session.auth_token,
+                                version     =   session.version,
+                                key_name    =   sessionTools.generateKey(   session.wave_id,
+                                                                            session.wavelet_id,
+                                                                            session.email))
+        old_settings = Settings.all().ancestor(session).fetch(10)
+        new_settings = []
+        for settings in old_settings:
+            new_settings.append(Settings(   read_blips      = settings.read_blips,
+                                            read_bits       = settings.read_bits,
+                                            read_upto       = settings.read_upto,
+                                            unseen_changes  = settings.unseen_changes,
+                                            rw_permission   = settings.rw_permission,
+                                            notification_version = settings.notification_version,
+                                            parent          = new_session,
+                                            key_name        = settingsTools.generateKey(session.wave_id,
+                                                                                        session.wavelet_id,
+                                                                                        session.email)))
+        db.put([new_session] + new_settings)
+        db.delete(old_settings + [session])
+        return new_session
+
+    new_session = db.run_in_transaction_options(db.create_transaction_options(xg=True),
+                                                worker,
+                                                session.key())
+    if new_session == None:
+        return
+    #Requests may have cached the originals while they were being copied
+    sessionTools.invalidate(new_session)
+    settingsTools.invalidate(session.wave_id, session.wavelet_id, session.email)
+    #The roster holds the key of the original session
+    rosterTools.delete(session.wave_id, session.wavelet_id)
@@ -0,0 +1,77 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Methods to make using DigestEntry models easier
+'''
+from models import DigestEntry
+
+from google.appengine.ext import db
+
+def add_multi(notifications):
+    '''
+    Saves many notifications with a single batched put. A newer notification
+    for a wave replaces the one already waiting for the same recipient
+    @param notifications: a list of dicts containing send_to, url, wave_id,
+    wavelet_id, who_modified, wave_title and optionally who_modified_display
+    '''
+    entries = []
+    for notification in notifications:
+        entries.append(DigestEntry( wave_id                 = notification['wave_id'],
+                                    wavelet_id              = notification['wavelet_id'],
+                                    url                     = notification['url'],
+                                    title                   = notification['wave_title'],
+                                    who_modified            = notification['who_modified'],
+                                    who_modified_display    = notification.get('who_modified_display', None),
+                                    parent                  = _generateRecipientKey(notification['send_to']),
+                                    key_name                = notification['wave_id'] + "|" + notification['wavelet_id']))
+    db.put(entries)
+
+def fetch(send_to, limit):
+    '''
+    @param send_to: the email address of the recipient
+    @param limit: the most entries to fetch
+    @return a list of the entries waiting for the recipient, oldest first
+    '''
+    query = DigestEntry.all().ancestor(_generateRecipientKey(send_to)).order('created')
+    return query.fetch(limit)
+
+def delete(entries):
+    '''
+    Removes entries once they have been sent. An entry that was replaced by a
+    newer notification in the meantime is kept for the next digest
+    @param entries: the list of entries to remove. All for one recipient
+    '''
+    def worker(entries):
+        '''
+        @transaction_safe
+        '''
+        current = db.get([entry.key() for entry in entries])
+        sent = []
+        for entry, latest in zip(entries, current):
+            if latest and latest.created == entry.created:
+                sent.append(latest)
+        db.delete(sent)
+
+    if entries:
+        db.run_in_transaction(worker, entries)
+
+def _generateRecipientKey(send_to):
+    '''
+    @param send_to: the email address of the recipient
+    @return the key that the recipients entries are children of
+    '''
+    return db.Key.from_path('DigestRecipient', send_to)
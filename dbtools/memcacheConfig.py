@@ -19,7 +19,44 @@ Set of configuration variables used for configuring memcache
 '''
 DEFAULT_EXPIRE_SECS = 300
 
+#How long an entity that doesn't exist is remembered as missing
+NEGATIVE_EXPIRE_SECS = 30
+
+#How long a key is locked against being re-cached after its entity is written
+INVALIDATE_LOCK_SECS = 2
+
+#The in memory cache each instance keeps in front of memcache. Instances look
+#for writes made by other instances at most once every check period
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_EXPIRE_SECS = 60
+LOCAL_CACHE_GENERATION_CHECK_SECS = 1
+
+#Read receipts are buffered in memcache and written to the datastore once
+#every flush period. Receipts not flushed before they expire are lost
+READ_RECEIPT_FLUSH_SECS = 60
+READ_RECEIPT_EXPIRE_SECS = 3600
+
+#How long an unfinished migration is remembered as unfinished. Read paths
+#keep checking entities until they see it has finished
+MIGRATION_STATUS_EXPIRE_SECS = 60
+
 PREFIX = {  "SESSION"       :   "sess:/",
             "SETTINGS"      :   "sett:/",
             "FOLLOWED_WAVE" :   "flwdwv:/",
-            "WAVE_META"     :   "wvmeta:/"}
\ No newline at end of file
+            "WAVE_META"     :   "wvmeta:/",
+            "WAVELET"       :   "wvlt:/",
+            "WAVELET_LEASE" :   "wvltlease:/",
+            "WAVELET_FLIGHT":   "wvltflight:/",
+            "PUSH_CLIENTS"  :   "pushclnt:/",
+            "GENERATION"    :   "gen:/",
+            "SESSION_CHUNK" :   "sesschnk:/",
+            "SESSION_GENERATION":"sessgen:/",
+            "ROSTER"        :   "rstr:/",
+            "READ_RECEIPTS" :   "rdrcpt:/",
+            "READ_RECEIPTS_FLUSH":"rdrcptflsh:/",
+            "MIGRATION"     :   "mgrtn:/",
+            "EMAIL_DIGEST"  :   "emldgst:/",
+            "MAIL_BUCKET"   :   "mlbckt:/",
+            "MAIL_PAUSE"    :   "mlpause:/",
+            "MAIL_METRIC"   :   "mlmetric:/",
+            "MAIL_SENT"     :   "mlsent:/"}
\ No newline at end of file
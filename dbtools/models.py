@@ -17,6 +17,8 @@ limitations under the License.
 '''
 Database models
 '''
+import array
+
 from google.appengine.api import datastore_types
 from google.appengine.ext import db
 
@@ -60,6 +62,28 @@ class JSONMap(db.Property):
         return db.Text(simplejson.dumps(value))
     data_type = datastore_types.Text
 
+class BitSet(db.Property):
+    """
+    A set of small non-negative integers stored as a bitmap. The value is an
+    array of bytes where bit i of the set is bit (i % 8) of byte (i / 8)
+    """
+    def get_value_for_datastore(self, model_instance):
+        value = super(BitSet, self).get_value_for_datastore(model_instance)
+        return self._deflate(value)
+    def validate(self, value):
+        return self._inflate(value)
+    def make_value_from_datastore(self, value):
+        return self._inflate(value)
+    def _inflate(self, value):
+        if value is None:
+            return array.array('B')
+        if isinstance(value, str):
+            return array.array('B', value)
+        return value
+    def _deflate(self, value):
+        return db.Blob(value.tostring())
+    data_type = datastore_types.Blob
+
 class Session(db.Model):
     """
     Model that is used to record the users access token + session data etc
@@ -81,9 +105,12 @@ class Settings(db.Model):
     Settings parent should always be set to a Session so read/writes can be
     transactionally safe
     """
-    read_blips = JSONList()
+    read_blips = JSONList()#Depricated in favour of read_bits. Migrated as the read state is written
+    read_bits = BitSet()#Indexed by the WaveMeta blip_index, starting from read_upto
+    read_upto = db.IntegerProperty(default=0)#Every blip indexed below this is read. A multiple of 8
     unseen_changes = db.BooleanProperty(default=False)#Default for migration. Users will get 1 rouge e-mail
     rw_permission = db.StringProperty(required=True, default=pt_raw.RW['READ_WRITE'])#Default for migration when we only had email users with rw permission
+    notification_version = db.IntegerProperty(default=0)#Incremented each time the user is sent a notification
 
 class FollowedWave(db.Model):
     """
@@ -99,4 +126,54 @@ class WaveMeta(db.Model):
     Parent should always be set to a FollowedWave so read/writes can be
     transactionally safe
     """
-    participant_profiles = JSONMap()
\ No newline at end of file
+    participant_profiles = JSONMap()
+    blip_index = JSONMap()#blip id to its bit in Settings.read_bits. Append only
+    blip_ids = JSONList()#The blip ids of blip_index in index order
+
+class Roster(db.Model):
+    """
+    Model that holds a summary of every user in a wave so the users to notify
+    can be found with a single get. Kept in step with each users Session and
+    Settings by writing it in the same cross group transaction
+    This is a root type and thus read/writes will not be transactionally safe
+    """
+    wave_id = db.StringProperty(required=True)
+    wavelet_id = db.StringProperty(required=True)
+    participants = JSONMap()#email to [session key, auth token, rw permission, unseen changes]
+
+class MigrationStatus(db.Model):
+    """
+    Model that records the progress of a bulk migration job. The key name is
+    the name of the job
+    This is a root type and thus read/writes will not be transactionally safe
+    """
+    kind = db.StringProperty(required=True)#The kind of entity being migrated
+    cursor = db.TextProperty()#Where the next batch starts
+    scanned = db.IntegerProperty(default=0)
+    migrated = db.IntegerProperty(default=0)
+    complete = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+class DigestEntry(db.Model):
+    """
+    Model that holds a notification waiting to be sent in a recipients next
+    digest e-mail. The key name is the wave and wavelet id so a wave only
+    appears once in each digest. Parent is a key for the recipient that has no
+    entity, so their entries can be fetched with an ancestor query
+    """
+    wave_id = db.StringProperty(required=True)
+    wavelet_id = db.StringProperty(required=True)
+    url = db.TextProperty(required=True)
+    title = db.TextProperty()
+    who_modified = db.StringProperty()
+    who_modified_display = db.StringProperty()
+    created = db.DateTimeProperty(auto_now=True)
+
+class SentMail(db.Model):
+    """
+    Model that records a message with an idempotency key has been claimed for
+    sending, so a retry doesn't send it again. The key name is a hash of the
+    idempotency key. This is a root type so each claim is its own transaction
+    """
+    created = db.DateTimeProperty(required=True)
@@ -0,0 +1,200 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Write behind buffer for read receipts. Rather than writing a users settings
+each time they read a blip, the blip is added to a per wave list of pending
+receipts in memcache. A deferred task flushes the list into the users
+settings once every READ_RECEIPT_FLUSH_SECS, so a user reading many blips
+costs at most one settings write per flush.
+
+Durability: a pending receipt only lives in memcache until it is flushed. If
+memcache evicts the list first, the blips read since the last flush show as
+unread again. Nothing else is lost. When the list can't be updated, the
+receipt is written straight to the datastore instead
+'''
+import base64
+import hashlib
+import logging
+import time
+
+import memcacheConfig
+import sessionTools
+import settingsTools
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+#Number of times to retry a contended update of the pending receipts
+_CAS_RETRIES = 5
+
+def record(session, blip_id):
+    '''
+    Records that a user has read a blip. The receipt is written to their
+    settings by the next flush
+    @param session: the users session
+    @param blip_id: the blip that was read
+    @return True if the receipt was buffered, False if it was written
+    straight to the datastore because the buffer couldn't be updated
+    '''
+    key = _generateKey(session.wave_id, session.wavelet_id)
+    client = memcache.Client()
+    for i in range(0, _CAS_RETRIES):
+        receipts = client.gets(key)
+        if receipts == None:
+            if client.add(key, {session.email: [blip_id]}, time=memcacheConfig.READ_RECEIPT_EXPIRE_SECS):
+                _scheduleFlush(session.wave_id, session.wavelet_id)
+                return True
+            continue
+        pending = receipts.setdefault(session.email, [])
+        if blip_id in pending:
+            return True
+        pending.append(blip_id)
+        if client.cas(key, receipts, time=memcacheConfig.READ_RECEIPT_EXPIRE_SECS):
+            _scheduleFlush(session.wave_id, session.wavelet_id)
+            return True
+    settingsTools.userReadsBlip(blip_id, session=session)
+    return False
+
+def getPending(wave_id, wavelet_id, email):
+    '''
+    @param wave_id: the wave id of the user
+    @param wavelet_id: the wavelet id of the user
+    @param email: the email of the user
+    @return a list of the blips the user has read that haven't been written
+    to their settings yet
+    '''
+    receipts = memcache.get(_generateKey(wave_id, wavelet_id)) or {}
+    return receipts.get(email, [])
+
+def discard(wave_id, wavelet_id, blip_id):
+    '''
+    Drops every pending receipt for a blip. Call this when the blip changes
+    and is marked unread, so a receipt for the old version isn't flushed over
+    the top of it
+    @param wave_id: the wave id of the blip
+    @param wavelet_id: the wavelet id of the blip
+    @param blip_id: the blip that changed
+    '''
+    key = _generateKey(wave_id, wavelet_id)
+    client = memcache.Client()
+    for i in range(0, _CAS_RETRIES):
+        receipts = client.gets(key)
+        if receipts == None:
+            return
+        modified = False
+        for pending in receipts.values():
+            if blip_id in pending:
+                pending.remove(blip_id)
+                modified = True
+        if not modified:
+            return
+        if client.cas(key, receipts, time=memcacheConfig.READ_RECEIPT_EXPIRE_SECS):
+            return
+    logging.warn("Could not discard read receipts for " + blip_id + " in " + wave_id + " " + wavelet_id)
+
+def flush(wave_id, wavelet_id):
+    '''
+    Writes the pending receipts of a wave to the users settings, one
+    transaction for each user. Receipts are only removed from the buffer once
+    they have been written so a failed flush is retried by the task queue
+    without losing any
+    @param wave_id: the wave id of the receipts
+    @param wavelet_id: the wavelet id of the receipts
+    '''
+    key = _generateKey(wave_id, wavelet_id)
+    receipts = memcache.get(key)
+    if not receipts:
+        return
+    for email, blip_ids in receipts.items():
+        if blip_ids:
+            settingsTools.update(   sessionTools.get(wave_id, wavelet_id, email),
+                                    read_blips=blip_ids)
+
+    client = memcache.Client()
+    for i in range(0, _CAS_RETRIES):
+        current = client.gets(key)
+        if current == None:
+            return
+        remaining = {}
+        for email, pending in current.items():
+            flushed = receipts.get(email, [])
+            pending = [blip_id for blip_id in pending if not blip_id in flushed]
+            if pending:
+                remaining[email] = pending
+        if client.cas(key, remaining, time=memcacheConfig.READ_RECEIPT_EXPIRE_SECS):
+            if remaining:
+                _scheduleFlush(wave_id, wavelet_id)
+            return
+    #They are already written so flushing them again does no harm
+    logging.warn("Could not remove flushed read receipts for " + wave_id + " " + wavelet_id)
+
+def _scheduleFlush(wave_id, wavelet_id):
+    '''
+    Makes sure a flush of the wave is queued for the end of the current
+    window. Only the first receipt of each window queues the task
+    @param wave_id: the wave id of the receipts
+    @param wavelet_id: the wavelet id of the receipts
+    '''
+    window = int(time.time() / memcacheConfig.READ_RECEIPT_FLUSH_SECS)
+    if not memcache.add(_generateScheduledKey(wave_id, wavelet_id, window),
+                        True,
+                        time=memcacheConfig.READ_RECEIPT_FLUSH_SECS * 2):
+        return
+    try:
+        _queueFlush(wave_id, wavelet_id, window)
+    except taskqueue.TombstonedTaskError:
+        #This windows flush has already run, by another instances clock
+        _queueFlush(wave_id, wavelet_id, window + 1)
+
+def _queueFlush(wave_id, wavelet_id, window):
+    '''
+    Queues the flush of a window, named so that it is only queued once
+    @param wave_id: the wave id of the receipts
+    @param wavelet_id: the wavelet id of the receipts
+    @param window: the number of the flush window
+    '''
+    name = "read-receipts-" + hashlib.md5((wave_id + wavelet_id).encode('utf-8')).hexdigest() + "-" + str(window)
+    eta = (window + 1) * memcacheConfig.READ_RECEIPT_FLUSH_SECS
+    try:
+        deferred.defer( flush,
+                        wave_id,
+                        wavelet_id,
+                        _name=name,
+                        _countdown=max(0, int(eta - time.time()) + 1))
+    except taskqueue.TaskAlreadyExistsError:
+        #Another instance queued it first
+        pass
+
+def _generateKey(wave_id, wavelet_id):
+    '''
+    @param wave_id: the id of the wave
+    @param wavelet_id: the id of the wavelet
+    @return the memcache key of the pending receipts for this wave
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['READ_RECEIPTS'] +
+                            wave_id + wavelet_id)
+
+def _generateScheduledKey(wave_id, wavelet_id, window):
+    '''
+    @param wave_id: the id of the wave
+    @param wavelet_id: the id of the wavelet
+    @param window: the number of the flush window
+    @return the memcache key marking that the windows flush is queued
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['READ_RECEIPTS_FLUSH'] +
+                            wave_id + wavelet_id + "|" + str(window))
@@ -0,0 +1,169 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Methods that read and change the blips a user has read. Each wave gives its
+blips a number in WaveMeta.blip_index and a user's read blips are stored as a
+bitmap of those numbers. Settings.read_upto is a watermark: every blip
+numbered below it is read, and Settings.read_bits only holds the bits from the
+watermark on. The watermark moves up over the leading bytes of the bitmap as
+they fill, so a user who keeps up with a wave stores a few bytes however many
+blips it has had. Settings written before this keep their blips in the
+read_blips list until they are migrated, so the read state is always the union
+of the list, the watermark and the bitmap
+'''
+import array
+
+def getReadBlips(settings, blip_ids):
+    '''
+    Lists the blips the user has read. The cost is in the bytes of the bitmap
+    and the blips that are read rather than every blip in the wave
+    @param settings: the users settings
+    @param blip_ids: the blip ids of the wave in index order, see
+    waveTools.getBlipIds
+    @return a list of the blip ids the user has read
+    '''
+    read_blips = blip_ids[:settings.read_upto]
+    bits = settings.read_bits
+    for byte in range(0, len(bits)):
+        if not bits[byte]:
+            continue
+        for bit in range(0, 8):
+            if bits[byte] & (1 << bit):
+                index = settings.read_upto + (byte << 3) + bit
+                if index < len(blip_ids):
+                    read_blips.append(blip_ids[index])
+    if settings.read_blips:
+        indexed = set(read_blips)
+        for blip_id in settings.read_blips:
+            if not blip_id in indexed:
+                read_blips.append(blip_id)
+    return read_blips
+
+def isRead(settings, blip_id, blip_index):
+    '''
+    @param settings: the users settings
+    @param blip_id: the blip to check
+    @param blip_index: the blip index of the wave
+    @return True if the user has read the blip
+    '''
+    index = blip_index.get(blip_id, None)
+    if not index == None and _isSet(settings, index):
+        return True
+    return blip_id in (settings.read_blips or [])
+
+def markRead(settings, blip_id, blip_index):
+    '''
+    Marks a blip read. If the blip has no index yet it is kept in the
+    read_blips list until it is given one
+    @param settings: the users settings
+    @param blip_id: the blip to mark read
+    @param blip_index: the blip index of the wave
+    @return True if the settings were changed
+    '''
+    index = blip_index.get(blip_id, None)
+    if index == None:
+        if blip_id in settings.read_blips:
+            return False
+        settings.read_blips.append(blip_id)
+        return True
+    if _isSet(settings, index):
+        return False
+    _set(settings, index, True)
+    return True
+
+def markUnread(settings, blip_id, blip_index):
+    '''
+    Marks a blip unread
+    @param settings: the users settings
+    @param blip_id: the blip to mark unread
+    @param blip_index: the blip index of the wave
+    @return True if the settings were changed
+    '''
+    modified = False
+    index = blip_index.get(blip_id, None)
+    if not index == None and _isSet(settings, index):
+        _set(settings, index, False)
+        modified = True
+    if settings.read_blips and blip_id in settings.read_blips:
+        settings.read_blips.remove(blip_id)
+        modified = True
+    return modified
+
+def migrate(settings, blip_index):
+    '''
+    Moves the blips in the read_blips list that have an index into read_bits
+    @param settings: the users settings
+    @param blip_index: the blip index of the wave
+    @return True if the settings were changed
+    '''
+    if not settings.read_blips:
+        return False
+    remaining = []
+    for blip_id in settings.read_blips:
+        index = blip_index.get(blip_id, None)
+        if index == None:
+            remaining.append(blip_id)
+        else:
+            _set(settings, index, True)
+    if len(remaining) == len(settings.read_blips):
+        return False
+    settings.read_blips = remaining
+    return True
+
+def _isSet(settings, index):
+    '''
+    @param settings: the users settings
+    @param index: the bit to test
+    @return True if the bit is set
+    '''
+    if index < settings.read_upto:
+        return True
+    byte = (index - settings.read_upto) >> 3
+    return byte < len(settings.read_bits) and bool(settings.read_bits[byte] & (1 << (index & 7)))
+
+def _set(settings, index, value):
+    '''
+    Sets or clears a bit, growing the bitmap if needed. Full bytes at the
+    start of the bitmap are folded into the watermark, and clearing a bit
+    below the watermark moves it back down
+    @param settings: the users settings
+    @param index: the bit to change
+    @param value: True to set the bit, False to clear it
+    '''
+    bits = settings.read_bits
+    if index < settings.read_upto:
+        if value:
+            return
+        #The watermark is always a whole number of bytes
+        read_upto = (index >> 3) << 3
+        bits[0:0] = array.array('B', [0xff] * ((settings.read_upto - read_upto) >> 3))
+        settings.read_upto = read_upto
+    byte = (index - settings.read_upto) >> 3
+    if byte >= len(bits):
+        if not value:
+            return
+        bits.extend([0] * (byte + 1 - len(bits)))
+    if value:
+        bits[byte] |= 1 << (index & 7)
+        full = 0
+        while full < len(bits) and bits[full] == 0xff:
+            full += 1
+        if full:
+            del bits[0:full]
+            settings.read_upto += full << 3
+    else:
+        bits[byte] &= ~(1 << (index & 7)) & 0xff
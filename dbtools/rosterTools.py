@@ -0,0 +1,277 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Methods to make using Roster models easier. A roster holds the email, session
+key, auth token, rw permission, unseen changes flag and notification version
+of every user in a wave. Writes to a users Session or Settings that change any of these update
+the roster in the same cross group transaction, except for fan-outs to many
+users which update it once in a transaction of its own straight after. Waves
+from before rosters existed have theirs built the first time it is asked for
+'''
+import base64
+
+import cacheTools
+import dbConfig
+import memcacheConfig
+from models import Roster
+import sessionTools
+import settingsTools
+
+from google.appengine.ext import db
+
+#Positions of the values in each roster entry
+_SESSION_KEY = 0
+_AUTH_TOKEN = 1
+_RW_PERMISSION = 2
+_UNSEEN_CHANGES = 3
+_NOTIFICATION_VERSION = 4
+
+def generateKey(wave_id, wavelet_id):
+    '''
+    Generates a key name for a roster
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @return the key name that can be used for this roster
+    '''
+    return dbConfig.KEY_PREFIX["ROSTER"] + wave_id + "|" + wavelet_id
+
+def getParticipants(wave_id, wavelet_id, local=True):
+    '''
+    Fetches a summary of every user in the wave, building the roster if the
+    wave doesn't have one yet
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @param local=True: set to False to skip the local cache
+    @return a list of Participant, one for each user with settings
+    '''
+    roster = get(wave_id, wavelet_id, local)
+    return [Participant(wave_id, wavelet_id, email, entry)
+                for email, entry in roster.participants.items()]
+
+def get(wave_id, wavelet_id, local=True):
+    '''
+    Uses the local cache, memcache or the datastore to fetch the roster of a
+    wave, building it if the wave doesn't have one yet
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @param local=True: set to False if the roster is going to be changed
+    @return the roster
+    '''
+    key = _generateMemcacheKey(wave_id, wavelet_id)
+    roster = cacheTools.get(key, wave_id + wavelet_id, local)
+    if roster is cacheTools.MISS:
+        roster = Roster.get_by_key_name(generateKey(wave_id, wavelet_id))
+        if roster == None:
+            roster = _build(wave_id, wavelet_id)
+        cacheTools.add(key, roster, wave_id + wavelet_id, local)
+    return roster
+
+def updateEntry(session, settings):
+    '''
+    Copies the values the roster holds for a user out of their session and
+    settings. Call this in the transaction that writes them. Waves without a
+    roster are left alone as it will be built from the new values
+    @transaction_safe
+    @param session: the users session
+    @param settings: the users settings
+    '''
+    roster = db.get(_generateDbKey(session.wave_id, session.wavelet_id))
+    if roster and _setEntry(roster, session, settings):
+        put(roster)
+
+def update_multi(wave_id, wavelet_id, all_sessions, all_settings, all_changes):
+    '''
+    Copies the values the roster holds for many users out of their settings
+    in a single transaction on the roster. Call this after the settings have
+    been written, so the roster is written once rather than once for each
+    user. Only the values named in each users change are copied, so a newer
+    value written by another request isn't put back. Waves without a roster
+    are left alone as it will be built from the new values
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @param all_sessions: the list of sessions, or participants, of the users
+    @param all_settings: the list of settings in the same order as the sessions
+    @param all_changes: a list of dicts in the same order as the sessions
+    naming the values that changed, as passed to settingsTools.update_multi
+    '''
+    def worker(wave_id, wavelet_id):
+        '''
+        @transaction_safe
+        '''
+        roster = db.get(_generateDbKey(wave_id, wavelet_id))
+        if roster == None:
+            return False
+        modified = False
+        for session, settings, change in zip(all_sessions, all_settings, all_changes):
+            if _mergeEntry(roster, session, settings, change):
+                modified = True
+        if modified:
+            roster.put()
+        return modified
+
+    if db.run_in_transaction(worker, wave_id, wavelet_id):
+        invalidate(wave_id, wavelet_id)
+
+def put(roster):
+    '''
+    Saves the roster to the datastore and removes it from memcache
+    @transaction_safe
+    @param roster: the roster to save
+    '''
+    roster.put()
+    invalidate(roster.wave_id, roster.wavelet_id)
+
+def delete(wave_id, wavelet_id):
+    '''
+    Removes the roster of a wave so it is built again the next time it is
+    asked for. Use this after changing sessions without updating the roster
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    '''
+    db.delete(_generateDbKey(wave_id, wavelet_id))
+    invalidate(wave_id, wavelet_id)
+
+def invalidate(wave_id, wavelet_id):
+    '''
+    Removes the roster from memcache
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    '''
+    cacheTools.delete(_generateMemcacheKey(wave_id, wavelet_id), wave_id + wavelet_id)
+
+class Participant(object):
+    '''
+    A user as held in the roster. Stands in for the users Session wherever
+    only its identity is needed, such as settingsTools.get_multi
+    '''
+    def __init__(self, wave_id, wavelet_id, email, entry):
+        '''
+        @param wave_id: the wave id of the user
+        @param wavelet_id: the wavelet id of the user
+        @param email: the email of the user
+        @param entry: the users entry in the roster
+        '''
+        self.wave_id = wave_id
+        self.wavelet_id = wavelet_id
+        self.email = email
+        self.auth_token = entry[_AUTH_TOKEN]
+        self.rw_permission = entry[_RW_PERMISSION]
+        self.unseen_changes = entry[_UNSEEN_CHANGES]
+        #Entries from before notification versions are rewritten on their next change
+        self.notification_version = 0
+        if len(entry) > _NOTIFICATION_VERSION:
+            self.notification_version = entry[_NOTIFICATION_VERSION]
+        self._session_key = entry[_SESSION_KEY]
+
+    def key(self):
+        '''
+        @return the datastore key of the users session
+        '''
+        return db.Key(self._session_key)
+
+def _build(wave_id, wavelet_id):
+    '''
+    Builds the roster of a wave from its sessions and settings. The roster is
+    only saved if another request hasn't saved one in the meantime. A change
+    to a users settings made while the roster is being built isn't seen until
+    that users next change
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @return the roster
+    '''
+    roster = Roster(wave_id     =   wave_id,
+                    wavelet_id  =   wavelet_id,
+                    key_name    =   generateKey(wave_id, wavelet_id))
+    for sessions in sessionTools.iter_session_chunks(wave_id, wavelet_id):
+        for session, settings in zip(sessions, settingsTools.get_multi(sessions)):
+            _setEntry(roster, session, settings)
+
+    def worker(roster):
+        '''
+        @transaction_safe
+        '''
+        existing = db.get(roster.key())
+        if existing:
+            return existing
+        put(roster)
+        return roster
+
+    return db.run_in_transaction(worker, roster)
+
+def _setEntry(roster, session, settings):
+    '''
+    Changes the roster object in memory
+    @param roster: the roster to change
+    @param session: the users session
+    @param settings: the users settings or None to leave the user out
+    @return True if the roster was changed and needs to be saved
+    '''
+    participants = roster.participants
+    if settings == None:
+        return False
+    entry = [   str(session.key()),
+                session.auth_token,
+                settings.rw_permission,
+                settings.unseen_changes,
+                settings.notification_version]
+    if participants.get(session.email, None) == entry:
+        return False
+    participants[session.email] = entry
+    roster.participants = participants
+    return True
+
+def _mergeEntry(roster, session, settings, change):
+    '''
+    Changes only the values named in a change in the roster object in memory.
+    Users without a full entry are given one
+    @param roster: the roster to change
+    @param session: the users session
+    @param settings: the users settings
+    @param change: a dict naming the values that changed
+    @return True if the roster was changed and needs to be saved
+    '''
+    participants = roster.participants
+    entry = participants.get(session.email, None)
+    if entry == None or len(entry) <= _NOTIFICATION_VERSION:
+        return _setEntry(roster, session, settings)
+    merged = list(entry)
+    for name, position in [ ('rw_permission', _RW_PERMISSION),
+                            ('unseen_changes', _UNSEEN_CHANGES),
+                            ('notification_version', _NOTIFICATION_VERSION)]:
+        if not change.get(name, None) == None:
+            merged[position] = getattr(settings, name)
+    if merged == entry:
+        return False
+    participants[session.email] = merged
+    roster.participants = participants
+    return True
+
+def _generateDbKey(wave_id, wavelet_id):
+    '''
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @return the datastore key of the roster
+    '''
+    return db.Key.from_path('Roster', generateKey(wave_id, wavelet_id))
+
+def _generateMemcacheKey(wave_id, wavelet_id):
+    '''
+    @param wave_id: the wave id of the roster
+    @param wavelet_id: the wavelet id of the roster
+    @return the memcache key of the roster
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['ROSTER'] + wave_id + wavelet_id)
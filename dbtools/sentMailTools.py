@@ -0,0 +1,91 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Methods to make using SentMail models easier. A SentMail records that the
+message with an idempotency key has been claimed for sending. The datastore
+record decides whether a message is sent, memcache only saves the
+transaction for messages that are already known to have gone out
+'''
+import base64
+import datetime
+import hashlib
+
+import config
+import memcacheConfig
+from models import SentMail
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+def claim(idempotency_key):
+    '''
+    Claims the right to send a message. Only one claim on a key succeeds
+    until it is released or MAIL_DEDUP_EXPIRE_SECS have passed
+    @param idempotency_key: the idempotency key of the message
+    @return True if the message should be sent, False if it has already been
+    claimed
+    '''
+    key_name = _generateKeyName(idempotency_key)
+    if memcache.get(_generateMemcacheKey(key_name)):
+        return False
+
+    def worker(key_name):
+        '''
+        @transaction_safe
+        '''
+        now = datetime.datetime.now()
+        sent = SentMail.get_by_key_name(key_name)
+        if sent and now - sent.created < datetime.timedelta(seconds=config.MAIL_DEDUP_EXPIRE_SECS):
+            return False
+        SentMail(key_name=key_name, created=now).put()
+        return True
+
+    return db.run_in_transaction(worker, key_name)
+
+def markSent(idempotency_key):
+    '''
+    Remembers in memcache that a claimed message has been sent, so a retry
+    is dropped without a transaction
+    @param idempotency_key: the idempotency key of the message
+    '''
+    memcache.set(   _generateMemcacheKey(_generateKeyName(idempotency_key)),
+                    True,
+                    time=config.MAIL_DEDUP_EXPIRE_SECS)
+
+def release(idempotency_key):
+    '''
+    Releases the claim on a message that couldn't be sent so a retry can
+    send it
+    @param idempotency_key: the idempotency key of the message
+    '''
+    key_name = _generateKeyName(idempotency_key)
+    db.delete(db.Key.from_path('SentMail', key_name))
+    memcache.delete(_generateMemcacheKey(key_name))
+
+def _generateKeyName(idempotency_key):
+    '''
+    @param idempotency_key: the idempotency key of the message
+    @return the key name of the messages SentMail
+    '''
+    return hashlib.md5(idempotency_key.encode('utf-8')).hexdigest()
+
+def _generateMemcacheKey(key_name):
+    '''
+    @param key_name: the key name of the messages SentMail
+    @return the memcache key of the messages SentMail
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['MAIL_SENT'] + key_name)
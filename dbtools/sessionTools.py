@@ -19,7 +19,9 @@ Methods to make using Session models easier
 '''
 import base64
 
+import cacheTools
 import config
+import dbConfig
 import dbmigration
 import memcacheConfig
 from models import Session
@@ -30,69 +32,185 @@ from google.appengine.api import memcache
 
 def fetch(wave_id, wavelet_id):
     '''
-    Uses memcache or the datastore to get fetch sessions by wave_id and
-    wavelet_id
+    Fetches every session in a wave as a list. This holds all of them in
+    memory at once so prefer iter_sessions or iter_session_chunks
     @param wave_id: the id of the session to fetch
     @param wavelet_id: the if of the session to fetch
     
-    @return the sessions using the most efficient means possible or None if it
-    couldn't be found
+    @return a list of the sessions in the wave
     '''
-    key = base64.b64encode( memcacheConfig.PREFIX['SESSION'] + 
+    return list(iter_sessions(wave_id, wavelet_id))
+
+def iter_sessions(wave_id, wavelet_id):
+    '''
+    Generates every session in a wave, one at a time. See iter_session_chunks
+    @param wave_id: the id of the sessions to fetch
+    @param wavelet_id: the id of the sessions to fetch
+    '''
+    for sessions in iter_session_chunks(wave_id, wavelet_id):
+        for session in sessions:
+            yield session
+
+def iter_session_chunks(wave_id, wavelet_id):
+    '''
+    Generates the sessions in a wave as lists of at most
+    dbConfig.SESSION_CHUNK_SIZE sessions. Each list is fetched from memcache
+    or with a query that carries on from the cursor of the last one, so waves
+    of any size can be walked without holding them all at once. Chunks are
+    cached under the waves session generation, which changes whenever a
+    session in the wave is written
+    @param wave_id: the id of the sessions to fetch
+    @param wavelet_id: the id of the sessions to fetch
+    '''
+    generation = _getSessionGeneration(wave_id, wavelet_id)
+    cursor = None
+    chunk = 0
+    while True:
+        cached = None
+        if not generation == None:
+            key = _generateChunkKey(wave_id, wavelet_id, generation, chunk)
+            cached = memcache.get(key)
+        if not cached == None:
+            sessions, next_cursor = cached
+        else:
+            query = Session.all()
+            query.filter("wave_id =", wave_id)
+            query.filter("wavelet_id =", wavelet_id)
+            if not cursor == None:
+                query.with_cursor(cursor)
+            sessions = query.fetch(dbConfig.SESSION_CHUNK_SIZE)
+            next_cursor = None
+            if len(sessions) == dbConfig.SESSION_CHUNK_SIZE:
+                next_cursor = query.cursor()
+            if not generation == None:
+                memcache.add(key, (sessions, next_cursor), time=memcacheConfig.DEFAULT_EXPIRE_SECS)
+        _migrate(sessions)
+        if sessions:
+            yield sessions
+        if next_cursor == None:
+            return
+        cursor = next_cursor
+        chunk += 1
+
+def _getSessionGeneration(wave_id, wavelet_id):
+    '''
+    @param wave_id: the wave id of the sessions
+    @param wavelet_id: the wavelet id of the sessions
+    @return the current session generation of the wave or None if memcache
+    is unavailable
+    '''
+    key = _generateGenerationKey(wave_id, wavelet_id)
+    generation = memcache.get(key)
+    if generation == None:
+        #Never written. Start it so everyone agrees on its value
+        memcache.add(key, 0)
+        generation = memcache.get(key)
+    return generation
+
+def _generateGenerationKey(wave_id, wavelet_id):
+    '''
+    @param wave_id: the wave id of the sessions
+    @param wavelet_id: the wavelet id of the sessions
+    @return the memcache key of the waves session generation counter
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['SESSION_GENERATION'] +
                             wave_id + wavelet_id)
-    sessions = memcache.get(key)
-    if not sessions == None:
-        dbmigration.migratev1tov2(sessions)
-        return sessions
-    else:
-        query = Session.all()
-        query.filter("wave_id =", wave_id)
-        query.filter("wavelet_id =", wavelet_id)
-        sessions = query.fetch(100)
-        dbmigration.migratev1tov2(sessions)
-        memcache.add(key, sessions, time=memcacheConfig.DEFAULT_EXPIRE_SECS)
-        return sessions
 
-def get(wave_id, wavelet_id, email):
+def _generateChunkKey(wave_id, wavelet_id, generation, chunk):
+    '''
+    @param wave_id: the wave id of the sessions
+    @param wavelet_id: the wavelet id of the sessions
+    @param generation: the session generation of the wave
+    @param chunk: the number of the chunk
+    @return the memcache key of the chunk
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['SESSION_CHUNK'] +
+                            wave_id + wavelet_id + "|" +
+                            str(generation) + "|" + str(chunk))
+
+def generateKey(wave_id, wavelet_id, email):
+    '''
+    Generates a key name for a session
+    @param wave_id: the wave id of the session
+    @param wavelet_id: the wavelet id of the session
+    @param email: the email of the session
+    @return the key name that can be used for this session
+    '''
+    return dbConfig.KEY_PREFIX["SESSION"] + wave_id + "|" + wavelet_id + "|" + email
+
+def get(wave_id, wavelet_id, email, local=True):
     '''
-    Uses memcache or the datastore to fetch a single session by wave_id,
-    wavelet_id and email
+    Uses the local cache, memcache or the datastore to fetch a single session
+    by wave_id, wavelet_id and email
     @param wave_id: the id of the session to fetch
     @param wavelet_id: the id of the session to fetch
     @param email: the email of the session to fetch
+    @param local=True: set to False if the session is going to be changed.
+    Sessions from the local cache are shared with other requests
     
     @return the session using the most efficient means possible or None if it
     couldn't be found
     '''
     key = base64.b64encode( memcacheConfig.PREFIX['SESSION'] + 
                             wave_id + wavelet_id + email)
-    session = memcache.get(key)
-    if not session == None:
-        dbmigration.migratev1tov2([session])
+    session = cacheTools.get(key, wave_id + wavelet_id, local)
+    if not session is cacheTools.MISS:
+        _migrate([session])
         return session
     else:
-        query = Session.all()
-        query.filter("wave_id =", wave_id)
-        query.filter("wavelet_id =", wavelet_id)
-        query.filter("email =", email)
-        session = query.get()
-        dbmigration.migratev1tov2([session])
-        memcache.add(key, session, time=memcacheConfig.DEFAULT_EXPIRE_SECS)
+        session = Session.get_by_key_name(generateKey(wave_id, wavelet_id, email))
+        #Sessions created before they had key names can only be found with a
+        #query until the job giving them key names has finished
+        if session == None and not dbmigration.isComplete(dbmigration.SESSION_KEYS):
+            session = _getLegacy(wave_id, wavelet_id, email)
+        _migrate([session])
+        cacheTools.add(key, session, wave_id + wavelet_id, local)
         return session
 
+def _migrate(sessions):
+    '''
+    Migrates any of the sessions that are still on version 1. Skipped once the
+    bulk migration job has finished
+    @param sessions: the sessions that have just been read
+    '''
+    if not dbmigration.isComplete(dbmigration.V1_TO_V2):
+        dbmigration.migratev1tov2(sessions)
+
+def _getLegacy(wave_id, wavelet_id, email):
+    '''
+    Queries for a session that was created before sessions had key names
+    @param wave_id: the id of the session to fetch
+    @param wavelet_id: the id of the session to fetch
+    @param email: the email of the session to fetch
+    @return the session or None if it couldn't be found
+    '''
+    query = Session.all()
+    query.filter("wave_id =", wave_id)
+    query.filter("wavelet_id =", wavelet_id)
+    query.filter("email =", email)
+    return query.get()
+
 def put(session):
     '''
     Saves the session to the datastore and removes it from memcache
     @param session: the session to save
     '''
     session.put()
-    memcache.delete(base64.b64encode(   memcacheConfig.PREFIX['SESSION'] +
-                                        session.wave_id +
-                                        session.wavelet_id))
-    memcache.delete(base64.b64encode(   memcacheConfig.PREFIX['SESSION'] +
-                                        session.wave_id + 
-                                        session.wavelet_id +
-                                        session.email))
+    invalidate(session)
+
+def invalidate(session):
+    '''
+    Removes the session from memcache and moves the wave on to a new session
+    generation so its cached chunks are no longer used
+    @param session: the session that has changed
+    '''
+    cacheTools.delete(  base64.b64encode(   memcacheConfig.PREFIX['SESSION'] +
+                                            session.wave_id + 
+                                            session.wavelet_id +
+                                            session.email),
+                        session.wave_id + session.wavelet_id)
+    memcache.incr(  _generateGenerationKey(session.wave_id, session.wavelet_id),
+                    initial_value=0)
 
 def isPublic(session):
     '''
@@ -19,12 +19,15 @@ Methods to make using Settings models easier
 '''
 import base64
 
+import cacheTools
 import dbConfig
 import memcacheConfig
 from models import Settings
+import readState
+import rosterTools
 import sessionTools
+import waveTools
 
-from google.appengine.api import memcache
 from google.appengine.ext import db
 
 def generateKey(wave_id, wavelet_id, email):
@@ -37,33 +40,62 @@ def generateKey(wave_id, wavelet_id, email):
     '''
     return dbConfig.KEY_PREFIX["SETTINGS"] + wave_id + "|" + wavelet_id + "|" + email
 
-def get(session):
+def get(session, local=True):
     '''
-    Uses memcache or the datastore to fetch a single setting by wave_id,
+    Uses the local cache, memcache or the datastore to fetch a single setting by wave_id,
     wavelet_id and email. Ideally this should fetch session only if needed but
     this wouldn't work with the appengine transaction framework.
     @transaction_safe
     @param session: the parent session object
+    @param local=True: set to False if the setting is going to be changed.
+    Settings from the local cache are shared with other requests
 
     @return the setting using the most efficient means possible or None if it
     couldn't be found
     '''
     if not session:
         return None
-    key = base64.b64encode( memcacheConfig.PREFIX['SETTINGS'] + 
-                            session.wave_id + 
-                            session.wavelet_id +
-                            session.email)
-    setting = memcache.get(key)
-    if not setting == None:
+    key = _generateMemcacheKey(session)
+    setting = cacheTools.get(key, _generateGroup(session), local)
+    if not setting is cacheTools.MISS:
         return setting
     else:
-        query = Settings.all()
-        query.ancestor(session)
-        setting = query.get()
-        memcache.add(key, setting, time=memcacheConfig.DEFAULT_EXPIRE_SECS)
+        setting = db.get(_generateDbKey(session))
+        cacheTools.add(key, setting, _generateGroup(session), local)
         return setting
 
+def get_multi(sessions, local=True):
+    '''
+    Fetches the settings for many sessions at once. Uses a single memcache
+    call for the cached settings and a single datastore get for the rest
+    rather than a lookup for each session
+    @param sessions: the list of parent session objects. All from one wave
+    @param local=True: set to False if the settings are going to be changed
+
+    @return a list of the settings in the same order as sessions. Any settings
+    that couldn't be found are None
+    '''
+    if not sessions:
+        return []
+    group = _generateGroup(sessions[0])
+    keys = [_generateMemcacheKey(session) for session in sessions]
+    cached = cacheTools.get_multi(keys, group, local)
+
+    missing = []
+    for i in range(0, len(sessions)):
+        if not cached.has_key(keys[i]):
+            missing.append(i)
+
+    if missing:
+        db_keys = [_generateDbKey(sessions[i]) for i in missing]
+        fetched = {}
+        for i, setting in zip(missing, db.get(db_keys)):
+            cached[keys[i]] = setting
+            fetched[keys[i]] = setting
+        cacheTools.add_multi(fetched, group, local)
+
+    return [cached.get(key, None) for key in keys]
+
 def put(setting, wave_id, wavelet_id, email):
     '''
     Saves the setting to the datastore and removes it from memcache
@@ -74,10 +106,20 @@ def put(setting, wave_id, wavelet_id, email):
     @param email: the email of the settings parent
     '''
     setting.put()
-    memcache.delete(base64.b64encode(   memcacheConfig.PREFIX['SETTINGS'] +
+    invalidate(wave_id, wavelet_id, email)
+
+def invalidate(wave_id, wavelet_id, email):
+    '''
+    Removes the setting from memcache
+    @param wave_id: the wave id of the settings parent
+    @param wavelet_id: the wavelet id of the settings parent
+    @param email: the email of the settings parent
+    '''
+    cacheTools.delete(base64.b64encode( memcacheConfig.PREFIX['SETTINGS'] +
                                         wave_id + 
                                         wavelet_id +
-                                        email))
+                                        email),
+                        wave_id + wavelet_id)
 
 def markSeenChanges(key=None, session=None):
     '''
@@ -86,21 +128,9 @@ def markSeenChanges(key=None, session=None):
     the value
     @param key=None: a dict containing wave_id, wavelet_id and email
     @param session=None: the parent session object
+    @return the updated settings or None if they couldn't be found
     '''
-    if not key == None:
-        _updateUnseenChanges(   key['wave_id'],
-                                key['wavelet_id'],
-                                key['email'],
-                                False,
-                                None)
-    elif not session == None:
-        _updateUnseenChanges(   session.wave_id,
-                                session.wavelet_id,
-                                session.email,
-                                False,
-                                session)
-    
-    
+    return update(_resolveSession(key, session), unseen_changes=False)
 
 def markUnseenChanges(key=None, session=None):
     '''
@@ -109,43 +139,9 @@ def markUnseenChanges(key=None, session=None):
     already have the value
     @param key=None: a dict containing wave_id, wavelet_id and email
     @param session=None: the parent session object
+    @return the updated settings or None if they couldn't be found
     '''
-    if not key == None:
-        _updateUnseenChanges(   key['wave_id'],
-                                key['wavelet_id'],
-                                key['email'],
-                                True,
-                                None)
-    elif not session == None:
-        _updateUnseenChanges(   session.wave_id,
-                                session.wavelet_id,
-                                session.email,
-                                True,
-                                session)
-    
-
-def _updateUnseenChanges(wave_id, wavelet_id, email, value, session):
-    '''
-    Changes the value of unseen_changes in a nice transaction safe way
-    @param wave_id: the wave id of the session to modify
-    @param wavelet_id: the wavelet id of the session to modify
-    @param email: the email of the session to modify
-    @param value: the new value for unseen_changes
-    @param session: if provided uses given session, if None fetches from db
-    '''
-    if session == None:
-        session = sessionTools.get(wave_id, wavelet_id, email)
-
-    def worker(session, wave_id, wavelet_id, email, value):
-        '''
-        @transaction_safe
-        '''
-        settings = get(session)
-        if settings:
-            settings.unseen_changes = value
-            put(settings, wave_id, wavelet_id, email)
-
-    db.run_in_transaction(worker, session, wave_id, wavelet_id, email, value)
+    return update(_resolveSession(key, session), unseen_changes=True)
 
 def userReadsBlip(blip_id, key=None, session=None):
     '''
@@ -155,21 +151,9 @@ def userReadsBlip(blip_id, key=None, session=None):
     @param key=None: a dict containing wave_id, wavelet_id and email
     @param session=None: the parent session object
     @param blip_id: the blip that is to be marked read
+    @return the updated settings or None if they couldn't be found
     '''
-    if session == None:
-        session = sessionTools.get(key['wave_id'], key['wavelet_id'], key['email'])     
-
-    def worker(session, blip_id):
-        '''
-        @transaction_safe
-        '''
-        settings = get(session)
-        if settings:
-            if not blip_id in settings.read_blips:
-                settings.read_blips.append(blip_id)
-                put(settings, session.wave_id, session.wavelet_id, session.email)
-
-    db.run_in_transaction(worker, session, blip_id)
+    return update(_resolveSession(key, session), read_blip=blip_id)
 
 def blipChanges(blip_id, key=None, session=None):
     '''
@@ -179,23 +163,11 @@ def blipChanges(blip_id, key=None, session=None):
     @param key=None: a dict containing wave_id, wavelet_id and email
     @param session=None: the parent session object
     @param blip_id: the blip that is to be marked read
+    @return the updated settings or None if they couldn't be found
     '''
     if blip_id == None:
-        return
-    if session == None:
-        session = sessionTools.get(key['wave_id'], key['wavelet_id'], key['email'])     
-
-    def worker(session, blip_id):
-        '''
-        @transaction_safe
-        '''
-        settings = get(session)
-        if settings:
-            if blip_id in settings.read_blips:
-                settings.read_blips.remove(blip_id)
-                put(settings, session.wave_id, session.wavelet_id, session.email)
-
-    db.run_in_transaction(worker, session, blip_id)
+        return None
+    return update(_resolveSession(key, session), unread_blip=blip_id)
 
 def changeRWPermission(new_permission, key=None, session=None):
     '''
@@ -205,17 +177,282 @@ def changeRWPermission(new_permission, key=None, session=None):
     @param key=None: a dict containing wave_id, wavelet_id and email
     @param session=None: the parent session object
     @param new_permission: the raw permission type to give this session
+    @return the updated settings or None if they couldn't be found
+    '''
+    return update(_resolveSession(key, session), rw_permission=new_permission)
+
+def update(session, unseen_changes=None, read_blip=None, unread_blip=None, rw_permission=None, read_blips=None, notification_version=None):
+    '''
+    Applies several changes to a users settings in a single transaction. Only
+    the changes that are supplied are made and the settings are only written
+    if something changed. Changes to unseen_changes, rw_permission or
+    notification_version are copied to the waves roster in the same cross
+    group transaction
+    @param session: the parent session object
+    @param unseen_changes=None: the new value for unseen_changes
+    @param read_blip=None: a blip id to mark read
+    @param unread_blip=None: a blip id to mark unread
+    @param rw_permission=None: the raw permission type to give this session
+    @param read_blips=None: a list of blip ids to mark read
+    @param notification_version=None: the version of the last notification
+    sent to the user
+    @return the updated settings or None if they couldn't be found
     '''
     if session == None:
+        return None
+    read_blips = _listReadBlips(read_blip, read_blips)
+    #Blip indexes live in another entity group so are assigned beforehand
+    blip_index = _getBlipIndex([session], [get(session)], [read_blips], [unread_blip])
+    settings, modified = db.run_in_transaction_options( db.create_transaction_options(xg=True),
+                                                        _updateWorker,
+                                                        session,
+                                                        blip_index,
+                                                        unseen_changes,
+                                                        read_blips,
+                                                        unread_blip,
+                                                        rw_permission,
+                                                        notification_version)
+    #Only once committed, so a reader can't cache the old settings again
+    if modified:
+        invalidate(session.wave_id, session.wavelet_id, session.email)
+    return settings
+
+def update_multi(sessions, changes, all_settings=None):
+    '''
+    Applies changes to the settings of many users, such as when fanning out a
+    change to a waves users. The blip index is assigned once for all of them.
+    The settings are read again and written back with one put in cross group
+    transactions of up to dbConfig.XG_TRANSACTION_GROUPS users, so a change
+    made to them by another request in the meantime is never overwritten.
+    The waves roster is then updated for all of them in a single transaction
+    and the cache is cleared with one call
+    @param sessions: the list of parent session objects, or roster
+    participants. All from one wave
+    @param changes: a list of dicts in the same order as sessions. Each dict
+    contains any of the keyword arguments accepted by update
+    @param all_settings=None: the settings of the sessions if they have already
+    been fetched with get_multi(sessions). Only used to decide which blips
+    need an index, they are read again in the transactions
+    @return a list of the updated settings in the same order as sessions. Any
+    settings that couldn't be found are None
+    '''
+    if not sessions:
+        return []
+    if all_settings == None:
+        all_settings = get_multi(sessions)
+    all_read_blips = [_listReadBlips(change.get('read_blip', None), change.get('read_blips', None))
+                        for change in changes]
+    blip_index = _getBlipIndex( sessions,
+                                all_settings,
+                                all_read_blips,
+                                [change.get('unread_blip', None) for change in changes])
+
+    options = db.create_transaction_options(xg=True)
+    updated = []
+    modified = []
+    for i in range(0, len(sessions), dbConfig.XG_TRANSACTION_GROUPS):
+        chunk_settings, chunk_modified = db.run_in_transaction_options( options,
+                                                                        _updateMultiWorker,
+                                                                        sessions[i:i + dbConfig.XG_TRANSACTION_GROUPS],
+                                                                        changes[i:i + dbConfig.XG_TRANSACTION_GROUPS],
+                                                                        all_read_blips[i:i + dbConfig.XG_TRANSACTION_GROUPS],
+                                                                        blip_index)
+        updated.extend(chunk_settings)
+        modified.extend(chunk_modified)
+
+    roster_sessions = []
+    roster_settings = []
+    roster_changes = []
+    memcache_keys = []
+    for session, settings, change, was_modified in zip(sessions, updated, changes, modified):
+        if not was_modified:
+            continue
+        memcache_keys.append(_generateMemcacheKey(session))
+        if _changesRoster(change):
+            roster_sessions.append(session)
+            roster_settings.append(settings)
+            roster_changes.append(change)
+    if roster_sessions:
+        rosterTools.update_multi(   sessions[0].wave_id,
+                                    sessions[0].wavelet_id,
+                                    roster_sessions,
+                                    roster_settings,
+                                    roster_changes)
+    if memcache_keys:
+        cacheTools.delete_multi(memcache_keys, _generateGroup(sessions[0]))
+    return updated
+
+def _updateWorker(session, blip_index, unseen_changes, read_blips, unread_blip, rw_permission, notification_version):
+    '''
+    Reads a users settings from the datastore, changes them and writes them
+    back. Changes to unseen_changes, rw_permission or notification_version
+    are copied to the waves roster. Run it in a cross group transaction and
+    invalidate the cached settings once it has committed
+    @transaction_safe
+    @param session: the parent session object
+    @param blip_index: the blip index of the wave or None
+    @param unseen_changes: the new value for unseen_changes or None
+    @param read_blips: a list of blip ids to mark read
+    @param unread_blip: a blip id to mark unread or None
+    @param rw_permission: the raw permission type or None
+    @param notification_version: the new notification version or None
+    @return a tuple of the updated settings, or None if they couldn't be
+    found, and True if they were written
+    '''
+    settings = db.get(_generateDbKey(session))
+    if settings and _applyChanges(settings, blip_index, unseen_changes, read_blips, unread_blip, rw_permission, notification_version):
+        settings.put()
+        if not unseen_changes == None or not rw_permission == None or not notification_version == None:
+            rosterTools.updateEntry(session, settings)
+        return (settings, True)
+    return (settings, False)
+
+def _updateMultiWorker(sessions, changes, all_read_blips, blip_index):
+    '''
+    Reads the settings of several users from the datastore, changes them and
+    writes the changed ones back in a single put. Run it in a cross group
+    transaction and invalidate the cached settings once it has committed
+    @transaction_safe
+    @param sessions: the list of parent session objects
+    @param changes: a list of dicts of the changes for each session
+    @param all_read_blips: a list of the blip ids to mark read for each
+    session
+    @param blip_index: the blip index of the wave or None
+    @return a tuple of the list of updated settings, None for any that
+    couldn't be found, and a list of True or False for whether each was
+    written
+    '''
+    all_settings = db.get([_generateDbKey(session) for session in sessions])
+    modified = []
+    to_put = []
+    for settings, change, read_blips in zip(all_settings, changes, all_read_blips):
+        if settings and _applyChanges(  settings,
+                                        blip_index,
+                                        change.get('unseen_changes', None),
+                                        read_blips,
+                                        change.get('unread_blip', None),
+                                        change.get('rw_permission', None),
+                                        change.get('notification_version', None)):
+            modified.append(True)
+            to_put.append(settings)
+        else:
+            modified.append(False)
+    if to_put:
+        db.put(to_put)
+    return (all_settings, modified)
+
+def _changesRoster(change):
+    '''
+    @param change: a dict of the keyword arguments accepted by update
+    @return True if the change touches a value held in the roster
+    '''
+    for name in ['unseen_changes', 'rw_permission', 'notification_version']:
+        if not change.get(name, None) == None:
+            return True
+    return False
+
+def _getBlipIndex(sessions, all_settings, read_blips, unread_blips):
+    '''
+    Fetches the blip index of the wave the sessions belong to, first giving an
+    index to any blips that are about to be marked read or still need to be
+    migrated out of the read_blips list
+    @param sessions: the list of sessions being changed. All from one wave
+    @param all_settings: the current settings of the sessions
+    @param read_blips: a list of the blip ids being marked read for each
+    @param unread_blips: the blip ids being marked unread, or None for each
+    @return the blip index or None if the read state isn't being changed
+    '''
+    needs_index = []
+    for settings, reading in zip(all_settings, read_blips):
+        if settings and settings.read_blips:
+            needs_index.extend(settings.read_blips)
+        needs_index.extend(reading)
+    if needs_index:
+        return waveTools.assignBlipIndexes( sessions[0].wave_id,
+                                            sessions[0].wavelet_id,
+                                            needs_index)
+    for unread_blip in unread_blips:
+        if not unread_blip == None:
+            return waveTools.getBlipIndex(sessions[0].wave_id, sessions[0].wavelet_id)
+    return None
+
+def _applyChanges(settings, blip_index, unseen_changes, read_blips, unread_blip, rw_permission, notification_version):
+    '''
+    Changes the settings object in memory
+    @param settings: the settings to change
+    @param blip_index: the blip index of the wave or None if the read state
+    isn't being changed
+    @param unseen_changes: the new value for unseen_changes or None
+    @param read_blips: a list of blip ids to mark read
+    @param unread_blip: a blip id to mark unread or None
+    @param rw_permission: the raw permission type or None
+    @param notification_version: the new notification version or None
+    @return True if the settings were changed and need to be saved
+    '''
+    modified = False
+    if not unseen_changes == None and not settings.unseen_changes == unseen_changes:
+        settings.unseen_changes = unseen_changes
+        modified = True
+    if not blip_index == None and readState.migrate(settings, blip_index):
+        modified = True
+    for read_blip in read_blips:
+        if readState.markRead(settings, read_blip, blip_index or {}):
+            modified = True
+    if not unread_blip == None and readState.markUnread(settings, unread_blip, blip_index or {}):
+        modified = True
+    if not rw_permission == None and not settings.rw_permission == rw_permission:
+        settings.rw_permission = rw_permission
+        modified = True
+    if not notification_version == None and not settings.notification_version == notification_version:
+        settings.notification_version = notification_version
+        modified = True
+    return modified
+
+def _listReadBlips(read_blip, read_blips):
+    '''
+    @param read_blip: a blip id to mark read or None
+    @param read_blips: a list of blip ids to mark read or None
+    @return a single list of every blip id to mark read
+    '''
+    reading = list(read_blips or [])
+    if not read_blip == None and not read_blip in reading:
+        reading.append(read_blip)
+    return reading
+
+def _resolveSession(key, session):
+    '''
+    @param key: a dict containing wave_id, wavelet_id and email or None
+    @param session: the parent session object or None
+    @return the session, fetching it using the key if it wasn't supplied
+    '''
+    if session == None and not key == None:
         session = sessionTools.get(key['wave_id'], key['wavelet_id'], key['email'])
-    
-    def worker(session, new_permission):
-        '''
-        @transaction_safe
-        '''
-        settings = get(session)
-        settings.rw_permission = new_permission
-        put(settings, session.wave_id, session.wavelet_id, session.email)
-
-    db.run_in_transaction(worker, session, new_permission)
-    
\ No newline at end of file
+    return session
+
+def _generateDbKey(session):
+    '''
+    @param session: the parent session object
+    @return the datastore key of the settings belonging to this session
+    '''
+    return db.Key.from_path('Settings',
+                            generateKey(session.wave_id,
+                                        session.wavelet_id,
+                                        session.email),
+                            parent=session.key())
+
+def _generateGroup(session):
+    '''
+    @param session: the parent session object
+    @return the cache group of the settings belonging to this session
+    '''
+    return session.wave_id + session.wavelet_id
+
+def _generateMemcacheKey(session):
+    '''
+    @param session: the parent session object
+    @return the memcache key of the settings belonging to this session
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['SETTINGS'] +
+                            session.wave_id +
+                            session.wavelet_id +
+                            session.email)
@@ -19,25 +19,28 @@ Methods to make using WaveTools models easier
 '''
 import base64
 
+import cacheTools
 import dbConfig
 import memcacheConfig
 from models import FollowedWave
 from models import WaveMeta
 
-from google.appengine.api import memcache
+from google.appengine.ext import db
 
-def get(wave_id, wavelet_id):
+def get(wave_id, wavelet_id, local=True):
     '''
     Fetches the WaveMeta object from the datastore using the most efficient
     method
     @param wave_id: the wave id of the tuple
     @param wavelet_id: the wavelet id of the tuple
+    @param local=True: set to False if the WaveMeta is going to be changed.
+    Objects from the local cache are shared with other requests
     @return the WaveMeta object or None if it could not be found
     '''
     followedWave = _getFollowedWave(wave_id, wavelet_id)
     if followedWave == None:
         return None
-    return _getWaveMeta(followedWave)
+    return _getWaveMeta(followedWave, local)
 
 def put(waveMeta, wave_id, wavelet_id):
     '''
@@ -56,7 +59,7 @@ def createOrUpdate(wave_id, wavelet_id, participant_profiles=None):
     @param participant_profiles=None: the participant profiles for this wave
     '''
     #Fetch or create
-    waveMeta = get(wave_id, wavelet_id)
+    waveMeta = get(wave_id, wavelet_id, False)
     if not waveMeta:
         followedWave = FollowedWave(wave_id     =   wave_id,
                                     wavelet_id  =   wavelet_id,
@@ -70,6 +73,79 @@ def createOrUpdate(wave_id, wavelet_id, participant_profiles=None):
     
     put(waveMeta, wave_id, wavelet_id)
 
+def getBlipIndex(wave_id, wavelet_id):
+    '''
+    Fetches the numbers given to the blips of a wave for storing read state
+    @param wave_id: the wave id of the tuple
+    @param wavelet_id: the wavelet id of the tuple
+    @return a dict of blip id to its index. Empty if there is no WaveMeta
+    '''
+    waveMeta = get(wave_id, wavelet_id)
+    if waveMeta == None:
+        return {}
+    return waveMeta.blip_index
+
+def getBlipIds(waveMeta):
+    '''
+    Lists the blips of a wave in the order of their index, so the blip with a
+    given index can be found without searching the blip index
+    @param waveMeta: the WaveMeta of the wave or None
+    @return a list of blip ids where each blip id is at its index
+    '''
+    if waveMeta == None:
+        return []
+    blip_ids = waveMeta.blip_ids
+    if not len(blip_ids) == len(waveMeta.blip_index):
+        #WaveMetas from before the list was kept have it built until their next write
+        blip_ids = [None] * len(waveMeta.blip_index)
+        for blip_id, index in waveMeta.blip_index.items():
+            blip_ids[index] = blip_id
+    return blip_ids
+
+def assignBlipIndexes(wave_id, wavelet_id, blip_ids):
+    '''
+    Makes sure each of the blips has an index, giving the next free index to
+    any that don't. Indexes are never reused or removed so they can be
+    assigned outside of any transaction on the users settings
+    @param wave_id: the wave id of the tuple
+    @param wavelet_id: the wavelet id of the tuple
+    @param blip_ids: the blip ids that need an index
+    @return a dict of blip id to its index
+    '''
+    waveMeta = get(wave_id, wavelet_id)
+    if waveMeta:
+        blip_index = waveMeta.blip_index
+        missing = [blip_id for blip_id in blip_ids if not blip_index.has_key(blip_id)]
+        if not missing:
+            return blip_index
+    else:
+        createOrUpdate(wave_id, wavelet_id)
+    followedWave = _getFollowedWave(wave_id, wavelet_id)
+
+    def worker(followedWave, blip_ids):
+        '''
+        @transaction_safe
+        '''
+        #Read from the datastore. The cached copy may be missing new indexes
+        query = WaveMeta.all()
+        query.ancestor(followedWave)
+        waveMeta = query.get()
+        blip_index = waveMeta.blip_index
+        ordered = getBlipIds(waveMeta)
+        added = False
+        for blip_id in blip_ids:
+            if not blip_index.has_key(blip_id):
+                blip_index[blip_id] = len(blip_index)
+                ordered.append(blip_id)
+                added = True
+        if added:
+            waveMeta.blip_index = blip_index
+            waveMeta.blip_ids = ordered
+            _putWaveMeta(waveMeta, followedWave.wave_id, followedWave.wavelet_id)
+        return blip_index
+
+    return db.run_in_transaction(worker, followedWave, blip_ids)
+
 def _getFollowedWave(wave_id, wavelet_id):
     '''
     Returns a followed wave if it can be found in the datastore or memcache
@@ -79,14 +155,14 @@ def _getFollowedWave(wave_id, wavelet_id):
     '''
     key = base64.b64encode( memcacheConfig.PREFIX['FOLLOWED_WAVE'] + 
                             wave_id + wavelet_id)
-    followedWave = memcache.get(key)
-    if not followedWave == None:
+    followedWave = cacheTools.get(key, wave_id + wavelet_id)
+    if not followedWave is cacheTools.MISS:
         return followedWave
     else:
         followedWave = FollowedWave.get_by_key_name(
                                 _generateFollowedWaveKey(wave_id, wavelet_id)
                                                     )
-        memcache.add(key, followedWave, time=memcacheConfig.DEFAULT_EXPIRE_SECS)
+        cacheTools.add(key, followedWave, wave_id + wavelet_id)
         return followedWave
 
 def _generateFollowedWaveKey(wave_id, wavelet_id):
@@ -97,25 +173,25 @@ def _generateFollowedWaveKey(wave_id, wavelet_id):
     '''
     return dbConfig.KEY_PREFIX["FOLLOWED_WAVE"] + wave_id + "|" + wavelet_id
 
-def _getWaveMeta(followedWave):
+def _getWaveMeta(followedWave, local=True):
     '''
     Returns a wave meta instance if it can be found in the datastore or 
     memcache
     @transaction_safe
     @param followedWave: the parent followedWave instance
+    @param local=True: set to False if the WaveMeta is going to be changed
     @return the WaveMeta instance or None if it was not found
     '''
-    key = base64.b64encode( memcacheConfig.PREFIX['WAVE_META'] + 
-                            followedWave.wave_id +
-                            followedWave.wavelet_id)
-    waveMeta = memcache.get(key)
-    if not waveMeta == None:
+    group = followedWave.wave_id + followedWave.wavelet_id
+    key = base64.b64encode( memcacheConfig.PREFIX['WAVE_META'] + group)
+    waveMeta = cacheTools.get(key, group, local)
+    if not waveMeta is cacheTools.MISS:
         return waveMeta
     else:
         query = WaveMeta.all()
         query.ancestor(followedWave)
         waveMeta = query.get()
-        memcache.add(key, waveMeta, time=memcacheConfig.DEFAULT_EXPIRE_SECS)
+        cacheTools.add(key, waveMeta, group, local)
         return waveMeta
 
 def _putFollowedWave(followedWave):
@@ -124,9 +200,10 @@ def _putFollowedWave(followedWave):
     @param followedWave: the followedWave instance to add to the datastore
     '''
     followedWave.put()
-    memcache.delete(base64.b64encode(   memcacheConfig.PREFIX['FOLLOWED_WAVE'] + 
+    cacheTools.delete(base64.b64encode( memcacheConfig.PREFIX['FOLLOWED_WAVE'] + 
                                         followedWave.wave_id +
-                                        followedWave.wavelet_id))
+                                        followedWave.wavelet_id),
+                        followedWave.wave_id + followedWave.wavelet_id)
 
 def _putWaveMeta(waveMeta, wave_id, wavelet_id):
     '''
@@ -136,8 +213,9 @@ def _putWaveMeta(waveMeta, wave_id, wavelet_id):
     @param wavelet_id: the wavelet id this tuple relates to
     '''
     waveMeta.put()
-    memcache.delete(base64.b64encode(   memcacheConfig.PREFIX['WAVE_META'] + 
-                                        wave_id + wavelet_id))
+    cacheTools.delete(base64.b64encode( memcacheConfig.PREFIX['WAVE_META'] + 
+                                        wave_id + wavelet_id),
+                        wave_id + wavelet_id)
 
 def updateParticipantProfiles(participant_profiles, wave_id, wavelet_id):
     '''
@@ -153,9 +231,9 @@ def updateParticipantProfiles(participant_profiles, wave_id, wavelet_id):
         '''
         @transaction_safe
         '''
-        waveMeta = _getWaveMeta(followedWave)
+        waveMeta = _getWaveMeta(followedWave, False)
         waveMeta.participant_profiles = participant_profiles
         _putWaveMeta(waveMeta, followedWave.wave_id, followedWave.wavelet_id)
     
     if not followedWave == None:
-        db.run_in_transaction(worker, waveMeta, participant_profiles)
\ No newline at end of file
+        db.run_in_transaction(worker, followedWave, participant_profiles)
\ No newline at end of file
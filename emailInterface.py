@@ -1,13 +1,22 @@
 '''
 Methods used in deploying emails
 '''
+import base64
+import cgi
 import datetime
+import hashlib
 import logging
+import time
 
 import config
+import mailDispatch
+from dbtools import digestTools
+from dbtools import memcacheConfig
 from dbtools import waveTools
+import taskTools
 
 from google.appengine.api import mail
+from google.appengine.api import memcache
 
 def sendFirstNotificationEmail(url, wave_id, wavelet_id, send_to, who_modified, wave_title, message=""):
     '''
@@ -43,15 +52,16 @@ def sendFirstNotificationEmail(url, wave_id, wavelet_id, send_to, who_modified,
         subject = "Invitation to join: " + wave_title
         
         #Send!
-        mail.send_mail( sender_address,
-                        send_to,
-                        subject,
-                        FIRST_NOTIFICATION_PLAIN % text_variables,
-                        html=FIRST_NOTIFICATION_HTML % text_variables)
-        logging.info("Mail sent successfully to " + send_to)
+        mailDispatch.send(  sender_address,
+                            send_to,
+                            subject,
+                            FIRST_NOTIFICATION_PLAIN % text_variables,
+                            html=FIRST_NOTIFICATION_HTML % text_variables,
+                            priority=mailDispatch.PRIORITY_INVITATION)
+        logging.info("Mail passed to dispatch for " + send_to)
 
 
-def sendNotificationEmail(url, wave_id, wavelet_id, send_to, who_modified, wave_title, who_modified_display=None):
+def sendNotificationEmail(url, wave_id, wavelet_id, send_to, who_modified, wave_title, who_modified_display=None, idempotency_key=None):
     '''
     Sends a notification email to the user
     @param url: this users unique url
@@ -61,6 +71,7 @@ def sendNotificationEmail(url, wave_id, wavelet_id, send_to, who_modified, wave_
     @param who_modified: who modified the wave and triggered the email
     @param wave_title: the title of the wave
     @param who_modified_display=None: a friendly name of who modified the wave. If None then a friendly name is retrieved from wave meta
+    @param idempotency_key=None: names the notification so a retry can't send it twice
     '''
     if _isEmailValid(send_to):
         logging.info("Sending notification email to " + send_to)
@@ -82,12 +93,161 @@ def sendNotificationEmail(url, wave_id, wavelet_id, send_to, who_modified, wave_
         sender_address = config.ROBOT_EMAIL_SENDER_NAME + " <" + config.ROBOT_EMAIL_SEND_NOTIFICATION + ">"
         subject = "Update: " + wave_title
         
-        mail.send_mail( sender_address,
-                        send_to,
-                        subject,
-                        REPLY_NOTIFICATION_PLAIN % text_variables,
-                        html=REPLY_NOTIFICATION_HTML % text_variables)
-        logging.info("Mail sent successfully to " + send_to)
+        mailDispatch.send(  sender_address,
+                            send_to,
+                            subject,
+                            REPLY_NOTIFICATION_PLAIN % text_variables,
+                            html=REPLY_NOTIFICATION_HTML % text_variables,
+                            priority=mailDispatch.PRIORITY_UPDATE,
+                            idempotency_key=idempotency_key)
+        logging.info("Mail passed to dispatch for " + send_to)
+
+def queueNotifications(notifications):
+    '''
+    Queues update notifications for sending. In digest mode the notifications
+    are saved with one batched put and each recipient is sent a single
+    e-mail covering every wave that changed during the digest window.
+    Otherwise a task is queued to send each one straight away, named after
+    its idempotency key so the same notification is only queued once. Either
+    way the tasks are added in batches
+    @param notifications: a list of dicts containing the arguments of
+    sendNotificationEmail by name
+    '''
+    if not notifications:
+        return
+    if not config.EMAIL_DIGEST_ENABLED:
+        #A tombstoned task has already sent its notification
+        taskTools.add_multi([_notificationTask(notification) for notification in notifications])
+        return
+
+    digestTools.add_multi(notifications)
+    _scheduleDigests(   list(set([notification['send_to'] for notification in notifications])),
+                        int(time.time() / config.EMAIL_DIGEST_WINDOW_SECS))
+
+def sendDigest(send_to):
+    '''
+    Sends the notifications waiting for a recipient as one e-mail. A single
+    notification is sent as a normal update e-mail
+    @param send_to: the email receipient to send the digest to
+    '''
+    entries = digestTools.fetch(send_to, config.EMAIL_DIGEST_MAX_ENTRIES)
+    if not entries:
+        return
+    #The entries are only deleted once sent, so a retry sees the same ones
+    idempotency_key = "digest|" + send_to + "|" + ",".join([str(entry.key()) + "@" + str(entry.created)
+                                                                for entry in entries])
+    if len(entries) == 1:
+        entry = entries[0]
+        sendNotificationEmail(  entry.url,
+                                entry.wave_id,
+                                entry.wavelet_id,
+                                send_to,
+                                entry.who_modified,
+                                entry.title,
+                                who_modified_display=entry.who_modified_display,
+                                idempotency_key=idempotency_key)
+    elif _isEmailValid(send_to):
+        logging.info("Sending digest of " + str(len(entries)) + " waves to " + send_to)
+        html_rows = []
+        plain_rows = []
+        metaWaves = {}
+        for entry in entries:
+            #Several entries can be from the same wave so only fetch it once
+            wave_key = (entry.wave_id, entry.wavelet_id)
+            if not metaWaves.has_key(wave_key):
+                metaWaves[wave_key] = waveTools.get(entry.wave_id, entry.wavelet_id)
+            display_name = entry.who_modified_display or _getDisplayName(metaWaves[wave_key], entry.who_modified)
+            row_variables = {   'title'     : entry.title or "Untitled",
+                                'modifier'  : display_name + " (" + entry.who_modified + ")",
+                                'url'       : entry.url}
+            plain_rows.append(DIGEST_ROW_PLAIN % row_variables)
+            for name, value in row_variables.items():
+                row_variables[name] = cgi.escape(value, True)
+            html_rows.append(DIGEST_ROW_HTML % row_variables)
+
+        text_variables = {  'count'     : len(entries),
+                            'time'      : datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S'),
+                            'robot_web' : config.ROBOT_WEB}
+        sender_address = config.ROBOT_EMAIL_SENDER_NAME + " <" + config.ROBOT_EMAIL_SEND_NOTIFICATION + ">"
+        subject = "Updates to " + str(len(entries)) + " waves"
+
+        text_variables['waves'] = "".join(plain_rows)
+        plain = DIGEST_NOTIFICATION_PLAIN % text_variables
+        text_variables['waves'] = "".join(html_rows)
+        mailDispatch.send(  sender_address,
+                            send_to,
+                            subject,
+                            plain,
+                            html=DIGEST_NOTIFICATION_HTML % text_variables,
+                            priority=mailDispatch.PRIORITY_UPDATE,
+                            idempotency_key=idempotency_key)
+        logging.info("Mail passed to dispatch for " + send_to)
+
+    digestTools.delete(entries)
+    if len(entries) == config.EMAIL_DIGEST_MAX_ENTRIES:
+        #There may be more waiting
+        _scheduleDigests([send_to], int(time.time() / config.EMAIL_DIGEST_WINDOW_SECS))
+
+def _notificationTask(notification):
+    '''
+    Builds the task that sends a notification straight away
+    @param notification: a dict containing the arguments of
+    sendNotificationEmail by name
+    @return the task, named if the notification has an idempotency key
+    '''
+    name = None
+    if not notification.get('idempotency_key', None) == None:
+        name = "email-notification-" + hashlib.md5(notification['idempotency_key'].encode('utf-8')).hexdigest()
+    return taskTools.task(sendNotificationEmail, _name=name, **notification)
+
+def _scheduleDigests(send_tos, window):
+    '''
+    Makes sure the digest of each recipient is queued for the end of the
+    window. The task is named after the recipient and window so it is only
+    queued once. A memcache marker, set once the task has been queued, saves
+    queueing it again for the rest of the window
+    @param send_tos: the list of email receipients
+    @param window: the number of the digest window
+    '''
+    markers = {}
+    for send_to in send_tos:
+        markers[base64.b64encode(memcacheConfig.PREFIX['EMAIL_DIGEST'] + send_to + "|" + str(window))] = send_to
+    queued = memcache.get_multi(markers.keys())
+    send_tos = [send_to for key, send_to in markers.items() if not key in queued]
+    if not send_tos:
+        return
+
+    tasks = {}
+    for send_to in send_tos:
+        tasks[_generateDigestTaskName(send_to, window)] = send_to
+    tombstoned = taskTools.add_multi([_digestTask(send_to, window) for send_to in send_tos])
+    if tombstoned:
+        #These windows have already been sent, by another instances clock
+        taskTools.add_multi([_digestTask(tasks[task.name], window + 1) for task in tombstoned])
+    memcache.set_multi( dict([(key, True) for key in markers.keys() if not key in queued]),
+                        time=config.EMAIL_DIGEST_WINDOW_SECS * 2)
+
+def _digestTask(send_to, window):
+    '''
+    Builds the task that sends the digest of a window, named so that it is
+    only queued once
+    @param send_to: the email receipient of the digest
+    @param window: the number of the digest window
+    @return the task
+    '''
+    eta = (window + 1) * config.EMAIL_DIGEST_WINDOW_SECS
+    return taskTools.task(  sendDigest,
+                            send_to,
+                            _name=_generateDigestTaskName(send_to, window),
+                            _countdown=max(0, int(eta - time.time()) + 1))
+
+def _generateDigestTaskName(send_to, window):
+    '''
+    @param send_to: the email receipient of the digest
+    @param window: the number of the digest window
+    @return the name of the task that sends the digest
+    '''
+    return "email-digest-" + hashlib.md5(send_to.encode('utf-8')).hexdigest() + "-" + str(window)
 
 def _getDisplayName(metaWave, who_modified):
     '''
@@ -199,6 +359,50 @@ REPLY_NOTIFICATION_HTML = \
 </table>
 """
 
+DIGEST_NOTIFICATION_HTML = \
+"""
+<table width="100%%" border="0" cellspacing="0" bordercolor="gray">
+    <tr><td>
+        <table width="100%%" border="0" cellspacing="10" style="font-family:arial, sans-serif; font-size:small;">
+            <tr>
+                <td width="77px" height="77px">
+                    <img src="%(robot_web)sweb/media/icon.png" title="Mr Ray logo" alt="Mr Ray logo" height="75" width="75" style="border:1px solid #CAD0D9; font-size:xx-small;"/>
+                </td>
+                <td>
+                    <p style="font-size:medium; font-weight:bold;">Mr Ray, the wav-e-mail bot</p>
+                </td>
+            </tr>
+            <tr>
+                <td colspan=2><p><b>%(count)s Waves that you follow have been updated. We thought you might want to see the changes!</b></p><br /></td>
+            </tr>
+            %(waves)s
+        </table>
+    </td></tr>
+    <tr><td style="color:gray; font-family:arial, sans-serif; font-size:xx-small; background-color:#F6F6F6">
+        <p><b>Why shouldn't I share the links that were sent to me?</b><p>
+        <p>These links are unique to you and your e-mail address. Sharing them will allow other people to reply as you.</p>
+        <p><b>I don't want any more notifications about these waves, what should I do?</b></p>
+        <p>Don't worry. Just ignore this e-mail. You will only receive more notifications about a wave if you visit the link we provided for it.</p>
+        <br />
+        <p>Mail sent at %(time)s</p>
+        <p>Do not reply to this email address it is not monitored. You will not receive any new notifications about updates to a wave until you have visited its url.</p>
+    </td></tr>
+</table>
+"""
+
+DIGEST_ROW_HTML = \
+"""
+            <tr>
+                <td style="color:gray;">Wave:</td><td>%(title)s</td>
+            </tr>
+            <tr>
+                <td style="color:gray;">By:</td><td>%(modifier)s</td>
+            </tr>
+            <tr>
+                <td style="color:gray;">Your link:</td><td>Please don't share <a href="%(url)s">your secret link!</a><br /><br /></td>
+            </tr>
+"""
+
 ################################################################################
 # Email content (Plain)
 ################################################################################
@@ -243,4 +447,27 @@ Don't worry. Just ignore this e-mail. You will only receive more notifications i
 
 Mail sent at %(time)s
 Do not reply to this email address it is not monitored. You will not receive any new notifications about updates to the wave until you have visited the url.
-"""
\ No newline at end of file
+"""
+
+DIGEST_NOTIFICATION_PLAIN = \
+"""
+%(count)s Waves that you follow have been updated. We thought you might want to see the changes!
+%(waves)s
+
+************************
+*Why shouldn't I share the links that were sent to me?
+These links are unique to you and your e-mail address. Sharing them will allow other people to reply as you.
+*I don't want any more notifications about these waves, what should I do?
+Don't worry. Just ignore this e-mail. You will only receive more notifications about a wave if you visit the link we provided for it.
+
+
+Mail sent at %(time)s
+Do not reply to this email address it is not monitored. You will not receive any new notifications about updates to a wave until you have visited its url.
+"""
+
+DIGEST_ROW_PLAIN = \
+"""
+Wave: %(title)s
+By: %(modifier)s
+Your link: Please don't share your secret link: %(url)s
+"""
@@ -174,11 +174,10 @@ def constructInitialState(wavelet):
     @param wavelet: the wavelet where the gadget will live
     @return a dictionary containing the key values of the initial state
     '''
-    sessions = sessionTools.fetch(wavelet.wave_id, wavelet.wavelet_id)
     #Form the email list
     email_list = []
     public_session = None
-    for session in sessions:
+    for session in sessionTools.iter_sessions(wavelet.wave_id, wavelet.wavelet_id):
         if sessionTools.isPublic(session):
             public_session = session
         else:
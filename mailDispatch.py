@@ -0,0 +1,322 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Sends outgoing mail at a controlled rate. Each sender has a token bucket in
+memcache shared by every instance. A message that can't be sent yet waits in
+the task queue of its priority lane. Update notices leave
+MAIL_INVITATION_RESERVE tokens in the bucket so a burst of them can't hold up
+invitations. When the mail quota runs out, every send backs off for a
+growing period.
+
+Messages are handed to a transport, chosen by config.MAIL_TRANSPORT. Any
+object with these can be plugged in with setTransport:
+
+send(message) sends a message dict containing sender, to, subject, body and
+html
+
+throttled_errors is an optional tuple of the exceptions send raises when the
+transport is refusing mail for now. They pause sending from the sender
+rather than failing the message
+
+A message sent with an idempotency key is only sent once, however many times
+a retried task asks for it. A dedup record for the key is created in the
+datastore in a transaction just before the message is handed to the
+transport, and is only released if the transport fails. memcache remembers
+the messages that have gone out so most retries don't need the transaction
+'''
+import base64
+import logging
+import time
+
+import config
+from dbtools import memcacheConfig
+from dbtools import sentMailTools
+
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.runtime import apiproxy_errors
+
+#Priority lanes, highest first
+PRIORITY_INVITATION = "invitation"
+PRIORITY_UPDATE = "update"
+PRIORITIES = [PRIORITY_INVITATION, PRIORITY_UPDATE]
+
+#Number of times to retry a contended update of a token bucket
+_CAS_RETRIES = 5
+
+class AppEngineMailTransport(object):
+    '''
+    Sends mail with the App Engine mail API
+    '''
+    throttled_errors = (apiproxy_errors.OverQuotaError,)
+
+    def send(self, message):
+        '''
+        @param message: a dict containing sender, to, subject, body and html
+        '''
+        mail.send_mail( message['sender'],
+                        message['to'],
+                        message['subject'],
+                        message['body'],
+                        html=message['html'])
+
+class MemoryMailTransport(object):
+    '''
+    Keeps mail in memory rather than sending it. Use it in place of the real
+    transport when testing
+    '''
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        '''
+        @param message: a dict containing sender, to, subject, body and html
+        '''
+        self.sent.append(message)
+
+def _createTransport():
+    '''
+    @return the transport named by config.MAIL_TRANSPORT
+    '''
+    if config.MAIL_TRANSPORT == "smtp":
+        #Only imported when used as smtplib isn't available on App Engine
+        import smtpTransport
+        return smtpTransport.fromConfig()
+    return AppEngineMailTransport()
+
+_transport = _createTransport()
+
+def setTransport(transport):
+    '''
+    Replaces the transport used to send mail
+    @param transport: the transport to use. See the top of this module for
+    what it needs
+    @return the transport that was replaced
+    '''
+    global _transport
+    replaced = _transport
+    _transport = transport
+    return replaced
+
+def send(sender, to, subject, body, html, priority=PRIORITY_UPDATE, idempotency_key=None):
+    '''
+    Sends a message now if the senders rate allows it, otherwise queues it in
+    its priority lane to be sent as soon as it does
+    @param sender: the sender address
+    @param to: the recipient address
+    @param subject: the subject of the message
+    @param body: the plain text body
+    @param html: the html body
+    @param priority=PRIORITY_UPDATE: the lane of the message
+    @param idempotency_key=None: a string naming the logical message. Any
+    later message with the same key within MAIL_DEDUP_EXPIRE_SECS is dropped
+    '''
+    message = { 'sender'    :   sender,
+                'to'        :   to,
+                'subject'   :   subject,
+                'body'      :   body,
+                'html'      :   html,
+                'key'       :   idempotency_key,
+                'queued'    :   time.time()}
+    _dispatch(message, priority, False)
+
+def getMetrics():
+    '''
+    @return a dict containing the depth of each lane, and for each lane the
+    number of messages sent and their average latency from being asked to
+    send to being sent, along with how often the quota has run out and how
+    many duplicate messages were dropped
+    '''
+    keys = ['over_quota', 'duplicates']
+    for priority in PRIORITIES:
+        keys.extend(['depth:' + priority, 'sent:' + priority, 'latency_ms:' + priority])
+    counters = memcache.get_multi([_generateMetricKey(key) for key in keys])
+    metrics = {}
+    for key in keys:
+        metrics[key] = counters.get(_generateMetricKey(key), 0)
+    for priority in PRIORITIES:
+        sent = metrics['sent:' + priority]
+        latency = metrics.pop('latency_ms:' + priority)
+        if sent:
+            metrics['average_latency_ms:' + priority] = latency / sent
+        else:
+            metrics['average_latency_ms:' + priority] = 0
+    return metrics
+
+def _deliver(message, priority):
+    '''
+    Task that retries a message that was waiting in its lane
+    @param message: the message dict
+    @param priority: the lane of the message
+    '''
+    _dispatch(message, priority, True)
+
+def _dispatch(message, priority, waiting):
+    '''
+    Sends the message or puts it back in its lane until it can be sent
+    @param message: the message dict
+    @param priority: the lane of the message
+    @param waiting: True if the message was already waiting in its lane
+    '''
+    wait = _pausedFor(message['sender'])
+    if not wait:
+        reserve = 0
+        if not priority == PRIORITY_INVITATION:
+            reserve = config.MAIL_INVITATION_RESERVE
+        wait = _takeToken(message['sender'], reserve)
+    if not wait:
+        if not _claim(message):
+            _count('duplicates')
+            if waiting:
+                _count('depth:' + priority, -1)
+            logging.info("Dropped duplicate mail to " + message['to'])
+            return
+        transport = _transport
+        try:
+            transport.send(message)
+        except getattr(transport, 'throttled_errors', ()):
+            _release(message)
+            wait = _backOff(message['sender'])
+        except:
+            _release(message)
+            raise
+        else:
+            _markSent(message)
+            _count('sent:' + priority)
+            _count('latency_ms:' + priority, int((time.time() - message['queued']) * 1000))
+            if waiting:
+                _count('depth:' + priority, -1)
+            logging.info("Mail sent to " + message['to'])
+            return
+
+    if not waiting:
+        _count('depth:' + priority)
+    deferred.defer( _deliver,
+                    message,
+                    priority,
+                    _queue=config.MAIL_QUEUES[priority],
+                    _countdown=int(wait) + 1)
+
+def _claim(message):
+    '''
+    Claims the dedup record of a message
+    @param message: the message dict
+    @return True if the message should be sent, False if it has already been
+    '''
+    if message.get('key', None) == None:
+        return True
+    return sentMailTools.claim(message['key'])
+
+def _markSent(message):
+    '''
+    Remembers that a message with a dedup record has been sent
+    @param message: the message dict
+    '''
+    if not message.get('key', None) == None:
+        sentMailTools.markSent(message['key'])
+
+def _release(message):
+    '''
+    Releases the dedup record of a message that couldn't be sent so a retry
+    can send it
+    @param message: the message dict
+    '''
+    if not message.get('key', None) == None:
+        sentMailTools.release(message['key'])
+
+def _takeToken(sender, reserve):
+    '''
+    Takes a token from the senders bucket
+    @param sender: the sender address
+    @param reserve: the tokens that must be left in the bucket afterwards
+    @return 0 if a token was taken, otherwise the seconds until one will be
+    free
+    '''
+    key = _generateKey('MAIL_BUCKET', sender)
+    rate = config.MAIL_RATE_PER_MINUTE / 60.0
+    client = memcache.Client()
+    for i in range(0, _CAS_RETRIES):
+        bucket = client.gets(key)
+        now = time.time()
+        if bucket == None:
+            tokens, updated = float(config.MAIL_BUCKET_SIZE), now
+        else:
+            tokens, updated = bucket
+        tokens = min(float(config.MAIL_BUCKET_SIZE), tokens + (now - updated) * rate)
+        if tokens - 1 < reserve:
+            return (reserve + 1 - tokens) / rate
+        if bucket == None:
+            if client.add(key, (tokens - 1, now)):
+                return 0
+        elif client.cas(key, (tokens - 1, now)):
+            return 0
+    #memcache is contended or unavailable. The quota backoff still applies
+    return 0
+
+def _pausedFor(sender):
+    '''
+    @param sender: the sender address
+    @return the seconds left of the senders quota backoff or 0
+    '''
+    paused = memcache.get(_generateKey('MAIL_PAUSE', sender))
+    if paused == None:
+        return 0
+    return max(0, paused[0] - time.time())
+
+def _backOff(sender):
+    '''
+    Pauses all sending from a sender after the mail quota has run out. Each
+    time it runs out again within the pause the pause is doubled
+    @param sender: the sender address
+    @return the seconds to pause for
+    '''
+    key = _generateKey('MAIL_PAUSE', sender)
+    paused = memcache.get(key)
+    backoff = config.MAIL_BACKOFF_MIN_SECS
+    if not paused == None:
+        backoff = min(config.MAIL_BACKOFF_MAX_SECS, paused[1] * 2)
+    #Kept past the pause so the next one knows to double
+    memcache.set(key, (time.time() + backoff, backoff), time=backoff * 2)
+    _count('over_quota')
+    logging.warn("Mail quota exceeded. Pausing mail from " + sender + " for " + str(backoff) + " seconds")
+    return backoff
+
+def _count(name, delta=1):
+    '''
+    @param name: the name of the counter
+    @param delta=1: the amount to change it by
+    '''
+    if delta < 0:
+        memcache.decr(_generateMetricKey(name), delta=-delta, initial_value=0)
+    else:
+        memcache.incr(_generateMetricKey(name), delta=delta, initial_value=0)
+
+def _generateMetricKey(name):
+    '''
+    @param name: the name of the counter
+    @return the memcache key of the counter
+    '''
+    return _generateKey('MAIL_METRIC', name)
+
+def _generateKey(prefix, value):
+    '''
+    @param prefix: the name of the memcacheConfig prefix
+    @param value: the rest of the key
+    @return the memcache key
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX[prefix] + value)
@@ -0,0 +1,162 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Unit tests for mailDispatch using the in memory mail transport
+'''
+import os
+import unittest
+
+import config
+import mailDispatch
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+SENDER = "Mr Ray <noreply@example.com>"
+
+class FailingTransport(object):
+    '''
+    Fails the first send then hands the rest to another transport
+    '''
+    def __init__(self, transport):
+        self.transport = transport
+        self.failed = False
+
+    def send(self, message):
+        if not self.failed:
+            self.failed = True
+            raise IOError("connection lost")
+        self.transport.send(message)
+
+class BusyTransport(object):
+    '''
+    Refuses every message as if the provider were throttling us
+    '''
+    throttled_errors = (IOError,)
+
+    def send(self, message):
+        raise IOError("try again later")
+
+class MailDispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_datastore_v3_stub()
+        #queue.yaml defines the lanes
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.transport = mailDispatch.MemoryMailTransport()
+        self.replaced = mailDispatch.setTransport(self.transport)
+
+    def tearDown(self):
+        mailDispatch.setTransport(self.replaced)
+        self.testbed.deactivate()
+
+    def send(self, to, priority, idempotency_key=None):
+        mailDispatch.send(  SENDER,
+                            to,
+                            "subject",
+                            "body",
+                            "<p>body</p>",
+                            priority=priority,
+                            idempotency_key=idempotency_key)
+
+    def drainUpdates(self):
+        '''
+        Sends update notices until only the invitation reserve is left
+        '''
+        for i in range(0, config.MAIL_BUCKET_SIZE - config.MAIL_INVITATION_RESERVE):
+            self.send("update%d@example.com" % i, mailDispatch.PRIORITY_UPDATE)
+
+    def testSendsWithinTheRate(self):
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE)
+        self.assertEquals(1, len(self.transport.sent))
+        self.assertEquals("a@example.com", self.transport.sent[0]['to'])
+        self.assertEquals(1, mailDispatch.getMetrics()['sent:' + mailDispatch.PRIORITY_UPDATE])
+
+    def testUpdatesLeaveTheInvitationReserve(self):
+        self.drainUpdates()
+        self.assertEquals(config.MAIL_BUCKET_SIZE - config.MAIL_INVITATION_RESERVE, len(self.transport.sent))
+
+        self.send("late@example.com", mailDispatch.PRIORITY_UPDATE)
+        self.assertEquals(config.MAIL_BUCKET_SIZE - config.MAIL_INVITATION_RESERVE, len(self.transport.sent))
+
+        self.send("invited@example.com", mailDispatch.PRIORITY_INVITATION)
+        self.assertEquals("invited@example.com", self.transport.sent[-1]['to'])
+
+    def testWaitingMailIsQueuedInItsLane(self):
+        self.drainUpdates()
+        for i in range(0, config.MAIL_INVITATION_RESERVE + 1):
+            self.send("invited%d@example.com" % i, mailDispatch.PRIORITY_INVITATION)
+        self.send("late@example.com", mailDispatch.PRIORITY_UPDATE)
+
+        self.assertEquals(1, len(self.taskqueue_stub.GetTasks(config.MAIL_QUEUES[mailDispatch.PRIORITY_INVITATION])))
+        self.assertEquals(1, len(self.taskqueue_stub.GetTasks(config.MAIL_QUEUES[mailDispatch.PRIORITY_UPDATE])))
+        metrics = mailDispatch.getMetrics()
+        self.assertEquals(1, metrics['depth:' + mailDispatch.PRIORITY_INVITATION])
+        self.assertEquals(1, metrics['depth:' + mailDispatch.PRIORITY_UPDATE])
+
+    def testInvitationsAreFreedBeforeUpdates(self):
+        self.drainUpdates()
+        update_wait = mailDispatch._takeToken(SENDER, config.MAIL_INVITATION_RESERVE)
+        invitation_wait = mailDispatch._takeToken(SENDER, 0)
+        self.assertTrue(update_wait > 0)
+        self.assertEquals(0, invitation_wait)
+
+        for i in range(0, config.MAIL_INVITATION_RESERVE):
+            mailDispatch._takeToken(SENDER, 0)
+        update_wait = mailDispatch._takeToken(SENDER, config.MAIL_INVITATION_RESERVE)
+        invitation_wait = mailDispatch._takeToken(SENDER, 0)
+        self.assertTrue(0 < invitation_wait < update_wait)
+
+    def testThrottlingPausesTheSender(self):
+        mailDispatch.setTransport(BusyTransport())
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE)
+        self.assertEquals(1, mailDispatch.getMetrics()['over_quota'])
+        self.assertTrue(mailDispatch._pausedFor(SENDER) > 0)
+        self.assertEquals(1, len(self.taskqueue_stub.GetTasks(config.MAIL_QUEUES[mailDispatch.PRIORITY_UPDATE])))
+
+    def testIdempotencyKeySendsOnce(self):
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE, idempotency_key="wave|wavelet|a@example.com|1")
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE, idempotency_key="wave|wavelet|a@example.com|1")
+        self.assertEquals(1, len(self.transport.sent))
+        self.assertEquals(1, mailDispatch.getMetrics()['duplicates'])
+
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE, idempotency_key="wave|wavelet|a@example.com|2")
+        self.assertEquals(2, len(self.transport.sent))
+
+    def testIdempotencyKeyOutlivesMemcache(self):
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE, idempotency_key="wave|wavelet|a@example.com|1")
+        memcache.flush_all()
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE, idempotency_key="wave|wavelet|a@example.com|1")
+        self.assertEquals(1, len(self.transport.sent))
+
+    def testFailedSendReleasesTheIdempotencyKey(self):
+        mailDispatch.setTransport(FailingTransport(self.transport))
+        self.assertRaises(  IOError,
+                            self.send,
+                            "a@example.com",
+                            mailDispatch.PRIORITY_UPDATE,
+                            "wave|wavelet|a@example.com|1")
+        self.send("a@example.com", mailDispatch.PRIORITY_UPDATE, idempotency_key="wave|wavelet|a@example.com|1")
+        self.assertEquals(1, len(self.transport.sent))
+
+
+if __name__ == "__main__":
+    unittest.main()
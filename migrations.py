@@ -0,0 +1,69 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Admin page to start the bulk migration jobs and follow their progress
+'''
+import logging
+
+from dbtools import dbmigration
+
+from waveapi import simplejson
+
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+#The jobs that can be started from this page
+JOBS = {   dbmigration.V1_TO_V2        :   dbmigration.startV1toV2,
+            dbmigration.SESSION_KEYS    :   dbmigration.startSessionKeys}
+
+class MigrationStatusPage(webapp.RequestHandler):
+
+    def get(self):
+        '''
+        Writes the progress of each job as json
+        '''
+        output = {}
+        for name in JOBS.keys():
+            status = dbmigration.getStatus(name)
+            if status == None:
+                output[name] = None
+            else:
+                output[name] = {'scanned'   :   status.scanned,
+                                'migrated'  :   status.migrated,
+                                'complete'  :   status.complete,
+                                'started'   :   str(status.started),
+                                'updated'   :   str(status.updated)}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps(output))
+
+    def post(self):
+        '''
+        Starts or resumes the job named in the job argument
+        '''
+        name = self.request.get("job", "")
+        if not JOBS.has_key(name):
+            self.response.set_status(400)
+            return
+        logging.info("Starting migration " + name)
+        JOBS[name]()
+        self.response.set_status(202)
+
+
+if __name__=="__main__":
+    run_wsgi_app(   webapp.WSGIApplication(
+                                            [('/admin/migrations', MigrationStatusPage)]
+    ))
@@ -0,0 +1,121 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Fans a change to a wave out to its e-mail participants. The robot and action
+handlers queue a single task for each change carrying only ids, so they take
+the same time however many participants the wave has.
+
+Each notification is keyed by the wave, the recipient and the recipients next
+notification version, which is only incremented once they have been notified.
+Concurrent changes, and retries of this task, that both see a recipient
+without unseen changes therefore produce the same key. Sending is deduplicated
+on the key, see emailInterface.queueNotifications
+'''
+import emailInterface
+from dbtools import readReceipts
+from dbtools import rosterTools
+from dbtools import settingsTools
+from dbtools import sessionTools
+from permission import rawTypes as pt_raw
+from push import waveChannels
+from security import sessionCreation
+
+from google.appengine.ext import deferred
+
+def queueNotifyParticipants(wave_id, wavelet_id, wave_title, who_modified, who_modified_display=None, blip_id=None, exclude_email=None, push=False):
+    '''
+    Queues the task that notifies the participants of a wave about a change.
+    See notifyParticipants
+    '''
+    deferred.defer( notifyParticipants,
+                    wave_id,
+                    wavelet_id,
+                    wave_title,
+                    who_modified,
+                    who_modified_display=who_modified_display,
+                    blip_id=blip_id,
+                    exclude_email=exclude_email,
+                    push=push)
+
+def notifyParticipants(wave_id, wavelet_id, wave_title, who_modified, who_modified_display=None, blip_id=None, exclude_email=None, push=False):
+    '''
+    Sends a notification to each e-mail participant that hasn't been sent one
+    since they last visited the wave, and marks that they have unseen changes
+    @param wave_id: the id of the wave that changed
+    @param wavelet_id: the id of the wavelet that changed
+    @param wave_title: the title of the wave
+    @param who_modified: who modified the wave
+    @param who_modified_display=None: a friendly name of who modified the wave
+    @param blip_id=None: the blip that changed. Marked unread for every user
+    @param exclude_email=None: the email of a user who made the change and
+    shouldn't be notified about it
+    @param push=False: set to True to also tell every page viewing the wave
+    that it has changed
+    '''
+    if push:
+        waveChannels.notifyWave(wave_id, wavelet_id)
+
+    #The roster is enough to decide who to e-mail
+    participants = [participant for participant in rosterTools.getParticipants(wave_id, wavelet_id, local=False)
+                        if  not participant.email == exclude_email and
+                            not sessionTools.isPublic(participant)]
+    changed = []
+    changes = []
+    notifications = []
+    for participant in participants:
+        change = {}
+        if blip_id:
+            change['unread_blip'] = blip_id
+        #Dispatch e-mail if these are new changes
+        if not participant.unseen_changes and not participant.rw_permission == pt_raw.RW['DELETED']:
+            notifications.append({  'url'                   :   sessionCreation.regenerateUser( wave_id,
+                                                                                                wavelet_id,
+                                                                                                participant.email,
+                                                                                                participant.auth_token),
+                                    'wave_id'               :   wave_id,
+                                    'wavelet_id'            :   wavelet_id,
+                                    'send_to'               :   participant.email,
+                                    'who_modified'          :   who_modified,
+                                    'wave_title'            :   wave_title,
+                                    'who_modified_display'  :   who_modified_display,
+                                    'idempotency_key'       :   _generateIdempotencyKey(wave_id,
+                                                                                        wavelet_id,
+                                                                                        participant.email,
+                                                                                        participant.notification_version + 1)})
+            change['unseen_changes'] = True
+            change['notification_version'] = participant.notification_version + 1
+        if change:
+            changed.append(participant)
+            changes.append(change)
+    emailInterface.queueNotifications(notifications)
+
+    #A receipt for the old version of the blip mustn't mark the new one read
+    if blip_id:
+        readReceipts.discard(wave_id, wavelet_id, blip_id)
+
+    #Written together so the roster is only written once for the change
+    settingsTools.update_multi(changed, changes)
+
+def _generateIdempotencyKey(wave_id, wavelet_id, email, version):
+    '''
+    @param wave_id: the id of the wave
+    @param wavelet_id: the id of the wavelet
+    @param email: the email of the recipient
+    @param version: the notification version of the recipient
+    @return the idempotency key of the notification
+    '''
+    return wave_id + "|" + wavelet_id + "|" + email + "|" + str(version)
@@ -0,0 +1,79 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Backends that can deliver push messages to a browser. A channel is opened for
+each page that is viewing a wave and messages are sent to it by client id.
+Any object with these methods can be passed to waveChannels.setBackend:
+
+createChannel(client_id) opens a channel for a client and returns the token
+the page uses to connect to it
+
+sendMessage(client_id, message) sends a string down a clients channel
+'''
+
+class AppEngineChannelBackend(object):
+    '''
+    Delivers push messages using the App Engine channel api
+    '''
+    def createChannel(self, client_id):
+        '''
+        @param client_id: the unique id of the client
+        @return the token the page uses to connect to the channel
+        '''
+        from google.appengine.api import channel
+        return channel.create_channel(client_id)
+
+    def sendMessage(self, client_id, message):
+        '''
+        @param client_id: the unique id of the client
+        @param message: the string to send
+        '''
+        from google.appengine.api import channel
+        channel.send_message(client_id, message)
+
+class InProcessChannelBackend(object):
+    '''
+    Keeps push messages in memory so they can be inspected. Stand-in for the
+    real channel api in tests and local development
+    '''
+    def __init__(self):
+        self.messages = {}
+
+    def createChannel(self, client_id):
+        '''
+        @param client_id: the unique id of the client
+        @return the client id, which is used as the token
+        '''
+        self.messages.setdefault(client_id, [])
+        return client_id
+
+    def sendMessage(self, client_id, message):
+        '''
+        @param client_id: the unique id of the client
+        @param message: the string to send
+        '''
+        self.messages.setdefault(client_id, []).append(message)
+
+    def getMessages(self, client_id):
+        '''
+        Returns and clears the messages that have been sent to a client
+        @param client_id: the unique id of the client
+        @return a list of the messages sent since the last call
+        '''
+        messages = self.messages.get(client_id, [])
+        self.messages[client_id] = []
+        return messages
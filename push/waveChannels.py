@@ -0,0 +1,140 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Methods that keep track of the pages viewing a wave and push updates to them
+as soon as the wave changes
+'''
+import base64
+import hashlib
+import logging
+import time
+import uuid
+
+import backends
+import config
+from dbtools import memcacheConfig
+
+from waveapi import simplejson
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+_backend = None
+
+#Number of times to retry a contended update of the client list
+_CAS_RETRIES = 5
+
+def setBackend(backend):
+    '''
+    Changes the backend used to deliver push messages
+    @param backend: the channel backend to use. See backends for its methods
+    '''
+    global _backend
+    _backend = backend
+
+def getBackend():
+    '''
+    @return the channel backend in use. Defaults to the App Engine channel api
+    '''
+    global _backend
+    if _backend == None:
+        _backend = backends.AppEngineChannelBackend()
+    return _backend
+
+def openChannel(wave_id, wavelet_id, email):
+    '''
+    Opens a push channel for a page that is viewing a wave
+    @param wave_id: the id of the wave being viewed
+    @param wavelet_id: the id of the wavelet being viewed
+    @param email: the email of the user viewing the wave
+    @return the token the page uses to connect or None if push is unavailable
+    '''
+    if not config.PUSH_ENABLED:
+        return None
+    #Public users share an email so each page needs a unique id
+    client_id = hashlib.md5((wave_id + wavelet_id + email).encode('utf-8')).hexdigest() + uuid.uuid4().hex[:16]
+    try:
+        token = getBackend().createChannel(client_id)
+    except Exception, e:
+        logging.warn("Could not open push channel: " + str(e))
+        return None
+    _addClient(wave_id, wavelet_id, client_id)
+    return token
+
+def queueNotifyWave(wave_id, wavelet_id):
+    '''
+    Queues a task that tells every page viewing a wave that it has changed, so
+    the cost of a message per page isn't paid by the request. See notifyWave
+    @param wave_id: the id of the wave that changed
+    @param wavelet_id: the id of the wavelet that changed
+    '''
+    if not config.PUSH_ENABLED:
+        return
+    deferred.defer(notifyWave, wave_id, wavelet_id)
+
+def notifyWave(wave_id, wavelet_id):
+    '''
+    Tells every page viewing a wave that it has changed. This sends a message
+    for each page so only call it from a task, see queueNotifyWave
+    @param wave_id: the id of the wave that changed
+    @param wavelet_id: the id of the wavelet that changed
+    '''
+    if not config.PUSH_ENABLED:
+        return
+    clients = memcache.get(_generateKey(wave_id, wavelet_id)) or {}
+    message = simplejson.dumps({'waveid': wave_id, 'waveletid': wavelet_id})
+    now = time.time()
+    for client_id, expires in clients.items():
+        if expires < now:
+            continue
+        try:
+            getBackend().sendMessage(client_id, message)
+        except Exception, e:
+            logging.warn("Could not push to client " + client_id + ": " + str(e))
+
+def _addClient(wave_id, wavelet_id, client_id):
+    '''
+    Records that a client is viewing a wave. Expired clients are removed at
+    the same time
+    @param wave_id: the id of the wave being viewed
+    @param wavelet_id: the id of the wavelet being viewed
+    @param client_id: the unique id of the client
+    '''
+    key = _generateKey(wave_id, wavelet_id)
+    client = memcache.Client()
+    for i in range(0, _CAS_RETRIES):
+        clients = client.gets(key)
+        now = time.time()
+        updated = {client_id: now + config.PUSH_CHANNEL_LIFETIME_SECS}
+        for other_id, expires in (clients or {}).items():
+            if expires > now:
+                updated[other_id] = expires
+        if clients == None:
+            if client.add(key, updated, time=config.PUSH_CHANNEL_LIFETIME_SECS):
+                return
+        elif client.cas(key, updated, time=config.PUSH_CHANNEL_LIFETIME_SECS):
+            return
+    logging.warn("Could not register push client for " + wave_id + " " + wavelet_id + ". It will poll instead")
+
+def _generateKey(wave_id, wavelet_id):
+    '''
+    @param wave_id: the id of the wave
+    @param wavelet_id: the id of the wavelet
+    @return the memcache key of the client list for this wave
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['PUSH_CLIENTS'] +
+                            wave_id + wavelet_id)
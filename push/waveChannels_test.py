@@ -0,0 +1,88 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Unit tests for waveChannels. Run from the application directory with
+python -m push.waveChannels_test
+'''
+import unittest
+
+import config
+from push import backends
+from push import waveChannels
+
+from waveapi import simplejson
+
+from google.appengine.ext import testbed
+
+class NotifyWaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.pages = backends.InProcessChannelBackend()
+        waveChannels.setBackend(self.pages)
+
+    def tearDown(self):
+        waveChannels.setBackend(None)
+        self.testbed.deactivate()
+
+    def _open(self, wave_id, email):
+        return waveChannels.openChannel(wave_id, "wavelet", email)
+
+    def testEachPageGetsOneMessage(self):
+        pages = [self._open("wave", "a@example.com"), self._open("wave", "b@example.com")]
+        waveChannels.notifyWave("wave", "wavelet")
+        for page in pages:
+            messages = self.pages.getMessages(page)
+            self.assertEquals(1, len(messages))
+            self.assertEquals({'waveid': "wave", 'waveletid': "wavelet"}, simplejson.loads(messages[0]))
+
+    def testPagesOfOneUserAreSeparateClients(self):
+        first = self._open("wave", "a@example.com")
+        second = self._open("wave", "a@example.com")
+        self.assertNotEquals(first, second)
+        waveChannels.notifyWave("wave", "wavelet")
+        self.assertEquals(1, len(self.pages.getMessages(first)))
+        self.assertEquals(1, len(self.pages.getMessages(second)))
+
+    def testPagesOfOtherWavesAreLeftAlone(self):
+        viewing = self._open("wave", "a@example.com")
+        elsewhere = self._open("other", "a@example.com")
+        waveChannels.notifyWave("wave", "wavelet")
+        self.assertEquals(1, len(self.pages.getMessages(viewing)))
+        self.assertEquals([], self.pages.getMessages(elsewhere))
+
+    def testQueuedNotifyLeavesThePushToATask(self):
+        page = self._open("wave", "a@example.com")
+        waveChannels.queueNotifyWave("wave", "wavelet")
+        self.assertEquals([], self.pages.getMessages(page))
+        tasks = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME).GetTasks("default")
+        self.assertEquals(1, len(tasks))
+
+    def testNothingIsOpenedWhenPushIsOff(self):
+        enabled = config.PUSH_ENABLED
+        config.PUSH_ENABLED = False
+        try:
+            self.assertEquals(None, self._open("wave", "a@example.com"))
+        finally:
+            config.PUSH_ENABLED = enabled
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -25,9 +25,11 @@ import config
 from dbtools import settingsTools
 from errors.interceptor import *
 from permission import rawTypes as pt_raw
+from security import requestContext
 from security.decorators import *
 import utils
 
+from waveto import waveletCache
 from waveto import waveRpc
 
 from waveapi import robot
@@ -56,19 +58,39 @@ class RenderWavePage(webapp.RequestHandler):
         self.auth_token = self.request.get("auth", "")
 
         logging.info("Request waveid: " + self.wave_id + " waveletid: " + self.wavelet_id + " email: " + self.email + " auth token: " + self.auth_token)
+        context = requestContext.get(self)
 
-        wavelet_details = waveRpc.retry_fetch_wavelet_json( config.HTTP_IMPORTANT_RETRY,
+        wavelet_details = waveletCache.fetch_wavelet_json(  config.HTTP_IMPORTANT_RETRY,
                                                             mrray,
                                                             self.wave_id,
                                                             self.wavelet_id)
-        settingsTools.markSeenChanges(key={ 'wave_id'   : self.wave_id,
-                                            'wavelet_id': self.wavelet_id,
-                                            'email'     : self.email})
+        context.setSettings(settingsTools.markSeenChanges(session=context.getSession()))
+        
+        #Built once for both the etag and the page
+        user_fields = utils.construct_user_fields(  self.wave_id,
+                                                    self.wavelet_id,
+                                                    self.email,
+                                                    session=context.getSession(),
+                                                    settings=context.getSettings())
+
+        #The page changes with the wavelet or when a new version is deployed
+        etag = '"' + utils.construct_wavelet_etag(  wavelet_details,
+                                                    self.wave_id,
+                                                    self.wavelet_id,
+                                                    self.email,
+                                                    user_fields=user_fields) + \
+                "-" + os.environ.get('CURRENT_VERSION_ID', '') + '"'
+        self.response.headers['ETag'] = etag
+        if self.request.headers.get('If-None-Match', None) == etag:
+            self.response.set_status(304)
+            return
+        
         wavelet_json = utils.construct_wavelet_json_for_http_response(  wavelet_details,
                                                                         self.wave_id,
                                                                         self.wavelet_id,
                                                                         self.email,
-                                                                        b64Encode=True)
+                                                                        b64Encode=True,
+                                                                        user_fields=user_fields)
         self._renderWavePage(wavelet_json)
 
     def _renderWavePage(self, wavelet_json):
@@ -92,6 +114,9 @@ if __name__=="__main__":
 
     mrray = robot.Robot(config.ROBOT_IDENT)
     mrray.setup_oauth(config.CONSUMER_KEY, config.CONSUMER_SECRET, server_rpc_base=config.WAVE_SERVER_RPC)
+    transport = waveRpc.get_http_transport()
+    if transport:
+        mrray.http_post = transport.post
 
     run_wsgi_app(   webapp.WSGIApplication(
                                             [('/wave', RenderWavePage)]
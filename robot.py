@@ -20,13 +20,10 @@ Handles all requests coming from the wave interface
 import logging
 
 import config
-import emailInterface
 import gadgetHandler
-from dbtools import settingsTools
-from dbtools import sessionTools
 from dbtools import waveTools
-from permission import rawTypes as pt_raw
-from security import sessionCreation
+import notifications
+from push import waveChannels
 import utils
 
 from waveapi import appengine_robot_runner
@@ -34,9 +31,9 @@ from waveapi import element
 from waveapi import events
 from waveapi import robot
 
+from waveto import waveletCache
 from waveto import waveletTools
-
-from google.appengine.ext import deferred
+from waveto import waveRpc
 
 mrray = None
 
@@ -99,6 +96,7 @@ def OnBlipSubmitted(event, wavelet):
         return
     logging.info('OnBlipSubmitted')
     
+    waveletCache.invalidate(wavelet.wave_id, wavelet.wavelet_id)
     updateUsers(event, wavelet)
 
 def OnParticpantsChanged(event, wavelet):
@@ -114,6 +112,9 @@ def OnParticpantsChanged(event, wavelet):
         return
     logging.info("OnParticipantsChanged")
     
+    waveletCache.invalidate(wavelet.wave_id, wavelet.wavelet_id)
+    waveChannels.queueNotifyWave(wavelet.wave_id, wavelet.wavelet_id)
+    
     root_blip = waveletTools.getRootBlip(wavelet)
     if root_blip:
         add_participants_gadget_v2 = root_blip.first(element.Gadget, url=config.ADD_PARTICIPANTS_GADGET_URL2)
@@ -130,26 +131,14 @@ def updateUsers(event, wavelet):
     blip_id = None
     if event.blip:
         blip_id = event.blip.blip_id
-    sessions = sessionTools.fetch(wavelet.wave_id, wavelet.wavelet_id)
-    for userSession in sessions:
-        if sessionTools.isPublic(userSession):
-            continue
-        #Dispatch e-mail if these are new changes
-        userSettings = settingsTools.get(userSession)
-        if userSettings and not userSettings.unseen_changes and not userSettings.rw_permission == pt_raw.RW['DELETED']:
-            deferred.defer( emailInterface.sendNotificationEmail,
-                            sessionCreation.regenerateUser( wavelet.wave_id,
-                                                            wavelet.wavelet_id,
-                                                            userSession.email   ),
-                            wavelet.wave_id,
-                            wavelet.wavelet_id,
-                            userSession.email,
-                            event.modified_by,
-                            wavelet.title)
-            settingsTools.markUnseenChanges(session=userSession)
-
-        #Update each users blip unread status
-        settingsTools.blipChanges(blip_id, session=userSession)
+    #The participants, and anyone looking at the wave, are worked through in a
+    #task so this takes the same time however many there are
+    notifications.queueNotifyParticipants(  wavelet.wave_id,
+                                            wavelet.wavelet_id,
+                                            wavelet.title,
+                                            event.modified_by,
+                                            blip_id=blip_id,
+                                            push=True)
 
 
 def ProfileHandler(name):
@@ -184,4 +173,4 @@ if __name__=='__main__':
     mrray.register_handler(events.WaveletParticipantsChanged, OnParticpantsChanged, context="ROOT")
     mrray.register_profile_handler(ProfileHandler)
     
-    appengine_robot_runner.run(mrray, debug=True)
+    appengine_robot_runner.run(mrray, debug=True, transport=waveRpc.get_http_transport())
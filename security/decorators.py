@@ -16,17 +16,12 @@ limitations under the License.
 '''
 Collection of security decorators used to authenticate/deny etc
 '''
-import cgi
 import logging
-import urllib
 
-from dbtools import sessionTools
-from dbtools import settingsTools
 from errors import friendlyCodes as eCodes
 from errors import output as eOutput
 from permission.readWrite import rwPermission
-
-from waveapi import simplejson
+import requestContext
 
 class isAuthenticated(object):
     '''
@@ -47,10 +42,9 @@ class isAuthenticated(object):
     def __call__(self, function):
         def decorated_function(*args, **kwargs):
             handler = args[0]
-            credentials = getAuthenticationValuesFromRequest(handler)
-            session = sessionTools.get( credentials['wave_id'],
-                                        credentials['wavelet_id'],
-                                        credentials['email'])
+            context = requestContext.get(handler)
+            credentials = context.getCredentials()
+            session = context.getSession()
             if session and session.auth_token == credentials['auth']:
                 logging.info("Request authenticated")
                 return function(*args, **kwargs)
@@ -99,19 +93,11 @@ class hasPermission(object):
     
     def getSettings(self, handler):
         '''
-        Fetches the settings object for this user
+        Fetches the settings object for this user from the request context
         @param handler: the webapp handler
         @return the settings object or None if it could not be found
         '''
-        credentials = getAuthenticationValuesFromRequest(handler)
-        session = sessionTools.get( credentials['wave_id'],
-                                    credentials['wavelet_id'],
-                                    credentials['email'])
-        if session:
-            settings = settingsTools.get(session)
-            if settings:
-                return settings
-        return None
+        return requestContext.get(handler).getSettings()
     
     def returnUnknownError(self, handler):
         '''
@@ -154,17 +140,4 @@ def getAuthenticationValuesFromRequest(requestHandler):
     @param requestHandler: the request object to extract the values from
     @return a dict containing {wave_id, wavelet_id, email, auth}
     '''
-    
-    #Load the json if it is available
-    try:
-        json = simplejson.loads(cgi.escape(requestHandler.request.body))
-    except:
-        json = {}
-
-    #Take either the values from the url or from the json
-    return {
-    "wave_id"   : requestHandler.request.get("waveid", urllib.unquote(json.get("waveid", ""))),
-    "wavelet_id": requestHandler.request.get("waveletid", urllib.unquote(json.get("waveletid", ""))),
-    "email"     : requestHandler.request.get("email", urllib.unquote(json.get("email", ""))),
-    "auth"      : requestHandler.request.get("auth", urllib.unquote(json.get("auth", "")))
-    }
\ No newline at end of file
+    return requestContext.get(requestHandler).getCredentials()
@@ -0,0 +1,128 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Holds the values that are loaded while handling a single request so the
+decorators, the handler and the response construction can share them. The
+request body is parsed once and the users session and settings are fetched
+at most once per request
+'''
+import cgi
+import urllib
+
+from dbtools import sessionTools
+from dbtools import settingsTools
+
+from waveapi import simplejson
+
+_NOT_LOADED = object()
+
+def get(handler):
+    '''
+    Fetches the context for the request being handled, creating it if this
+    is the first time it has been asked for. webapp creates a new handler for
+    each request so the context lives on the handler
+    @param handler: the webapp handler
+    @return the RequestContext for this request
+    '''
+    context = getattr(handler, 'request_context', None)
+    if context == None:
+        context = RequestContext(handler.request)
+        handler.request_context = context
+    return context
+
+class RequestContext(object):
+    '''
+    Identity map for a single request. Values are loaded the first time they
+    are asked for and the same object is returned from then on
+    '''
+    def __init__(self, request):
+        '''
+        @param request: the webapp request being handled
+        '''
+        self._request = request
+        self._body = _NOT_LOADED
+        self._body_error = None
+        self._credentials = None
+        self._session = _NOT_LOADED
+        self._settings = _NOT_LOADED
+
+    def getBody(self, strict=False):
+        '''
+        @param strict=False: set to true to raise the decoding error if the body
+        could not be parsed
+        @return the json body of the request or None if it could not be parsed
+        '''
+        if self._body is _NOT_LOADED:
+            try:
+                self._body = simplejson.loads(cgi.escape(self._request.body))
+            except Exception, e:
+                self._body = None
+                self._body_error = e
+        if strict and not self._body_error == None:
+            raise self._body_error
+        return self._body
+
+    def getCredentials(self):
+        '''
+        Fetches the wave id, wavelet id, email and auth token from the request
+        using whichever means are possible. If they cannot be found an empty
+        string is used for each
+        @return a dict containing {wave_id, wavelet_id, email, auth}
+        '''
+        if self._credentials == None:
+            json = self.getBody()
+            if not isinstance(json, dict):
+                json = {}
+            #Take either the values from the url or from the json
+            self._credentials = {
+            "wave_id"   : self._request.get("waveid", urllib.unquote(json.get("waveid", ""))),
+            "wavelet_id": self._request.get("waveletid", urllib.unquote(json.get("waveletid", ""))),
+            "email"     : self._request.get("email", urllib.unquote(json.get("email", ""))),
+            "auth"      : self._request.get("auth", urllib.unquote(json.get("auth", "")))
+            }
+        return self._credentials
+
+    def getSession(self):
+        '''
+        @return the session of the user making the request or None if it
+        couldn't be found
+        '''
+        if self._session is _NOT_LOADED:
+            credentials = self.getCredentials()
+            self._session = sessionTools.get(   credentials['wave_id'],
+                                                credentials['wavelet_id'],
+                                                credentials['email'])
+        return self._session
+
+    def getSettings(self):
+        '''
+        @return the settings of the user making the request or None if they
+        couldn't be found
+        '''
+        if self._settings is _NOT_LOADED:
+            self._settings = settingsTools.get(self.getSession())
+        return self._settings
+
+    def setSettings(self, settings):
+        '''
+        Replaces the settings held for this request. Call this with the
+        settings returned by the settingsTools mutators so the rest of the
+        request sees the change
+        @param settings: the updated settings
+        '''
+        if not settings == None:
+            self._settings = settings
@@ -23,11 +23,14 @@ import uuid
 
 import config
 
+from dbtools import rosterTools
 from dbtools import settingsTools
 from dbtools import sessionTools
 from dbtools.models import Settings
 from dbtools.models import Session
 
+from google.appengine.ext import db
+
 
 def generateNewUser(wave_id, wavelet_id, email, rw_permission):
     '''
@@ -41,59 +44,64 @@ def generateNewUser(wave_id, wavelet_id, email, rw_permission):
     '''
     #We don't want duplicates so we need to check for the sesison first. If
     #we do find an existing user we need to apply the default settings
-    session = sessionTools.get(wave_id, wavelet_id, email)
+    session = sessionTools.get(wave_id, wavelet_id, email, local=False)
     if session:
         logging.info("Found existing user with same credentials. Updating")
         auth_token = session.auth_token
         session.version = 2
+    else:
+        auth_token = _generateAuthToken()
+        logging.info("Creating new token with auth code " + auth_token)
+        session = Session(  wave_id         =   wave_id,
+                            wavelet_id      =   wavelet_id,
+                            email           =   email,
+                            auth_token      =   auth_token,
+                            version         =   2,
+                            key_name        =   sessionTools.generateKey(   wave_id,
+                                                                            wavelet_id,
+                                                                            email))
+
+    def worker(session):
+        '''
+        @transaction_safe
+        '''
         sessionTools.put(session)
-        
-        settings = settingsTools.get(session)
+        settings = settingsTools.get(session, local=False)
         if settings:
             settings.unseen_changes = True
             settings.rw_permission = rw_permission
         else:
             settings = Settings(unseen_changes  =   True,
                                 rw_permission   =   rw_permission,
-                                parent          =   parent,
+                                parent          =   session,
                                 key_name        =   settingsTools.generateKey(  wave_id,
                                                                                 wavelet_id,
                                                                                 email))
         settingsTools.put(settings, wave_id, wavelet_id, email)
-    else:
-        auth_token = _generateAuthToken()
-        logging.info("Creating new token with auth code " + auth_token)
-        session = Session(  wave_id         =   wave_id,
-                            wavelet_id      =   wavelet_id,
-                            email           =   email,
-                            auth_token      =   auth_token,
-                            version         =   2)
-        sessionTools.put(session)
+        rosterTools.updateEntry(session, settings)
 
-        settings = Settings(unseen_changes  =   True,
-                            rw_permission   =   rw_permission,
-                            parent          =   session,
-                            key_name        =   settingsTools.generateKey(  wave_id,
-                                                                            wavelet_id,
-                                                                            email))
-        settingsTools.put(settings, wave_id, wavelet_id, email)
+    #The session and settings are one entity group and the roster another
+    db.run_in_transaction_options(db.create_transaction_options(xg=True), worker, session)
     
     return _generateUrl(wave_id, wavelet_id, email, auth_token)
     
 
-def regenerateUser(wave_id, wavelet_id, email):
+def regenerateUser(wave_id, wavelet_id, email, auth_token=None):
     '''
     Fetches the database entry for this user and regenerates their unique url
     @param wave_id: the id of the wave to generate the link for
     @param wavelet_id: the id of the wavelet to generate the link for
     @param email: the email address to generate the link for
+    @param auth_token=None: the users auth token if it is already known, such
+    as from the waves roster. Saves fetching the session
     @return unique url for this user and wave
     '''
-    session = sessionTools.get(wave_id, wavelet_id, email)
-    return _generateUrl(session.wave_id,
-                        session.wavelet_id,
-                        session.email,
-                        session.auth_token)
+    if auth_token == None:
+        auth_token = sessionTools.get(wave_id, wavelet_id, email).auth_token
+    return _generateUrl(wave_id,
+                        wavelet_id,
+                        email,
+                        auth_token)
 
 def _generateUrl(wave_id, wavelet_id, email, auth_token):
     '''
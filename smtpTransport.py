@@ -0,0 +1,270 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Sends mail through an SMTP server for when the app isn't run on App Engine.
+Connections are authenticated once and kept open in a pool, so each message
+after the first on a connection costs a single MAIL, RCPT and DATA exchange
+rather than a new connection, TLS handshake and login. When the server
+supports PIPELINING, MAIL, RCPT and DATA are sent together so that exchange
+takes one round trip rather than three. A connection is retired after
+SMTP_MAX_MESSAGES_PER_CONNECTION messages, and one that has been dropped by
+the server is replaced and the message sent again. A message the server
+refuses leaves the connection in the pool.
+
+Select it by setting config.MAIL_TRANSPORT to "smtp"
+'''
+import email.utils
+import logging
+import smtplib
+import socket
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import config
+
+#SMTP replies that mean the server is throttling us rather than failing
+_THROTTLED_CODES = [421, 450, 451, 452]
+
+#The reply sent when the server is closing the connection
+_CLOSING_CODE = 421
+
+class ThrottledError(Exception):
+    '''
+    Raised when the SMTP server is refusing mail for now
+    '''
+    pass
+
+class SmtpMailTransport(object):
+    '''
+    Sends mail over a pool of persistent SMTP connections
+    '''
+    throttled_errors = (ThrottledError,)
+
+    def __init__(self, host, port, username=None, password=None, use_tls=False, pool_size=4, max_messages=100):
+        '''
+        @param host: the host of the SMTP server
+        @param port: the port of the SMTP server
+        @param username=None: the user to log in as or None to send without
+        logging in
+        @param password=None: the password of the user
+        @param use_tls=False: set to True to upgrade each connection with
+        STARTTLS before logging in
+        @param pool_size=4: the most idle connections to keep open
+        @param max_messages=100: the most messages to send on one connection
+        before replacing it
+        '''
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._use_tls = use_tls
+        self._pool_size = pool_size
+        self._max_messages = max_messages
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        '''
+        @param message: a dict containing sender, to, subject, body and html
+        '''
+        from_address = email.utils.parseaddr(message['sender'])[1]
+        to_address = email.utils.parseaddr(message['to'])[1]
+        content = _buildMessage(message).as_string()
+
+        connection = self._acquire()
+        try:
+            try:
+                _sendmail(connection, from_address, to_address, content)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                #The server closed the idle connection. Try once on a new one
+                logging.info("SMTP connection to " + self._host + " lost. Reconnecting")
+                self._close(connection)
+                connection = None
+                connection = self._connect()
+                _sendmail(connection, from_address, to_address, content)
+        except smtplib.SMTPRecipientsRefused, e:
+            #The transaction was reset so the connection can still be used
+            self._release(connection)
+            code = e.recipients[to_address][0]
+            if code in _THROTTLED_CODES:
+                raise ThrottledError(str(e))
+            raise
+        except smtplib.SMTPResponseException, e:
+            #Only a reply closing the connection means it can't be used again
+            if e.smtp_code == _CLOSING_CODE:
+                self._discard(connection)
+            elif connection:
+                self._release(connection)
+            if e.smtp_code in _THROTTLED_CODES:
+                raise ThrottledError(str(e))
+            raise
+        except:
+            self._discard(connection)
+            raise
+        connection.sent += 1
+        self._release(connection)
+
+    def close(self):
+        '''
+        Closes every idle connection
+        '''
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for connection in idle:
+            self._close(connection)
+
+    def _acquire(self):
+        '''
+        @return an idle connection from the pool or a new one if there are none
+        '''
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._lock.release()
+        return self._connect()
+
+    def _release(self, connection):
+        '''
+        Returns a connection to the pool, closing it if the pool is full or it
+        has sent its share of messages
+        @param connection: the connection to return
+        '''
+        if connection.sent < self._max_messages:
+            self._lock.acquire()
+            try:
+                if len(self._idle) < self._pool_size:
+                    self._idle.append(connection)
+                    return
+            finally:
+                self._lock.release()
+        self._close(connection)
+
+    def _connect(self):
+        '''
+        @return a new connection, logged in if a username was given
+        '''
+        connection = smtplib.SMTP(self._host, self._port)
+        connection.ehlo()
+        if self._use_tls:
+            connection.starttls()
+            connection.ehlo()
+        if not self._username == None:
+            connection.login(self._username, self._password)
+        connection.sent = 0
+        return connection
+
+    def _discard(self, connection):
+        '''
+        @param connection: a broken connection to close, or None if the
+        replacement for one couldn't be opened
+        '''
+        if connection:
+            self._close(connection)
+
+    def _close(self, connection):
+        '''
+        @param connection: the connection to close. Errors are ignored as the
+        connection may already be broken
+        '''
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+
+def fromConfig():
+    '''
+    @return an SmtpMailTransport using the SMTP settings in config
+    '''
+    return SmtpMailTransport(   config.SMTP_HOST,
+                                config.SMTP_PORT,
+                                username=config.SMTP_USERNAME,
+                                password=config.SMTP_PASSWORD,
+                                use_tls=config.SMTP_USE_TLS,
+                                pool_size=config.SMTP_POOL_SIZE,
+                                max_messages=config.SMTP_MAX_MESSAGES_PER_CONNECTION)
+
+def _sendmail(connection, from_address, to_address, content):
+    '''
+    Sends one message, pipelining MAIL, RCPT and DATA if the server allows it.
+    Raises the same errors as smtplib.SMTP.sendmail and, like it, resets the
+    transaction when the server refuses the message
+    @param connection: the connection to send on
+    @param from_address: the envelope sender
+    @param to_address: the envelope recipient
+    @param content: the message as a string
+    '''
+    if not connection.has_extn('pipelining'):
+        connection.sendmail(from_address, [to_address], content)
+        return
+
+    connection.send("mail FROM:" + smtplib.quoteaddr(from_address) + "\r\n" +
+                    "rcpt TO:" + smtplib.quoteaddr(to_address) + "\r\n" +
+                    "data\r\n")
+    mail_code, mail_reply = connection.getreply()
+    rcpt_code, rcpt_reply = connection.getreply()
+    data_code, data_reply = connection.getreply()
+    if data_code == 354 and (not mail_code == 250 or not rcpt_code in [250, 251]):
+        #The server is waiting for a message it will refuse. End it empty
+        connection.send(".\r\n")
+        connection.getreply()
+    if not mail_code == 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_reply, from_address)
+    if not rcpt_code in [250, 251]:
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused({to_address : (rcpt_code, rcpt_reply)})
+    if not data_code == 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(data_code, data_reply)
+
+    data = smtplib.quotedata(content)
+    if not data.endswith("\r\n"):
+        data += "\r\n"
+    connection.send(data + ".\r\n")
+    code, reply = connection.getreply()
+    if not code == 250:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, reply)
+
+def _buildMessage(message):
+    '''
+    @param message: a dict containing sender, to, subject, body and html
+    @return a multipart MIME message with the plain and html bodies
+    '''
+    mime = MIMEMultipart('alternative')
+    mime['From'] = message['sender']
+    mime['To'] = message['to']
+    mime['Subject'] = message['subject']
+    mime.attach(MIMEText(_encode(message['body']), 'plain', 'utf-8'))
+    mime.attach(MIMEText(_encode(message['html']), 'html', 'utf-8'))
+    return mime
+
+def _encode(text):
+    '''
+    @param text: a unicode or utf-8 encoded string
+    @return the text as a utf-8 encoded string
+    '''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
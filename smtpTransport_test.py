@@ -0,0 +1,198 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Unit tests for smtpTransport against a local SMTP server that keeps the mail
+it is sent in memory
+'''
+import asyncore
+import smtpd
+import smtplib
+import threading
+import unittest
+
+import smtpTransport
+
+MESSAGE = { 'sender'    :   "Mr Ray <noreply@example.com>",
+            'to'        :   "a@example.com",
+            'subject'   :   "subject",
+            'body'      :   u"body \xe9",
+            'html'      :   "<p>body</p>"}
+
+class LocalSmtpChannel(smtpd.SMTPChannel):
+    '''
+    Adds EHLO with PIPELINING to smtpd, refuses the recipients the server
+    names and records each chunk read from the client
+    '''
+    def __init__(self, server, conn, addr):
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+        self.local_server = server
+
+    def smtp_EHLO(self, arg):
+        if not self.local_server.pipelining:
+            self.push('502 Error: command "EHLO" not implemented')
+            return
+        self.push('250-localhost')
+        self.push('250 PIPELINING')
+
+    def smtp_RCPT(self, arg):
+        for address in self.local_server.refused:
+            if address in arg:
+                self.push('550 No such user')
+                return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+    def recv(self, buffer_size):
+        data = smtpd.SMTPChannel.recv(self, buffer_size)
+        self.local_server.reads.append(data)
+        return data
+
+class LocalSmtpServer(smtpd.SMTPServer):
+    '''
+    An SMTP server on a free local port that keeps the mail it is sent in
+    received rather than delivering it
+    '''
+    def __init__(self, pipelining=True, refused=()):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.pipelining = pipelining
+        self.refused = refused
+        self.received = []
+        self.reads = []
+        self._thread = None
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            LocalSmtpChannel(self, pair[0], pair[1])
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append({  'from'  :   mailfrom,
+                                'to'    :   rcpttos,
+                                'data'  :   data})
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        asyncore.close_all()
+        self._thread.join()
+
+class ReplyingSmtpServer(LocalSmtpServer):
+    '''
+    Answers every message with the same error reply
+    '''
+    def __init__(self, reply):
+        LocalSmtpServer.__init__(self)
+        self.reply = reply
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        return self.reply
+
+class SmtpMailTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.transport = None
+
+    def tearDown(self):
+        if self.transport:
+            self.transport.close()
+        if self.server:
+            self.server.stop()
+
+    def start(self, server, **kwargs):
+        '''
+        Starts the server and a transport that counts the connections it opens
+        '''
+        self.server = server
+        self.server.start()
+        self.transport = smtpTransport.SmtpMailTransport("127.0.0.1", self.server.port, **kwargs)
+        self.connections = 0
+        connect = self.transport._connect
+        def countingConnect():
+            self.connections += 1
+            return connect()
+        self.transport._connect = countingConnect
+
+    def testReusesConnection(self):
+        self.start(LocalSmtpServer())
+        for i in range(0, 5):
+            self.transport.send(MESSAGE)
+        self.assertEquals(5, len(self.server.received))
+        self.assertEquals(1, self.connections)
+        self.assertEquals("noreply@example.com", self.server.received[0]['from'])
+        self.assertEquals(["a@example.com"], self.server.received[0]['to'])
+
+    def testPipelinesTheEnvelope(self):
+        self.start(LocalSmtpServer())
+        self.transport.send(MESSAGE)
+        envelopes = [data for data in self.server.reads if data.lower().startswith("mail from")]
+        self.assertEquals(1, len(envelopes))
+        self.assertTrue("rcpt to" in envelopes[0].lower())
+        self.assertTrue(envelopes[0].lower().endswith("data\r\n"))
+
+    def testSendsWithoutPipelining(self):
+        self.start(LocalSmtpServer(pipelining=False))
+        self.transport.send(MESSAGE)
+        self.transport.send(MESSAGE)
+        self.assertEquals(2, len(self.server.received))
+        self.assertEquals(1, self.connections)
+
+    def testReplacesConnectionAfterMaxMessages(self):
+        self.start(LocalSmtpServer(), max_messages=2)
+        for i in range(0, 5):
+            self.transport.send(MESSAGE)
+        self.assertEquals(5, len(self.server.received))
+        self.assertEquals(3, self.connections)
+
+    def testReconnectsAfterDrop(self):
+        self.start(LocalSmtpServer())
+        self.transport.send(MESSAGE)
+        #The pooled connection goes away while it is idle
+        self.transport._idle[0].close()
+        self.transport.send(MESSAGE)
+        self.assertEquals(2, len(self.server.received))
+        self.assertEquals(2, self.connections)
+        self.transport.send(MESSAGE)
+        self.assertEquals(2, self.connections)
+
+    def testThrottlingKeepsTheConnection(self):
+        self.start(ReplyingSmtpServer("452 Too many messages"))
+        self.assertRaises(smtpTransport.ThrottledError, self.transport.send, MESSAGE)
+        self.assertEquals(1, len(self.transport._idle))
+
+    def testRefusedMessageKeepsTheConnection(self):
+        self.start(ReplyingSmtpServer("554 Message refused"))
+        self.assertRaises(smtplib.SMTPDataError, self.transport.send, MESSAGE)
+        self.assertRaises(smtplib.SMTPDataError, self.transport.send, MESSAGE)
+        self.assertEquals(1, self.connections)
+
+    def testRefusedRecipientKeepsTheConnection(self):
+        self.start(LocalSmtpServer(refused=["gone@example.com"]))
+        refused = dict(MESSAGE)
+        refused['to'] = "gone@example.com"
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self.transport.send, refused)
+        self.transport.send(MESSAGE)
+        self.assertEquals(1, len(self.server.received))
+        self.assertEquals(["a@example.com"], self.server.received[0]['to'])
+        self.assertEquals(1, self.connections)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Methods for queueing many deferred tasks at once. deferred.defer makes a task
+queue call for every task, these build the tasks first and add them in
+batches
+'''
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+#The url the deferred handler is mapped to in app.yaml
+DEFERRED_URL = "/_ah/queue/deferred"
+
+#The most tasks the task queue accepts in a single add
+MAX_BATCH_SIZE = 100
+
+def task(function, *args, **kwargs):
+    '''
+    Builds a task that runs a function with the deferred handler, in the
+    same way as deferred.defer but without adding it
+    @param function: a module level function to run
+    @param _name=None: the name of the task
+    @param _countdown=None: the seconds to wait before running the task
+    @return the task
+    '''
+    name = kwargs.pop('_name', None)
+    countdown = kwargs.pop('_countdown', None)
+    return taskqueue.Task(  payload     =   deferred.serialize(function, *args, **kwargs),
+                            url         =   DEFERRED_URL,
+                            headers     =   {'Content-Type': 'application/octet-stream'},
+                            name        =   name,
+                            countdown   =   countdown)
+
+def add_multi(tasks):
+    '''
+    Adds many tasks to the default queue with as few calls as possible.
+    Named tasks that have already been added are skipped
+    @param tasks: the list of tasks to add
+    @return a list of the named tasks that weren't added because a task with
+    the same name has already run
+    '''
+    tombstoned = []
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), MAX_BATCH_SIZE):
+        batch = tasks[i:i + MAX_BATCH_SIZE]
+        try:
+            queue.add(batch)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            #Find out which ones were refused by adding the rest one at a time
+            for batch_task in batch:
+                if batch_task.was_enqueued:
+                    continue
+                try:
+                    queue.add(batch_task)
+                except taskqueue.TaskAlreadyExistsError:
+                    pass
+                except taskqueue.TombstonedTaskError:
+                    tombstoned.append(batch_task)
+    return tombstoned
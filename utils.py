@@ -17,14 +17,19 @@ limitations under the License.
 Collection of commonly widely used methods
 '''
 import base64
+import hashlib
 
 import config
+from dbtools import readReceipts
+from dbtools import readState
 from dbtools import settingsTools
 from dbtools import sessionTools
 from dbtools import waveTools
 
 from waveapi import simplejson
 
+from waveto import waveletTools
+
 def getProxyForFromEmail(email):
     '''
     Returns the proxy for name from a given email address
@@ -87,7 +92,7 @@ def getNameFromPublicProxyFor(proxyfor):
         return proxyfor[0:index]
     
 
-def construct_wavelet_json_for_http_response(wavelet_data, wave_id, wavelet_id, email, b64Encode=False):
+def construct_wavelet_json_for_http_response(wavelet_data, wave_id, wavelet_id, email, b64Encode=False, known=None, session=None, settings=None, user_fields=None):
     '''
     Constructs the json that will be sent back through the http request from
     various elements
@@ -96,27 +101,145 @@ def construct_wavelet_json_for_http_response(wavelet_data, wave_id, wavelet_id,
     @param wavelet_id: the id of the wavelet
     @param email: the email of the user waiting for the response
     @param b64Encode=False: set to true if you want the response base64 encoded
+    @param known=None: the state the client already has. A dict containing
+    'blips' (blip id to version) and the 'digests' from its last response. If
+    provided only the changes since that state are returned
+    @param session=None: the users session if it has already been loaded
+    @param settings=None: the users settings if they have already been loaded
+    @param user_fields=None: the result of construct_user_fields if it has
+    already been built for this request
     
     @return the json to be sent to the webpage
     '''
-    #Fetch the required data from the datastore
-    session = sessionTools.get(wave_id, wavelet_id, email)
-    settings = settingsTools.get(session)
+    #Construct the outgoing json
+    if user_fields == None:
+        user_fields = construct_user_fields(wave_id, wavelet_id, email, session, settings)
+    wavelet_json = dict(user_fields)
+    wavelet_json['wavelet'] = wavelet_data.get("json")
+    digests = _construct_digests(wavelet_json)
+    etag = _construct_etag(wavelet_json['wavelet'], wavelet_json, digests)
+    if known:
+        wavelet_json = _construct_delta(wavelet_json, digests, known)
+    wavelet_json['digests'] = digests
+    wavelet_json['etag'] = etag
+    
+    if b64Encode:
+        return base64.b64encode(simplejson.dumps(wavelet_json))
+    else:
+        return simplejson.dumps(wavelet_json)
+
+def construct_wavelet_etag(wavelet_data, wave_id, wavelet_id, email, session=None, settings=None, user_fields=None):
+    '''
+    Constructs a validator for the response that would be sent to this user.
+    It changes whenever the wavelet or the users view of it changes and is
+    much cheaper to produce than the response itself
+    @param wavelet_data: the dict with the wavelet and wavelet json
+    @param wave_id: the id of the wave
+    @param wavelet_id: the id of the wavelet
+    @param email: the email of the user waiting for the response
+    @param session=None: the users session if it has already been loaded
+    @param settings=None: the users settings if they have already been loaded
+    @param user_fields=None: the result of construct_user_fields. Pass the
+    same fields to construct_wavelet_json_for_http_response so they are only
+    fetched once
+    
+    @return the etag for the response
+    '''
+    if user_fields == None:
+        user_fields = construct_user_fields(wave_id, wavelet_id, email, session, settings)
+    return _construct_etag( wavelet_data.get("json"),
+                            user_fields,
+                            _construct_digests(user_fields))
+
+def construct_user_fields(wave_id, wavelet_id, email, session=None, settings=None):
+    '''
+    Fetches the parts of the response that are specific to this user
+    @param wave_id: the id of the wave
+    @param wavelet_id: the id of the wavelet
+    @param email: the email of the user waiting for the response
+    @param session=None: the users session. Fetched if not supplied
+    @param settings=None: the users settings. Fetched if not supplied
+    
+    @return a dict containing readblips, profiles, isPublic and rwPermission
+    '''
+    #Fetch the required data from the datastore if it wasn't supplied
+    if session == None:
+        session = sessionTools.get(wave_id, wavelet_id, email)
+    if settings == None:
+        settings = settingsTools.get(session)
     waveMeta = waveTools.get(wave_id, wavelet_id)
     if waveMeta:
         participant_profiles = waveMeta.participant_profiles or {}
     else:
         participant_profiles = {}
     
-    #Construct the outgoing json
-    wavelet_json = {
-        'wavelet'       :   wavelet_data.get("json"),
-        'readblips'     :   settings.read_blips or [],
+    #Include the receipts that haven't been written to the datastore yet
+    read_blips = readState.getReadBlips(settings, waveTools.getBlipIds(waveMeta))
+    for blip_id in readReceipts.getPending(wave_id, wavelet_id, session.email):
+        if not blip_id in read_blips:
+            read_blips.append(blip_id)
+
+    return {
+        'readblips'     :   read_blips,
         'profiles'      :   participant_profiles,
         'isPublic'      :   sessionTools.isPublic(session),
         'rwPermission'  :   settings.rw_permission   
     }
-    if b64Encode:
-        return base64.b64encode(simplejson.dumps(wavelet_json))
-    else:
-        return simplejson.dumps(wavelet_json)
\ No newline at end of file
+
+def _construct_digests(user_fields):
+    '''
+    @param user_fields: the user specific fields of the response
+    @return a dict of the digest for each field that can be left out of a delta
+    '''
+    digests = {}
+    for field in _DELTA_DIGEST_FIELDS:
+        digests[field] = _digest(user_fields[field])
+    return digests
+
+def _construct_etag(raw_wavelet, user_fields, digests):
+    '''
+    @param raw_wavelet: the raw wavelet json from the wave server
+    @param user_fields: the user specific fields of the response
+    @param digests: the digests of the user specific fields
+    @return the etag identifying this version of the response
+    '''
+    wavelet_data = (raw_wavelet or {}).get('waveletData', None) or {}
+    return _digest([wavelet_data.get('lastModifiedTime', None),
+                    wavelet_data.get('version', None),
+                    user_fields['isPublic'],
+                    digests])
+
+#The fields that are only sent in a delta response if they have changed
+_DELTA_DIGEST_FIELDS = ['readblips', 'profiles', 'rwPermission']
+
+def _construct_delta(wavelet_json, digests, known):
+    '''
+    Reduces the full response json down to the changes since the state the
+    client already has
+    @param wavelet_json: the full response json
+    @param digests: the digests of the fields in the full response
+    @param known: the state the client already has
+    
+    @return the delta response json
+    '''
+    raw_wavelet = wavelet_json['wavelet'] or {}
+    changed, removed = waveletTools.getBlipChanges(raw_wavelet, known.get('blips', None) or {})
+    delta = {
+        'delta'         :   True,
+        'wavelet'       :   {   'waveletData'   :   raw_wavelet.get('waveletData'),
+                                'blips'         :   changed,
+                                'removedBlips'  :   removed},
+        'isPublic'      :   wavelet_json['isPublic']
+    }
+    known_digests = known.get('digests', None) or {}
+    for field in _DELTA_DIGEST_FIELDS:
+        if not known_digests.get(field, None) == digests[field]:
+            delta[field] = wavelet_json[field]
+    return delta
+
+def _digest(value):
+    '''
+    @param value: a json serializable value
+    @return a short digest of the value that changes when the value does
+    '''
+    return hashlib.md5(simplejson.dumps(value, sort_keys=True)).hexdigest()
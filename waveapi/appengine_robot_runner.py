@@ -164,7 +164,8 @@ def create_robot_webapp(robot, debug=False, extra_handlers=None):
                                 debug=debug)
 
 
-def run(robot, debug=False, log_errors=True, extra_handlers=None):
+def run(robot, debug=False, log_errors=True, extra_handlers=None,
+        transport=None):
   """Sets up the webapp handlers for this robot and starts listening.
 
     A robot is typically setup in the following steps:
@@ -190,12 +191,18 @@ def run(robot, debug=False, log_errors=True, extra_handlers=None):
           to install more handlers. For example, passing
             [('/about', AboutHandler),] would install an extra about handler
             for the robot.
+      transport: Optional http transport, such as an
+          http_pool.PooledHttpTransport, whose post method is used instead
+          of urlfetch for posting http.
   """
   # App Engine expects to construct a class with no arguments, so we
   # pass a lambda that constructs the appropriate handler with
   # arguments from the enclosing scope.
   if log_errors:
     robot.register_handler(events.OperationError, operation_error_handler)
-  robot.http_post = appengine_post
+  if transport:
+    robot.http_post = transport.post
+  else:
+    robot.http_post = appengine_post
   app = create_robot_webapp(robot, debug, extra_handlers)
   run_wsgi_app(app)
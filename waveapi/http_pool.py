@@ -0,0 +1,197 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Acknack Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Added by wave.to. A keep-alive http transport for robot rpcs.
+
+Robot.http_post opens a new connection for every rpc. On servers where
+the robot is not running on App Engine that means a new TCP (and TLS)
+handshake for each fetch or submit. PooledHttpTransport keeps idle
+connections open per host and reuses them. Install it through the
+http_post monkey patch point:
+
+  transport = http_pool.PooledHttpTransport()
+  robot.http_post = transport.post
+
+or pass it to appengine_robot_runner.run(robot, transport=transport).
+"""
+
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+
+class PooledHttpTransport(object):
+  """Posts http requests over pooled persistent connections.
+
+  Connections are pooled per (scheme, host, port). A connection is put
+  back in its pool once the response has been read completely, unless
+  the server asked for it to be closed. Connections that have been idle
+  for longer than idle_timeout are closed instead of being reused. If a
+  reused connection turns out to be stale, because the server closed it
+  before sending any response, the request is retried once on a new
+  connection. Nothing else is retried: after a timeout, or on a fresh
+  connection, the server may already have applied the request.
+
+  The transport counts what it does in the stats dictionary:
+    pool_hits: requests sent over a pooled connection.
+    new_connections: connections opened.
+    reconnects: requests retried because a pooled connection was stale.
+    expired: idle connections closed because of idle_timeout.
+    discarded: connections closed because the pool for their host was
+        full or the server closed them.
+  """
+
+  def __init__(self, max_idle_per_host=4, idle_timeout=60, timeout=10):
+    """Initializes the transport.
+
+    Args:
+      max_idle_per_host: the most idle connections kept open for each host.
+      idle_timeout: seconds an idle connection is kept before being closed.
+      timeout: socket timeout in seconds for new connections.
+    """
+    self._max_idle_per_host = max_idle_per_host
+    self._idle_timeout = idle_timeout
+    self._timeout = timeout
+    self._pools = {}
+    self._lock = threading.Lock()
+    self.stats = {'pool_hits': 0,
+                  'new_connections': 0,
+                  'reconnects': 0,
+                  'expired': 0,
+                  'discarded': 0}
+
+  def post(self, url, data, headers):
+    """Execute an http post. Signature matches Robot.http_post.
+
+    Args:
+        url: to post to
+        data: post body
+        headers: extra headers to pass along
+    Returns:
+        response_code, returned_page
+    """
+    scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+    if query:
+      path += '?' + query
+    key = (scheme, netloc)
+    conn = self._acquire(key)
+    if conn:
+      try:
+        return self._request(key, conn, path, data, headers)
+      except (httplib.HTTPException, socket.error), e:
+        conn.close()
+        if not _is_stale(e):
+          raise
+        self._count('reconnects')
+    return self._request(key, self._connect(key), path, data, headers)
+
+  def close(self):
+    """Closes all idle connections."""
+    self._lock.acquire()
+    try:
+      pools, self._pools = self._pools, {}
+    finally:
+      self._lock.release()
+    for pool in pools.values():
+      for conn, last_used in pool:
+        conn.close()
+
+  def _request(self, key, conn, path, data, headers):
+    """Sends the request and returns the connection to the pool."""
+    conn.request('POST', path, data, headers)
+    response = conn.getresponse()
+    content = response.read()
+    if response.will_close:
+      conn.close()
+      self._count('discarded')
+    else:
+      self._release(key, conn)
+    return response.status, content
+
+  def _connect(self, key):
+    """Opens a new connection for a (scheme, netloc) key."""
+    scheme, netloc = key
+    if scheme == 'https':
+      conn = httplib.HTTPSConnection(netloc, timeout=self._timeout)
+    else:
+      conn = httplib.HTTPConnection(netloc, timeout=self._timeout)
+    self._count('new_connections')
+    return conn
+
+  def _acquire(self, key):
+    """Returns an idle connection for key or None if there is none."""
+    now = time.time()
+    expired = []
+    conn = None
+    self._lock.acquire()
+    try:
+      pool = self._pools.get(key, [])
+      while pool:
+        candidate, last_used = pool.pop()
+        if now - last_used > self._idle_timeout:
+          expired.append(candidate)
+        else:
+          conn = candidate
+          self.stats['pool_hits'] += 1
+          break
+      self.stats['expired'] += len(expired)
+    finally:
+      self._lock.release()
+    for stale in expired:
+      stale.close()
+    return conn
+
+  def _release(self, key, conn):
+    """Puts a connection back in the pool for key."""
+    self._lock.acquire()
+    try:
+      pool = self._pools.setdefault(key, [])
+      if len(pool) < self._max_idle_per_host:
+        pool.append((conn, time.time()))
+        return
+      self.stats['discarded'] += 1
+    finally:
+      self._lock.release()
+    conn.close()
+
+  def _count(self, stat):
+    self._lock.acquire()
+    try:
+      self.stats[stat] += 1
+    finally:
+      self._lock.release()
+
+
+# Errors from a reused connection that mean the server closed it while it
+# was idle, before it read the new request.
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def _is_stale(error):
+  """Returns True if an error from a pooled connection means it was stale.
+
+  A timeout is never stale: the request may have reached the server.
+  """
+  if isinstance(error, socket.timeout):
+    return False
+  if isinstance(error, httplib.BadStatusLine):
+    return True
+  if isinstance(error, socket.error):
+    return len(error.args) > 0 and error.args[0] in _STALE_ERRNOS
+  return False
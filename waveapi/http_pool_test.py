@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Copyright 2011 Acknack Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the http_pool module."""
+
+import BaseHTTPServer
+import httplib
+import socket
+import threading
+import time
+import unittest
+
+import http_pool
+
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Keep-alive handler that echoes the posted body."""
+  protocol_version = 'HTTP/1.1'
+  requests = 0
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers['Content-Length']))
+    EchoHandler.requests += 1
+    if self.path == '/hangup':
+      # Closes the connection without responding
+      self.close_connection = 1
+      return
+    if self.path == '/slow':
+      time.sleep(0.5)
+    if self.path == '/drop':
+      # Closes the connection after responding without saying it will
+      self.close_connection = 1
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      return
+    if self.path == '/close':
+      self.close_connection = 1
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    if self.close_connection:
+      self.send_header('Connection', 'close')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TestPooledHttpTransport(unittest.TestCase):
+
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), EchoHandler)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.setDaemon(True)
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.transport = http_pool.PooledHttpTransport()
+    EchoHandler.requests = 0
+
+  def tearDown(self):
+    self.transport.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testReusesConnection(self):
+    for body in ['one', 'two', 'three']:
+      status, content = self.transport.post(self.url + '/rpc', body, {})
+      self.assertEquals(200, status)
+      self.assertEquals(body, content)
+    self.assertEquals(1, self.transport.stats['new_connections'])
+    self.assertEquals(2, self.transport.stats['pool_hits'])
+
+  def testServerClosesConnection(self):
+    self.transport.post(self.url + '/close', 'one', {})
+    self.transport.post(self.url + '/close', 'two', {})
+    self.assertEquals(2, self.transport.stats['new_connections'])
+    self.assertEquals(0, self.transport.stats['pool_hits'])
+    self.assertEquals(2, self.transport.stats['discarded'])
+
+  def testReconnectsOnStaleConnection(self):
+    self.transport.post(self.url + '/drop', 'one', {})
+    status, content = self.transport.post(self.url + '/rpc', 'two', {})
+    self.assertEquals('two', content)
+    self.assertEquals(1, self.transport.stats['reconnects'])
+    self.assertEquals(2, self.transport.stats['new_connections'])
+    self.assertEquals(2, EchoHandler.requests)
+
+  def testDoesNotRetryTimeout(self):
+    self.transport = http_pool.PooledHttpTransport(timeout=0.2)
+    self.transport.post(self.url + '/rpc', 'one', {})
+    self.assertRaises(socket.timeout,
+                      self.transport.post, self.url + '/slow', 'two', {})
+    time.sleep(0.5)
+    self.assertEquals(0, self.transport.stats['reconnects'])
+    self.assertEquals(2, EchoHandler.requests)
+
+  def testDoesNotRetryFreshConnection(self):
+    self.assertRaises(httplib.BadStatusLine,
+                      self.transport.post, self.url + '/hangup', 'one', {})
+    self.assertEquals(0, self.transport.stats['reconnects'])
+    self.assertEquals(1, EchoHandler.requests)
+
+  def testIdleTimeout(self):
+    self.transport = http_pool.PooledHttpTransport(idle_timeout=-1)
+    self.transport.post(self.url + '/rpc', 'one', {})
+    self.transport.post(self.url + '/rpc', 'two', {})
+    self.assertEquals(1, self.transport.stats['expired'])
+    self.assertEquals(0, self.transport.stats['pool_hits'])
+
+  def testMaxIdlePerHost(self):
+    self.transport = http_pool.PooledHttpTransport(max_idle_per_host=0)
+    self.transport.post(self.url + '/rpc', 'one', {})
+    self.assertEquals(1, self.transport.stats['discarded'])
+    self.assertEquals({}, dict((k, v) for k, v in
+                               self.transport._pools.items() if v))
+
+
+if __name__ == '__main__':
+  unittest.main()
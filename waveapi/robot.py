@@ -22,7 +22,9 @@ as well as some helper functions for web requests and responses.
 
 import base64
 import logging
+import Queue
 import sys
+import threading
 
 try:
   __import__('google3') # setup internal test environment
@@ -44,6 +46,39 @@ oauth = None
 DEFAULT_PROFILE_URL = (
     'http://code.google.com/apis/wave/extensions/robots/python-tutorial.html')
 
+class LazyWaveletData(dict):
+  """Added by wave.to. The dict returned by the *_wavelet_json fetches.
+
+  Holds the raw json under 'json'. The Wavelet object under 'wavelet' is
+  only built from the json the first time it is asked for, so callers
+  that only need the json don't pay for constructing every blip,
+  annotation and element.
+  """
+
+  def __init__(self, robot, json, proxy_for_id=None):
+    dict.__init__(self, json=json)
+    self._robot = robot
+    self._proxy_for_id = proxy_for_id
+
+  def _build(self, key):
+    if key == 'wavelet' and not dict.__contains__(self, 'wavelet'):
+      dict.__setitem__(self, 'wavelet', self._robot.blind_wavelet(
+          dict.__getitem__(self, 'json'), self._proxy_for_id))
+
+  def __getitem__(self, key):
+    self._build(key)
+    return dict.__getitem__(self, key)
+
+  def get(self, key, default=None):
+    self._build(key)
+    return dict.get(self, key, default)
+
+  def __contains__(self, key):
+    return key == 'wavelet' or dict.__contains__(self, key)
+
+  has_key = __contains__
+
+
 class Robot(object):
   """Robot metadata class.
 
@@ -455,13 +490,80 @@ class Robot(object):
   def fetch_wavelet_json(self, wave_id, wavelet_id, proxy_for_id=None):
     """
     Added by wave.to. A copy of fetch_wavelet that instead of returning
-    the wavelet it returns a dict containing the raw json and the wavelet.
+    the wavelet it returns a LazyWaveletData containing the raw json. The
+    wavelet is only built if 'wavelet' is asked for.
     """
     operation_queue = ops.OperationQueue(proxy_for_id)
     operation_queue.robot_fetch_wave(wave_id, wavelet_id)
     result = self._first_rpc_result(self.make_rpc(operation_queue))
-    wvlt = self._wavelet_from_json(result, ops.OperationQueue(proxy_for_id))
-    return {'json': result, 'wavelet': wvlt}
+    return LazyWaveletData(self, result, proxy_for_id)
+
+  def fetch_wavelets_many(self, ids, max_concurrency=4, proxy_for_id=None):
+    """
+    Added by wave.to. Fetches many wavelets, up to max_concurrency at once.
+
+    Each wavelet is fetched with fetch_wavelet_json on a pool of worker
+    threads. Results are yielded as they complete rather than in the order
+    of ids. An error fetching one wavelet is yielded with that wavelet and
+    does not stop the others being fetched. With a max_concurrency of 1, or
+    where threads can't be started, the wavelets are fetched serially.
+
+    Args:
+      ids: a list of (wave_id, wavelet_id) tuples to fetch.
+      max_concurrency: the most fetches to have in flight at once.
+      proxy_for_id: the proxying information that will be set on the
+          wavelets' operation queues.
+
+    Returns:
+      A generator of (wave_id, wavelet_id, wavelet_data, error) tuples.
+      wavelet_data is the LazyWaveletData returned by fetch_wavelet_json,
+      or None if the fetch raised error.
+    """
+    ids = list(ids)
+    work = Queue.Queue()
+    for wave_id, wavelet_id in ids:
+      work.put((wave_id, wavelet_id))
+    results = Queue.Queue()
+
+    workers = 0
+    if max_concurrency > 1:
+      for i in range(min(max_concurrency, len(ids))):
+        worker = threading.Thread(target=self._fetch_worker,
+                                  args=(work, results, proxy_for_id))
+        worker.setDaemon(True)
+        try:
+          worker.start()
+        except Exception, e:
+          logging.warn('Could not start fetch thread: %s', e)
+          break
+        workers += 1
+
+    if not workers:
+      # Fetch serially on this thread, yielding each result as it arrives.
+      for wave_id, wavelet_id in ids:
+        yield self._fetch_one(wave_id, wavelet_id, proxy_for_id)
+      return
+
+    for i in range(len(ids)):
+      yield results.get()
+
+  def _fetch_worker(self, work, results, proxy_for_id):
+    """Fetches wavelets from the work queue until it is empty."""
+    while True:
+      try:
+        wave_id, wavelet_id = work.get_nowait()
+      except Queue.Empty:
+        return
+      results.put(self._fetch_one(wave_id, wavelet_id, proxy_for_id))
+
+  def _fetch_one(self, wave_id, wavelet_id, proxy_for_id):
+    """Fetches a wavelet, returning a fetch_wavelets_many result tuple."""
+    try:
+      return (wave_id, wavelet_id,
+              self.fetch_wavelet_json(wave_id, wavelet_id, proxy_for_id),
+              None)
+    except Exception, e:
+      return wave_id, wavelet_id, None, e
 
   def blind_wavelet(self, json, proxy_for_id=None):
     """Construct a blind wave from a json string.
@@ -487,6 +589,42 @@ class Robot(object):
     """
     return self._wavelet_from_json(json, ops.OperationQueue(proxy_for_id))
 
+  def lazy_wavelet_data(self, json, proxy_for_id=None):
+    """
+    Added by wave.to. Wraps a wavelet json snapshot, such as one read from
+    a cache, in a LazyWaveletData. The blind wavelet is only built if
+    'wavelet' is asked for.
+    """
+    return LazyWaveletData(self, json, proxy_for_id)
+
+  def submit_and_fetch_wavelet_json(self, wavelet_to_submit, proxy_for_id=None):
+    """
+    Added by wave.to. Submits the pending operations associated with
+    wavelet_to_submit and fetches the updated wavelet in the same rpc.
+
+    The fetch is sent after the pending operations so the returned
+    snapshot includes their changes.
+
+    Returns:
+      A tuple of the results of the submitted operations and a
+      LazyWaveletData, as returned by fetch_wavelet_json.
+    """
+    pending = wavelet_to_submit.get_operation_queue()
+    fetch_queue = ops.OperationQueue(proxy_for_id)
+    fetch_op = fetch_queue.robot_fetch_wave(wavelet_to_submit.wave_id,
+                                            wavelet_to_submit.wavelet_id)
+    res = self.make_rpc(list(pending) + list(fetch_queue))
+    pending.clear()
+    logging.info('submit returned:%s', res)
+    if type(res) != list:
+      res = [res]
+    submit_results = [r for r in res if r.get('id') != fetch_op.id]
+    fetch_results = [r for r in res if r.get('id') == fetch_op.id]
+    if not fetch_results:
+      raise errors.Error('RPC Error: No fetch result.')
+    result = self._first_rpc_result(fetch_results)
+    return submit_results, LazyWaveletData(self, result, proxy_for_id)
+
   def submit(self, wavelet_to_submit):
     """Submit the pending operations associated with wavelet_to_submit.
 
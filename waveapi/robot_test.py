@@ -173,6 +173,63 @@ class TestRobot(unittest.TestCase):
     self.assertEquals(ops.WAVELET_APPEND_BLIP, operations[1]['method'])
     self.assertEquals('proxyid', operations[1]['params']['proxyingFor'])
 
+  def testSubmitAndFetchWaveletJson(self):
+    wavelet = self.robot.blind_wavelet(TEST_JSON)
+    wavelet.reply()
+    sent = []
+    def make_rpc(operations):
+      sent.extend(operations)
+      return [{'id': op.id, 'data': {}} for op in operations[:-1]] + [
+          {'id': operations[-1].id,
+           'data': simplejson.loads(TEST_JSON)}]
+    self.robot.make_rpc = make_rpc
+
+    submit_results, fetched = self.robot.submit_and_fetch_wavelet_json(wavelet)
+    self.assertEquals([ops.WAVELET_APPEND_BLIP, ops.ROBOT_FETCH_WAVE],
+                      [op.method for op in sent])
+    self.assertEquals(1, len(submit_results))
+    self.assertEquals(0, len(wavelet.get_operation_queue()))
+    self.assertEquals('A title', fetched['json']['wavelet']['title'])
+    self.assertEquals('test.com!wdykLROk*11', fetched['wavelet'].wave_id)
+
+  def testFetchWaveletJsonIsLazy(self):
+    self.robot.make_rpc = lambda ops: [{'data': simplejson.loads(TEST_JSON)}]
+    built = []
+    blind_wavelet = self.robot.blind_wavelet
+    def counting_blind_wavelet(json, proxy_for_id=None):
+      built.append(json)
+      return blind_wavelet(json, proxy_for_id)
+    self.robot.blind_wavelet = counting_blind_wavelet
+
+    fetched = self.robot.fetch_wavelet_json('test.com!wdykLROk*11',
+                                            'test.com!conv+root')
+    self.assertEquals('A title', fetched['json']['wavelet']['title'])
+    self.assertTrue('wavelet' in fetched)
+    self.assertEquals(0, len(built))
+    self.assertEquals('A title', fetched.get('wavelet').title)
+    self.assertTrue(fetched['wavelet'] is fetched.get('wavelet'))
+    self.assertEquals(1, len(built))
+
+  def testFetchWaveletsMany(self):
+    def make_rpc(operations):
+      wave_id = list(operations)[0].params['waveId']
+      if wave_id == 'bad':
+        return [{'error': {'code': 500, 'message': 'Not found'}}]
+      return [{'data': simplejson.loads(TEST_JSON)}]
+    self.robot.make_rpc = make_rpc
+
+    ids = [('good1', 'conv+root'), ('bad', 'conv+root'), ('good2', 'conv+root')]
+    for max_concurrency in [1, 3]:
+      results = list(self.robot.fetch_wavelets_many(ids, max_concurrency))
+      self.assertEquals(sorted(ids), sorted([r[:2] for r in results]))
+      for wave_id, wavelet_id, wavelet_data, error in results:
+        if wave_id == 'bad':
+          self.assertEquals(None, wavelet_data)
+          self.assertTrue(error is not None)
+        else:
+          self.assertEquals(None, error)
+          self.assertEquals('A title', wavelet_data['wavelet'].title)
+
   def testCapabilitiesHashIncludesContextAndFilter(self):
     robot1 = robot.Robot('Robot1')
     robot1.register_handler(events.WaveletSelfAdded, lambda: '')
@@ -19,6 +19,7 @@
 
 import blip_test
 import element_test
+import http_pool_test
 import module_test_runner
 import ops_test
 import robot_test
@@ -32,6 +33,7 @@ def RunUnitTests():
   test_runner.modules = [
       blip_test,
       element_test,
+      http_pool_test,
       ops_test,
       robot_test,
       util_test,
@@ -13,10 +13,40 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
+import base64
+import logging
+import time
+import uuid
+
+import config
+from dbtools import memcacheConfig
+
+from waveapi import http_pool
+
+from google.appengine.api import memcache
+
+_http_transport = None
+
+def get_http_transport():
+    '''
+    Returns the http transport robots should post rpcs with. The pooled
+    transport is shared by every robot in the instance so its connections
+    outlive a single request
+    @return a PooledHttpTransport if config.HTTP_TRANSPORT is "pooled",
+    otherwise None to keep the default transport
+    '''
+    global _http_transport
+    if not config.HTTP_TRANSPORT == "pooled":
+        return None
+    if _http_transport == None:
+        _http_transport = http_pool.PooledHttpTransport()
+    return _http_transport
+
 def retry_fetch_wavelet(retries, robot, wave_id, wavelet_id):
     '''
     Wrapper for fetch_wavelet. Retries a number of times before failing.
-    Excepts nicely if a known error is thrown
+    Excepts nicely if a known error is thrown. Concurrent fetches of the same
+    wavelet are coalesced into a single request to the wave server
     @param retries: the number of times to retry the request
     @param robot: the Wave robot object
     @param wave_id: the wave id to attempt to fetch
@@ -24,21 +54,13 @@ def retry_fetch_wavelet(retries, robot, wave_id, wavelet_id):
     
     @return the wavelet, or if it couldn't be fetched raises an exception
     '''
-    excep = None
-    for i in range(0, retries):
-        try:
-            return robot.fetch_wavelet(wave_id, wavelet_id)
-        except Exception, e:
-            excep = e
-            if excep.message.find("is not a participant of wave id") != -1:
-                raise NotParticipantException("User is not participant of Wave")
-
-    raise DownloadException("Problem downloading content from Wave server: ".join(excep.args))
+    return _single_flight_fetch(retries, robot, wave_id, wavelet_id).get('wavelet')
 
 def retry_fetch_wavelet_json(retries, robot, wave_id, wavelet_id):
     '''
     Wrapper for fetch_wavelet_json. Retries a number of times before failing
-    Excepts nicely if a known error is thrown
+    Excepts nicely if a known error is thrown. Concurrent fetches of the same
+    wavelet are coalesced into a single request to the wave server
     @param retries: the number of times to retry the request
     @param robot: the Wave robot object
     @param wave_id: the wave id to attempt to fetch
@@ -46,6 +68,53 @@ def retry_fetch_wavelet_json(retries, robot, wave_id, wavelet_id):
     
     @return the wavelet, or if it couldn't be fetched raises an exception
     '''
+    return _single_flight_fetch(retries, robot, wave_id, wavelet_id)
+
+def retry_fetch_wavelets_many(retries, robot, ids, max_concurrency=None):
+    '''
+    Wrapper for fetch_wavelets_many. Fetches many wavelets concurrently for
+    bulk jobs, retrying the wavelets that failed a number of times. Unlike
+    retry_fetch_wavelet the fetches are not coalesced with other requests
+    @param retries: the number of times to retry each wavelet
+    @param robot: the Wave robot object
+    @param ids: a list of (wave_id, wavelet_id) tuples to fetch
+    @param max_concurrency: the most fetches to have in flight at once.
+    Defaults to config.WAVELET_FETCH_MANY_CONCURRENCY
+
+    @return a generator of (wave_id, wavelet_id, wavelet json dict, error)
+    tuples in the order they complete. If a wavelet couldn't be fetched its
+    json dict is None and error is a NotParticipantException or
+    DownloadException
+    '''
+    if max_concurrency == None:
+        max_concurrency = config.WAVELET_FETCH_MANY_CONCURRENCY
+    pending = list(ids)
+    for i in range(0, retries):
+        failed = []
+        for wave_id, wavelet_id, wavelet_data, excep in robot.fetch_wavelets_many(pending, max_concurrency):
+            if excep == None:
+                yield (wave_id, wavelet_id, wavelet_data, None)
+            elif excep.message.find("is not a participant of wave id") != -1:
+                yield (wave_id, wavelet_id, None, NotParticipantException("User is not participant of Wave"))
+            elif i == retries - 1:
+                yield (wave_id, wavelet_id, None, DownloadException("Problem downloading content from Wave server: ".join(excep.args)))
+            else:
+                failed.append((wave_id, wavelet_id))
+        if not failed:
+            return
+        pending = failed
+
+def _retry_fetch_wavelet_json(retries, robot, wave_id, wavelet_id):
+    '''
+    Fetches the wavelet json from the wave server. Retries a number of times
+    before failing
+    @param retries: the number of times to retry the request
+    @param robot: the Wave robot object
+    @param wave_id: the wave id to attempt to fetch
+    @param wavelet_id: the wavelet id to attempt to fetch
+    
+    @return the wavelet json dict, or if it couldn't be fetched raises an exception
+    '''
     excep = None
     for i in range(0, retries):
         try:
@@ -57,6 +126,94 @@ def retry_fetch_wavelet_json(retries, robot, wave_id, wavelet_id):
 
     raise DownloadException("Problem downloading content from Wave server: ".join(excep.args))
 
+def _single_flight_fetch(retries, robot, wave_id, wavelet_id):
+    '''
+    Makes sure only one request fetches a wavelet at a time. The first request
+    takes out a lease in memcache and fetches the wavelet, publishing the
+    result under its lease for anyone else who wants it. Other requests wait
+    briefly for the result and fetch the wavelet themselves if it doesn't
+    arrive in time
+    @param retries: the number of times to retry the request
+    @param robot: the Wave robot object
+    @param wave_id: the wave id to attempt to fetch
+    @param wavelet_id: the wavelet id to attempt to fetch
+    
+    @return the wavelet json dict, or if it couldn't be fetched raises an exception
+    '''
+    lease_key = _generate_lease_key(wave_id, wavelet_id)
+    lease = uuid.uuid4().hex
+    
+    if memcache.add(lease_key, lease, time=config.WAVELET_FETCH_LEASE_SECS):
+        try:
+            wavelet_data = _retry_fetch_wavelet_json(retries, robot, wave_id, wavelet_id)
+            #The lease is taken away if the wavelet changes during the fetch
+            if memcache.get(lease_key) == lease:
+                try:
+                    memcache.add(   _generate_result_key(wave_id, wavelet_id, lease),
+                                    wavelet_data.get('json'),
+                                    time=config.WAVELET_FETCH_RESULT_SECS)
+                except ValueError:
+                    logging.warn("Wavelet " + wave_id + " " + wavelet_id + " is too large to share")
+            return wavelet_data
+        finally:
+            if memcache.get(lease_key) == lease:
+                memcache.delete(lease_key)
+    
+    #Somebody else is fetching. The runtime serves one request at a time so
+    #only wait a moment for them to finish
+    lease = memcache.get(lease_key)
+    if not lease == None:
+        result_key = _generate_result_key(wave_id, wavelet_id, lease)
+        deadline = time.time() + config.WAVELET_FETCH_WAIT_SECS
+        while time.time() < deadline:
+            time.sleep(config.WAVELET_FETCH_POLL_SECS)
+            flight = memcache.get_multi([lease_key, result_key])
+            json = flight.get(result_key, None)
+            if not json == None:
+                return robot.lazy_wavelet_data(json)
+            if not flight.get(lease_key, None) == lease:
+                break#The fetch finished without a result we can use
+    
+    logging.info("Single flight fetch for " + wave_id + " " + wavelet_id + " not available. Fetching")
+    return _retry_fetch_wavelet_json(retries, robot, wave_id, wavelet_id)
+
+def invalidate_flight(wave_id, wavelet_id):
+    '''
+    Stops any fetch that is in flight from sharing its result. Used when the
+    wavelet has changed so waiting requests don't receive the old wavelet.
+    The lease is removed as well so the next request starts a new fetch
+    @param wave_id: the wave id of the flight
+    @param wavelet_id: the wavelet id of the flight
+    '''
+    lease_key = _generate_lease_key(wave_id, wavelet_id)
+    lease = memcache.get(lease_key)
+    if not lease == None:
+        #Locking the result stops a fetch that is just finishing from adding it
+        memcache.delete(_generate_result_key(wave_id, wavelet_id, lease),
+                        seconds=config.WAVELET_FETCH_RESULT_SECS)
+        memcache.delete(lease_key)
+
+def _generate_lease_key(wave_id, wavelet_id):
+    '''
+    Generates the memcache key of the lease on a single flight fetch
+    @param wave_id: the wave id to be fetched
+    @param wavelet_id: the wavelet id to be fetched
+    @return the memcache key
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['WAVELET_LEASE'] + wave_id + wavelet_id)
+
+def _generate_result_key(wave_id, wavelet_id, lease):
+    '''
+    Generates the memcache key the result of a single flight fetch is shared
+    under. Each lease has its own key so a result can only reach the
+    requests that waited on that fetch
+    @param wave_id: the wave id to be fetched
+    @param wavelet_id: the wavelet id to be fetched
+    @param lease: the lease the fetch was made under
+    @return the memcache key
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['WAVELET_FLIGHT'] + wave_id + wavelet_id + lease)
+
 def retry_submit(retries, robot, wavelet):
     '''
     Wrapper for submit. Retries a number of times before failing
@@ -69,7 +226,9 @@ def retry_submit(retries, robot, wavelet):
     excep = None
     for i in range(0, retries):
         try:
-            return robot.submit(wavelet)
+            result = robot.submit(wavelet)
+            invalidate_flight(wavelet.wave_id, wavelet.wavelet_id)
+            return result
         except Exception, e:
             excep = e
             if excep.message.find("is not a participant of wave id") != -1 or excep.message.find("RPC Error500") != -1:
@@ -77,6 +236,30 @@ def retry_submit(retries, robot, wavelet):
 
     raise DownloadException("Problem submitting content to Wave server: ".join(excep.args))
 
+def retry_submit_and_fetch_wavelet_json(retries, robot, wavelet):
+    '''
+    Wrapper for submit_and_fetch_wavelet_json. Submits the wavelet and fetches
+    the updated wavelet json in a single request. Retries a number of times
+    before failing. Excepts nicely if a known error is thrown
+    @param retries: the number of times to retry the request
+    @param robot: the Wave robot object
+    @param wavelet: the wavelet with the pending operations to submit
+    
+    @return a tuple of the submit results and the updated wavelet json dict,
+    or if it couldn't be submitted raises an exception
+    '''
+    excep = None
+    for i in range(0, retries):
+        try:
+            result = robot.submit_and_fetch_wavelet_json(wavelet)
+            invalidate_flight(wavelet.wave_id, wavelet.wavelet_id)
+            return result
+        except Exception, e:
+            excep = e
+            if excep.message.find("is not a participant of wave id") != -1 or excep.message.find("RPC Error500") != -1:
+                raise NotParticipantException("User is not participant of Wave")
+
+    raise DownloadException("Problem submitting content to Wave server: ".join(excep.args))
 
 class NotParticipantException(Exception):
     '''
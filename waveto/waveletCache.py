@@ -0,0 +1,115 @@
+'''
+Copyright 2011 Acknack Ltd
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+'''
+Shared cache of wavelet snapshots fetched from the wave server. Every user
+following a wave sees the same wavelet json so a single snapshot can be
+served to all of them before being re-fetched
+'''
+import base64
+import logging
+
+import config
+from dbtools import memcacheConfig
+import waveRpc
+
+from google.appengine.api import memcache
+
+def fetch_wavelet_json(retries, robot, wave_id, wavelet_id, fresh=False):
+    '''
+    Returns the wavelet json from the snapshot cache if it is fresh, otherwise
+    fetches it from the wave server and caches it for the other users
+    @param retries: the number of times to retry a request to the wave server
+    @param robot: the Wave robot object
+    @param wave_id: the wave id to fetch
+    @param wavelet_id: the wavelet id to fetch
+    @param fresh=False: set to True to skip the snapshot and always fetch from
+    the wave server. Use this when the wavelet is about to be changed, as the
+    snapshot can be up to WAVELET_SNAPSHOT_FRESH_SECS old
+
+    @return a dict containing the raw json and the wavelet, which is only built
+    when it is asked for, or raises an exception if it couldn't be fetched
+    '''
+    key = _generateKey(wave_id, wavelet_id)
+    if not fresh:
+        json = memcache.get(key)
+        if not json == None:
+            return robot.lazy_wavelet_data(json)
+
+    wavelet_data = waveRpc.retry_fetch_wavelet_json(retries,
+                                                    robot,
+                                                    wave_id,
+                                                    wavelet_id)
+    try:
+        if fresh:
+            #We know this copy is current so it replaces any older snapshot
+            memcache.set(   key,
+                            wavelet_data.get('json'),
+                            time=config.WAVELET_SNAPSHOT_FRESH_SECS)
+        else:
+            memcache.add(   key,
+                            wavelet_data.get('json'),
+                            time=config.WAVELET_SNAPSHOT_FRESH_SECS)
+    except ValueError:
+        logging.warn("Wavelet " + wave_id + " " + wavelet_id + " is too large to cache")
+    return wavelet_data
+
+def submit_and_fetch_wavelet_json(retries, robot, wavelet):
+    '''
+    Submits the pending operations on a wavelet and caches the updated
+    wavelet that is returned with the submit
+    @param retries: the number of times to retry a request to the wave server
+    @param robot: the Wave robot object
+    @param wavelet: the wavelet with the pending operations to submit
+
+    @return a dict containing the raw json and the updated wavelet, which is
+    only built when it is asked for, or raises an exception if it couldn't be
+    submitted
+    '''
+    invalidate(wavelet.wave_id, wavelet.wavelet_id)
+    submit_results, wavelet_data = waveRpc.retry_submit_and_fetch_wavelet_json(  retries,
+                                                                                robot,
+                                                                                wavelet)
+    try:
+        #Set overrides the invalidate lock. We know this copy is current
+        memcache.set(   _generateKey(wavelet.wave_id, wavelet.wavelet_id),
+                        wavelet_data.get('json'),
+                        time=config.WAVELET_SNAPSHOT_FRESH_SECS)
+    except ValueError:
+        logging.warn("Wavelet " + wavelet.wave_id + " " + wavelet.wavelet_id + " is too large to cache")
+    return wavelet_data
+
+def invalidate(wave_id, wavelet_id):
+    '''
+    Removes the snapshot of a wavelet from the cache, along with the result of
+    any fetch of it that is in flight. Call this whenever the wavelet is known
+    to have changed
+    @param wave_id: the wave id of the snapshot
+    @param wavelet_id: the wavelet id of the snapshot
+    '''
+    memcache.delete(_generateKey(wave_id, wavelet_id),
+                    seconds=config.WAVELET_SNAPSHOT_INVALIDATE_LOCK_SECS)
+    waveRpc.invalidate_flight(wave_id, wavelet_id)
+
+def _generateKey(wave_id, wavelet_id):
+    '''
+    Generates the memcache key for a wavelet snapshot
+    @param wave_id: the wave id of the snapshot
+    @param wavelet_id: the wavelet id of the snapshot
+    @return the memcache key
+    '''
+    return base64.b64encode(memcacheConfig.PREFIX['WAVELET'] +
+                            wave_id + wavelet_id)
@@ -26,3 +26,21 @@ def getRootBlip(wavelet):
         if blip.is_root():
             return blip
     return false
+
+def getBlipChanges(wavelet_json, known_versions):
+    """
+    Compares the blips in the raw wavelet json against the blip versions a
+    client already has
+    @param wavelet_json the raw wavelet json from the wave server
+    @param known_versions dict of blip id to the version the client has
+
+    @return a tuple of a dict containing the raw blips that were added or
+    changed and a list of the blip ids that were removed
+    """
+    blips = wavelet_json.get('blips', {})
+    changed = {}
+    for blip_id, raw_blip in blips.items():
+        if not known_versions.get(blip_id, None) == raw_blip.get('version'):
+            changed[blip_id] = raw_blip
+    removed = [blip_id for blip_id in known_versions if not blip_id in blips]
+    return changed, removed
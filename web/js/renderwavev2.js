@@ -20,6 +20,8 @@ var reloadPage = undefined;
 	var clickedButton = undefined;
 	var dialogOpen = false;
 	var viewerSession = undefined;
+	var pushConnected = false;
+	var pollTimeout = undefined;
 	
 	/**
 	* Final variables
@@ -40,6 +42,10 @@ var reloadPage = undefined;
 	var PROFILE_ID_PREFIX = {
 		IMG				    :	'participantImage_'	
 	};
+	var REFRESH_INTERVAL = {
+		POLLING			    :	15000,
+		PUSH_FALLBACK	    :	120000
+	};
 	
 	/**
 	* Represnts participant profiles in javascript way
@@ -293,6 +299,44 @@ var reloadPage = undefined;
 		        return true;
 		    }
 		    return false;
+		},
+		/**
+		* Describes the state of the wavelet we already have so the server
+		* only needs to send us what has changed
+		* @param waveletJson: the waveletJson we currently have
+		* @return map containing the blip versions and the field digests
+		*/
+		getKnownState       :   function(waveletJson) {
+		    var blipVersions = {};
+		    var blips = waveletJson['wavelet']['blips'];
+		    for(var blipId in blips) {
+		        blipVersions[blipId] = blips[blipId]['version'];
+		    }
+		    return {'blips': blipVersions, 'digests': waveletJson['digests']};
+		},
+		/**
+		* Applies a delta response from the server to the waveletJson we have
+		* @param waveletJson: the waveletJson we currently have
+		* @param delta: the delta response from the server
+		* @return a new waveletJson with the changes applied
+		*/
+		mergeWaveletDelta   :   function(waveletJson, delta) {
+		    var merged = JSON.parse(JSON.stringify(waveletJson));
+		    var changes = delta['wavelet'];
+		    merged['wavelet']['waveletData'] = changes['waveletData'];
+		    for(var blipId in changes['blips']) {
+		        merged['wavelet']['blips'][blipId] = changes['blips'][blipId];
+		    }
+		    for(var i = 0; i < changes['removedBlips'].length; i++) {
+		        delete merged['wavelet']['blips'][changes['removedBlips'][i]];
+		    }
+		    var fields = ['readblips', 'profiles', 'rwPermission', 'isPublic', 'digests', 'etag'];
+		    for(var j = 0; j < fields.length; j++) {
+		        if(delta[fields[j]] !== undefined) {
+		            merged[fields[j]] = delta[fields[j]];
+		        }
+		    }
+		    return merged;
 		}
 	};
 	
@@ -1117,16 +1161,18 @@ var reloadPage = undefined;
 	};
 	
 	/**
-	* Refreshes the wave and sets the timeout to do it again
+	* Fetches any changes to the wave and re-renders the page
 	*/
-	reloadPage = function() {
+	var refreshWavelet = function() {
 		if(!dialogOpen) {
 
 			var jsondata = JSON.stringify({	'action': 'REFRESH',
      										'waveid': utils.getUrlArg('waveid'),
      										'waveletid': utils.getUrlArg('waveletid'),
      										'email': utils.getUrlArg('email'),
-     										'auth': utils.getUrlArg('auth')})
+     										'auth': utils.getUrlArg('auth'),
+     										'known': utils.getKnownState(waveletJson),
+     										'etag': waveletJson['etag']})
      			
 			$.ajax({
      			'dataType': 'json',
@@ -1135,11 +1181,85 @@ var reloadPage = undefined;
      			'contentType': 'application/json',
      			'data': jsondata,
      			'success': function(data, textStatus) {
+     				if(data['unchanged']) {
+     					return;
+     				}
+     				if(data['delta']) {
+     					data = utils.mergeWaveletDelta(waveletJson, data);
+     				}
      				reloadWavelet(data);
      			}
    			});
 		}
-		setTimeout('reloadPage()', 15000);
+	};
+	
+	/**
+	* Refreshes the wave and sets the timeout to do it again. Polling is only a
+	* slow fallback while updates are being pushed to the page
+	*/
+	reloadPage = function() {
+		refreshWavelet();
+		if(pushConnected) {
+			pollTimeout = setTimeout('reloadPage()', REFRESH_INTERVAL['PUSH_FALLBACK']);
+		} else {
+			pollTimeout = setTimeout('reloadPage()', REFRESH_INTERVAL['POLLING']);
+		}
+	};
+	
+	/**
+	* Goes back to polling when the channel goes down. The next poll was set
+	* for the slow push fallback interval so it is replaced with one now
+	*/
+	var pushLost = function() {
+		if(!pushConnected) {
+			return;
+		}
+		pushConnected = false;
+		clearTimeout(pollTimeout);
+		reloadPage();
+	};
+	
+	/**
+	* Opens a channel so the server can tell us as soon as the wave changes.
+	* If the channel api is not available the page keeps polling
+	*/
+	var connectPush = function() {
+		if(typeof goog === "undefined" || goog.appengine === undefined) {
+			return;
+		}
+		var jsondata = JSON.stringify({	'action': 'CONNECT',
+										'waveid': utils.getUrlArg('waveid'),
+										'waveletid': utils.getUrlArg('waveletid'),
+										'email': utils.getUrlArg('email'),
+										'auth': utils.getUrlArg('auth')})
+		
+		$.ajax({
+			'dataType': 'json',
+			'url': robotWebAddress + "wave/action/",
+			'type': 'POST',
+			'contentType': 'application/json',
+			'data': jsondata,
+			'success': function(data, textStatus) {
+				if(!data['token']) {
+					return;
+				}
+				var socket = new goog.appengine.Channel(data['token']).open();
+				socket.onopen = function() {
+					pushConnected = true;
+				};
+				socket.onmessage = function(message) {
+					refreshWavelet();
+				};
+				socket.onerror = function(error) {
+					pushLost();
+				};
+				socket.onclose = function() {
+					//Channels expire so open a new one
+					pushLost();
+					setTimeout(connectPush, REFRESH_INTERVAL['PUSH_FALLBACK']);
+				};
+			}
+		});
 	};
 	
 	
@@ -1150,6 +1270,7 @@ var reloadPage = undefined;
 	    waveletJson = JSON.parse(Base64.decode(waveletJson));
 	    
         setup(waveletJson);
-        setTimeout('reloadPage()', 15000);
+        connectPush();
+        pollTimeout = setTimeout('reloadPage()', REFRESH_INTERVAL['POLLING']);
     });
 })(jQuery);
\ No newline at end of file
@@ -13,7 +13,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 */
-var reloadPage=undefined;(function($){var clickedButton=undefined;var dialogOpen=false;var viewerSession=undefined;var BLIP_ID_PREFIX={CHILDREN_CONTAINER:'blip-children-container-',CONTAINER:'blip-container-',INLINE_CONTAINER:'inline-container-',INLINE_TOGGLE:'inline-toggle-',CONTRIBUTOR:'blip-contributor-',LAST_EDITED:'blip-last-edited-',CONTENT:'blip-content-',REPLY:'reply-button-',REPLY_IMAGE:"reply-image-",WORKING:'working-image-',READ_STATUS:'blip-readstatus'};var PROFILE_ID_PREFIX={IMG:'participantImage_'};var Profiles=function(rawProfiles){var self=this;self.rawProfiles=rawProfiles;self.getRawParticipant=function(id){return self.rawProfiles[id]||{};};self.getDisplayName=function(id){if(id===robotEmail){return"Mr-Ray";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf(publicEmail.replace("@",proxyForAtReplace))!==-1){return id.replace(robotIdent+"+","").replace("."+publicEmail.replace("@",proxyForAtReplace),"").replace("@"+robotDomain,"")+"(via Mr-Ray Public)";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf("@"+robotDomain===id.length-12)){return utils.maskEmailIfPublic(id.replace(robotIdent+"+","").replace("@"+robotDomain,"").replace(proxyForAtReplace,"@"))+"(via Mr-Ray)";}else{return self.getRawParticipant(id)['displayName']||id;}};self.getImageUrl=function(id){if(id===robotEmail){return robotWebAddress+"web/media/icon.png";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf(publicEmail.replace("@",proxyForAtReplace))!==-1){return robotWebAddress+"web/media/icon_public.png";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf("@"+robotDomain)===id.length-12){return robotWebAddress+"web/media/icon_proxyfor.png";}else{return self.getRawParticipant(id)['thumbUrl']||robotWebAddress+"web/media/icon_waver.png";}};};var Session=function(rawIsPublic,rawRwPermission){var self=this;self.rawIsPublic=rawIsPublic;self.rawRwPermission=rawRwPermission;self.unreadCount=0;self.isPublic=function(){return self.rawIsPublic;};self.canWrite=function(){if(self.rawRwPermission==="rw"){return true;}else{return false;}};self.incrementUnreadCount=function(qty){self.unreadCount+=qty;};self.decrementUnreadCount=function(qty){self.unreadCount-=qty}
+var reloadPage=undefined;(function($){var clickedButton=undefined;var dialogOpen=false;var viewerSession=undefined;var pushConnected=false;var pollTimeout=undefined;var BLIP_ID_PREFIX={CHILDREN_CONTAINER:'blip-children-container-',CONTAINER:'blip-container-',INLINE_CONTAINER:'inline-container-',INLINE_TOGGLE:'inline-toggle-',CONTRIBUTOR:'blip-contributor-',LAST_EDITED:'blip-last-edited-',CONTENT:'blip-content-',REPLY:'reply-button-',REPLY_IMAGE:"reply-image-",WORKING:'working-image-',READ_STATUS:'blip-readstatus'};var PROFILE_ID_PREFIX={IMG:'participantImage_'};var REFRESH_INTERVAL={POLLING:15000,PUSH_FALLBACK:120000};var Profiles=function(rawProfiles){var self=this;self.rawProfiles=rawProfiles;self.getRawParticipant=function(id){return self.rawProfiles[id]||{};};self.getDisplayName=function(id){if(id===robotEmail){return"Mr-Ray";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf(publicEmail.replace("@",proxyForAtReplace))!==-1){return id.replace(robotIdent+"+","").replace("."+publicEmail.replace("@",proxyForAtReplace),"").replace("@"+robotDomain,"")+"(via Mr-Ray Public)";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf("@"+robotDomain===id.length-12)){return utils.maskEmailIfPublic(id.replace(robotIdent+"+","").replace("@"+robotDomain,"").replace(proxyForAtReplace,"@"))+"(via Mr-Ray)";}else{return self.getRawParticipant(id)['displayName']||id;}};self.getImageUrl=function(id){if(id===robotEmail){return robotWebAddress+"web/media/icon.png";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf(publicEmail.replace("@",proxyForAtReplace))!==-1){return robotWebAddress+"web/media/icon_public.png";}else if(id.indexOf(robotIdent+"+")===0&&id.indexOf("@"+robotDomain)===id.length-12){return robotWebAddress+"web/media/icon_proxyfor.png";}else{return self.getRawParticipant(id)['thumbUrl']||robotWebAddress+"web/media/icon_waver.png";}};};var Session=function(rawIsPublic,rawRwPermission){var self=this;self.rawIsPublic=rawIsPublic;self.rawRwPermission=rawRwPermission;self.unreadCount=0;self.isPublic=function(){return self.rawIsPublic;};self.canWrite=function(){if(self.rawRwPermission==="rw"){return true;}else{return false;}};self.incrementUnreadCount=function(qty){self.unreadCount+=qty;};self.decrementUnreadCount=function(qty){self.unreadCount-=qty}
 self.getUnreadCount=function(){return self.unreadCount;}};var utils={epochToDate:function(epoch){var d=new Date(epoch);var day=d.getDate();var month=d.getMonth()+1;var year=d.getFullYear();if(month<10){month="0"+month;}
 return day+"-"+month+"-"+year;},epochToDateTime:function(epoch){var d=new Date(epoch);var hours=d.getHours();var minutes=d.getMinutes();var day=d.getDate();var month=d.getMonth()+1;var year=d.getFullYear();if(minutes<10){minutes="0"+minutes;}
 if(month<10){month="0"+month;}
@@ -23,7 +23,11 @@ return participantString;},getParticipantDisplayNameAndRaw:function(profiles,id)
 atIndex=maskedEmail.indexOf(proxyForAtReplace);if(atIndex!==-1){dotIndex=maskedEmail.substr(atIndex,maskedEmail.length).indexOf(".")+atIndex;maskedEmail=maskedEmail.substr(0,atIndex)+'@******'+maskedEmail.substr(dotIndex);}
 email=maskedEmail;}
 return email;},insertIntoString:function(originalString,toInsert,index){return originalString.substr(0,index)+toInsert+originalString.substr(index);},areWaveletsSame:function(wavelet1,wavelet2){if(JSON.stringify(wavelet1)===JSON.stringify(wavelet2)){return true;}
-return false;}};var setBlipAsRead=function(blipId,waveTitle){var readStatusElem=$(document.getElementById(BLIP_ID_PREFIX['READ_STATUS']+blipId));if(readStatusElem.attr("class").indexOf("blipIsRead")===-1){readStatusElem.fadeOut('slow',function(){$(this).attr("style","visibility: hidden;")});readStatusElem.attr("class",readStatusElem.attr("class")+" blipIsRead");viewerSession.decrementUnreadCount(1);$(document).attr("title",waveTitle+utils.getFriendlyUnreadCount()+" - Mr-Ray. Wav-e-mail");var jsondata=JSON.stringify({'action':'READ','blipid':blipId,'waveid':utils.getUrlArg('waveid'),'waveletid':utils.getUrlArg('waveletid'),'email':utils.getUrlArg('email'),'auth':utils.getUrlArg('auth')})
+return false;},getKnownState:function(waveletJson){var blipVersions={};var blips=waveletJson['wavelet']['blips'];for(var blipId in blips){blipVersions[blipId]=blips[blipId]['version'];}
+return{'blips':blipVersions,'digests':waveletJson['digests']};},mergeWaveletDelta:function(waveletJson,delta){var merged=JSON.parse(JSON.stringify(waveletJson));var changes=delta['wavelet'];merged['wavelet']['waveletData']=changes['waveletData'];for(var blipId in changes['blips']){merged['wavelet']['blips'][blipId]=changes['blips'][blipId];}
+for(var i=0;i<changes['removedBlips'].length;i++){delete merged['wavelet']['blips'][changes['removedBlips'][i]];}
+var fields=['readblips','profiles','rwPermission','isPublic','digests','etag'];for(var j=0;j<fields.length;j++){if(delta[fields[j]]!==undefined){merged[fields[j]]=delta[fields[j]];}}
+return merged;}};var setBlipAsRead=function(blipId,waveTitle){var readStatusElem=$(document.getElementById(BLIP_ID_PREFIX['READ_STATUS']+blipId));if(readStatusElem.attr("class").indexOf("blipIsRead")===-1){readStatusElem.fadeOut('slow',function(){$(this).attr("style","visibility: hidden;")});readStatusElem.attr("class",readStatusElem.attr("class")+" blipIsRead");viewerSession.decrementUnreadCount(1);$(document).attr("title",waveTitle+utils.getFriendlyUnreadCount()+" - Mr-Ray. Wav-e-mail");var jsondata=JSON.stringify({'action':'READ','blipid':blipId,'waveid':utils.getUrlArg('waveid'),'waveletid':utils.getUrlArg('waveletid'),'email':utils.getUrlArg('email'),'auth':utils.getUrlArg('auth')})
 $.ajax({'dataType':'json','url':robotWebAddress+"wave/action/",'type':'POST','contentType':'application/json','data':jsondata});}};var elementFactory=function(elemType,attr,elemText,clickEvent){var elem=$(document.createElement(elemType));for(var n in attr){elem.attr(n,attr[n]);}
 if(elemText!==undefined&&elemText!==false){elem.text(elemText);}
 if(clickEvent!==undefined&&clickEvent!==false){elem.click(clickEvent);}
@@ -59,6 +63,11 @@ $("#replyform").dialog('close');$(clickedButton).replaceWith(elementFactory("img
 dialogOpen=false;}});};var setup=function(waveletJson){viewerSession=new Session(waveletJson['isPublic'],waveletJson['rwPermission']);var wavelet=new Wavelet(waveletJson['wavelet'],waveletJson['readblips'],waveletJson['profiles']);setupReplyDialog();setupReplyGenericErrorDialog();setupReplyNotParticipantErrorDialog();$('#replyform').attr("style","");$('#replysubmitgenericerror').attr("style","");$('#replysubmitnotparticipanterror').attr("style","");if(viewerSession.isPublic()){$('#responseNameContainer').attr("style","").show();}
 wavelet.renderBlips($('#blips'));wavelet.renderParticipants($('#participants'));wavelet.renderTitle($('#headertitle'));};var reloadWavelet=function(newWaveletJson){if(newWaveletJson!==undefined&&newWaveletJson!==null){if(utils.areWaveletsSame(newWaveletJson,waveletJson)){return;}
 waveletJson=newWaveletJson;}
-var scrollPosition=$(window).scrollTop();$('#headertitle').children().remove();$('#participants').children().remove();$('#blips').children().remove();setup(waveletJson);$(window).scrollTop(scrollPosition);};reloadPage=function(){if(!dialogOpen){var jsondata=JSON.stringify({'action':'REFRESH','waveid':utils.getUrlArg('waveid'),'waveletid':utils.getUrlArg('waveletid'),'email':utils.getUrlArg('email'),'auth':utils.getUrlArg('auth')})
-$.ajax({'dataType':'json','url':robotWebAddress+"wave/action/",'type':'POST','contentType':'application/json','data':jsondata,'success':function(data,textStatus){reloadWavelet(data);}});}
-setTimeout('reloadPage()',15000);};$(document).ready(function(){robotEmail=Base64.decode(robotEmail);publicEmail=Base64.decode(publicEmail);waveletJson=JSON.parse(Base64.decode(waveletJson));setup(waveletJson);setTimeout('reloadPage()',15000);});})(jQuery);
\ No newline at end of file
+var scrollPosition=$(window).scrollTop();$('#headertitle').children().remove();$('#participants').children().remove();$('#blips').children().remove();setup(waveletJson);$(window).scrollTop(scrollPosition);};var refreshWavelet=function(){if(!dialogOpen){var jsondata=JSON.stringify({'action':'REFRESH','waveid':utils.getUrlArg('waveid'),'waveletid':utils.getUrlArg('waveletid'),'email':utils.getUrlArg('email'),'auth':utils.getUrlArg('auth'),'known':utils.getKnownState(waveletJson),'etag':waveletJson['etag']})
+$.ajax({'dataType':'json','url':robotWebAddress+"wave/action/",'type':'POST','contentType':'application/json','data':jsondata,'success':function(data,textStatus){if(data['unchanged']){return;}
+if(data['delta']){data=utils.mergeWaveletDelta(waveletJson,data);}
+reloadWavelet(data);}});}};reloadPage=function(){refreshWavelet();if(pushConnected){pollTimeout=setTimeout('reloadPage()',REFRESH_INTERVAL['PUSH_FALLBACK']);}else{pollTimeout=setTimeout('reloadPage()',REFRESH_INTERVAL['POLLING']);}};var pushLost=function(){if(!pushConnected){return;}
+pushConnected=false;clearTimeout(pollTimeout);reloadPage();};var connectPush=function(){if(typeof goog==="undefined"||goog.appengine===undefined){return;}
+var jsondata=JSON.stringify({'action':'CONNECT','waveid':utils.getUrlArg('waveid'),'waveletid':utils.getUrlArg('waveletid'),'email':utils.getUrlArg('email'),'auth':utils.getUrlArg('auth')})
+$.ajax({'dataType':'json','url':robotWebAddress+"wave/action/",'type':'POST','contentType':'application/json','data':jsondata,'success':function(data,textStatus){if(!data['token']){return;}
+var socket=new goog.appengine.Channel(data['token']).open();socket.onopen=function(){pushConnected=true;};socket.onmessage=function(message){refreshWavelet();};socket.onerror=function(error){pushLost();};socket.onclose=function(){pushLost();setTimeout(connectPush,REFRESH_INTERVAL['PUSH_FALLBACK']);};}});};$(document).ready(function(){robotEmail=Base64.decode(robotEmail);publicEmail=Base64.decode(publicEmail);waveletJson=JSON.parse(Base64.decode(waveletJson));setup(waveletJson);connectPush();pollTimeout=setTimeout('reloadPage()',REFRESH_INTERVAL['POLLING']);});})(jQuery);
\ No newline at end of file